@@ -0,0 +1,282 @@
+"""
+This file contains the annotation store of a camera, which replaces the 'json' file written for every frame. The faces
+and license plates of all the frames of a camera are rows of a single append-only file of NumPy records, and a second
+file indexes the rows of every frame. Both files can be memory-mapped, so whole cameras are read without touching
+thousands of small files, and they can be exported to the 'json' layout for the tools which still need it.
+
+The record of a frame also tells whether its annotations were detected or reused from an earlier frame, and from
+which one (see keyframes.DuplicateFilter).
+
+    python annotationstore.py export <dataset>
+"""
+
+import json
+import os
+import sys
+import numpy as np
+
+# kinds of annotation
+FACE = 0
+PLATE = 1
+
+# one row per bounding box, a license plate annotation may hold several boxes
+DETECTION_DTYPE = np.dtype([('kind', '<u1'), ('group', '<i4'), ('object', '<i4'), ('confidence', '<f8'), ('box', '<i4', (4,))])
+
+# longest frame name a frame record holds, in bytes
+NAME_SIZE = 64
+
+# one row per frame, the latest row of a frame holds its annotations, source is the frame they were reused from
+FRAME_DTYPE = np.dtype([('name', f'S{NAME_SIZE}'), ('start', '<i8'), ('count', '<i4'), ('source', f'S{NAME_SIZE}')])
+
+# first row of a frames file, identifying the format
+HEADER = np.array([(b"annotationstore/1", 0, 0, b"")], dtype=FRAME_DTYPE)
+
+def check_name(name):
+    """
+    Function to make sure a frame name fits in a frame record, a longer name would be cut and could be mistaken for
+    another frame.
+
+    Parameters:
+        name: File name of the frame.
+    """
+    if len(name.encode()) > NAME_SIZE:
+        raise ValueError(f"The name of {name} is longer than the {NAME_SIZE} bytes of the annotation store, its annotations "
+                         f"have to be saved as 'json' files.")
+
+def _load(path, dtype, offset=0):
+    # memory-mapped records of a file after offset bytes, np.memmap can't map an empty file
+    if not os.path.isfile(path) or os.path.getsize(path) < offset + dtype.itemsize:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=((os.path.getsize(path) - offset) // dtype.itemsize,))
+
+class AnnotationStore:
+    """
+    Annotations of all the frames of a camera. Appended frames are buffered in memory and written in bulk by flush.
+    A frame appended again, e.g. when it is processed again, replaces its earlier annotations.
+
+    Parameters:
+        path: Location of the store without extension, e.g. '<sequence>/annotations/<cam>'. The store is made of
+              '<path>.frames' and '<path>.detections'.
+    """
+    def __init__(self, path):
+        self.frames_path = path + ".frames"
+        self.detections_path = path + ".detections"
+
+        self._frames = []
+        self._detections = []
+        self._index = None
+        self._sources = None
+
+        self._recover()
+
+    def _recover(self):
+        # an interrupted flush may leave a partial frame record, and rows which no frame points to
+        if os.path.isfile(self.frames_path):
+            with open(self.frames_path, 'r+b') as f:
+                f.truncate(os.path.getsize(self.frames_path) // FRAME_DTYPE.itemsize * FRAME_DTYPE.itemsize)
+                f.seek(0)
+                if f.read(FRAME_DTYPE.itemsize) not in (b"", HEADER.tobytes()):
+                    raise ValueError(f"{self.frames_path} isn't a frames file of an annotation store.")
+
+        frames = self.frames()
+        end = int(frames['start'][-1] + frames['count'][-1]) if len(frames) else 0
+        del frames
+
+        if os.path.isfile(self.detections_path) and os.path.getsize(self.detections_path) > end * DETECTION_DTYPE.itemsize:
+            with open(self.detections_path, 'r+b') as f:
+                f.truncate(end * DETECTION_DTYPE.itemsize)
+
+    def append(self, name, faces, plates, source=None):
+        """
+        Function to add the annotations of a frame, in the format of the 'json' files.
+
+        Parameters:
+            name: File name of the frame.
+            faces: Dictionary of faces, {'face_<n>': {'Confidence', 'Bounding box'}}.
+            plates: Dictionary of license plates, {vehicle: {object ID: {'Confidence', 'Bounding box'}}}.
+            source: File name of the frame the annotations were reused from, NoneType object if they were detected.
+        """
+        check_name(name)
+        if source is not None:
+            check_name(source)
+
+        rows = []
+        for face, detection in faces.items():
+            rows.append((FACE, -1, int(face.split("_")[-1]), detection['Confidence'], detection['Bounding box']))
+
+        for vehicle, objects in plates.items():
+            for objectId, detection in objects.items():
+                for box in detection['Bounding box']:
+                    rows.append((PLATE, int(vehicle), int(objectId), detection['Confidence'], box))
+
+        self._frames.append((name, len(rows), source or ""))
+        self._detections.extend(rows)
+
+    def flush(self):
+        """
+        Function to write the appended frames, detections first so that the index never points past them.
+        """
+        if not self._frames:
+            return
+
+        start = os.path.getsize(self.detections_path) // DETECTION_DTYPE.itemsize if os.path.isfile(self.detections_path) else 0
+
+        frames = np.empty(len(self._frames), dtype=FRAME_DTYPE)
+        frames['name'] = [name.encode() for name, _, _ in self._frames]
+        frames['count'] = [count for _, count, _ in self._frames]
+        frames['start'] = start + np.cumsum(frames['count']) - frames['count']
+        frames['source'] = [source.encode() for _, _, source in self._frames]
+
+        with open(self.detections_path, 'ab') as f:
+            f.write(np.array(self._detections, dtype=DETECTION_DTYPE).tobytes())
+        with open(self.frames_path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(HEADER.tobytes())
+            f.write(frames.tobytes())
+
+        self._frames.clear()
+        self._detections.clear()
+        self._index = None
+        self._sources = None
+
+    def frames(self):
+        """
+        Function to get the frame records written so far, memory-mapped.
+        """
+        return _load(self.frames_path, FRAME_DTYPE, offset=FRAME_DTYPE.itemsize)
+
+    def detections(self):
+        """
+        Function to get the detection records written so far, memory-mapped.
+        """
+        return _load(self.detections_path, DETECTION_DTYPE)
+
+    def index(self):
+        """
+        Function to get the rows of every frame.
+
+        Return:
+            Dictionary of (first row, number of rows) of every frame name, in order of first appearance.
+        """
+        if self._index is None:
+            frames = self.frames()
+            self._index = {name.decode(): (int(start), int(count)) for name, start, count in zip(frames['name'], frames['start'], frames['count'])}
+            self._sources = {name.decode(): source.decode() or None for name, source in zip(frames['name'], frames['source'])}
+
+        return self._index
+
+    def source(self, name):
+        """
+        Function to get the frame the annotations of a frame were reused from.
+
+        Parameters:
+            name: File name of the frame.
+
+        Return:
+            File name of the source frame, NoneType object if the annotations of the frame were detected.
+        """
+        self.index()
+        return self._sources[name]
+
+    def __len__(self):
+        return len(self.index())
+
+    def __contains__(self, name):
+        return name in self.index()
+
+    def __getitem__(self, name):
+        """
+        Function to get the detection records of a frame.
+
+        Parameters:
+            name: File name of the frame.
+        """
+        start, count = self.index()[name]
+        return self.detections()[start:start + count]
+
+    def annotations(self, name):
+        """
+        Function to get the annotations of a frame in the format of the 'json' files.
+
+        Parameters:
+            name: File name of the frame.
+
+        Return:
+            Dictionary of faces and dictionary of license plates.
+        """
+        faces = {}
+        plates = {}
+        rows = self[name]
+        for kind, group, objectId, confidence, box in zip(*(rows[field].tolist() for field in DETECTION_DTYPE.names)):
+            if kind == FACE:
+                faces[f"face_{objectId}"] = {'Confidence': confidence, 'Bounding box': box}
+            else:
+                plate = plates.setdefault(str(group), {}).setdefault(str(objectId), {'Confidence': confidence, 'Bounding box': []})
+                plate['Bounding box'].append(box)
+
+        return faces, plates
+
+    def export_json(self, face_path, lic_path, frame_path):
+        """
+        Function to write the annotations of every frame as 'json' files, named after the frames.
+
+        Parameters:
+            face_path, lic_path: Directories of the face and license plate annotations of the camera.
+            frame_path: Directory of the frame records of the camera, see frame_record.
+        """
+        for path in (face_path, lic_path, frame_path):
+            os.makedirs(path, exist_ok=True)
+
+        for name in self.index():
+            stem = os.path.splitext(name)[0]
+            for path, result in zip((face_path, lic_path, frame_path), (*self.annotations(name), frame_record(self.source(name)))):
+                with open(os.path.join(path, f"{stem}.json"), "w") as f:
+                    f.write(json.dumps(result))
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def frame_record(source):
+    """
+    Function to get the record of a frame in the 'json' layout, telling where its annotations come from.
+
+    Parameters:
+        source: File name of the frame the annotations were reused from, NoneType object if they were detected.
+    """
+    return {'Reused': source is not None, 'Source frame': source}
+
+def camera_stores(dataset):
+    """
+    Generator going through the annotation stores of a dataset.
+
+    Parameters:
+        dataset: Directory of the dataset.
+
+    Return:
+        Yields (sequence directory, camera, store).
+    """
+    for dir in sorted(os.listdir(dataset)):
+        annotations = os.path.join(dataset, dir, "annotations")
+        if not os.path.isdir(annotations):
+            continue
+
+        for file in sorted(os.listdir(annotations)):
+            if file.endswith(".frames"):
+                cam = file[:-len(".frames")]
+                yield os.path.join(dataset, dir), cam, AnnotationStore(os.path.join(annotations, cam))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "export":
+        print("Usage : python annotationstore.py export <dataset>")
+        sys.exit(1)
+
+    for currdir, cam, store in camera_stores(sys.argv[2]):
+        store.export_json(os.path.join(currdir, "annotations", "faces", cam), os.path.join(currdir, "annotations", "license-plates", cam),
+                          os.path.join(currdir, "annotations", "frames", cam))
+        print(f"Annotations of {cam} of {os.path.basename(currdir)} have been exported")
@@ -0,0 +1,484 @@
+"""
+This file contains the benchmarks of the detection and blurring pipeline. A synthetic dataset laid out like the
+India Driving Dataset (<sequence>/camera/<cam>/*.png) is generated, and the throughput (frames per second) and
+peak memory of every stage are measured and compared against a stored baseline.
+
+By default Darknet and RetinaFace are replaced by stub detectors returning synthetic boxes, so the benchmarks
+run without weights or a GPU while still exercising all the Python code around the networks.
+
+    python benchmark.py --save-baseline benchmark-baseline.json
+    python benchmark.py --baseline benchmark-baseline.json
+"""
+
+from types import ModuleType, SimpleNamespace
+import argparse
+import ctypes
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import cv2
+
+def make_dataset(root, sequences=2, cameras=2, frames=16, width=1920, height=1080, seed=0, video=False, pan=8):
+    """
+    Function to generate a synthetic dataset, the frames of a camera are a slowly panning random texture.
+
+    Parameters:
+        root: Directory of the dataset, created if it doesn't exist.
+        sequences, cameras, frames: Number of sequences, cameras per sequence and frames per camera.
+        width, height: Resolution of the frames.
+        seed: Seed of the random texture.
+        video: Save every camera as an MP4 video (<sequence>/camera/<cam>.mp4) instead of a folder of frames.
+        pan: Pixels the texture moves by from a frame to the next, 0 for a still scene.
+
+    Return:
+        Total number of frames generated.
+    """
+    rng = np.random.default_rng(seed)
+
+    for s in range(sequences):
+        for c in range(cameras):
+            currcam = os.path.join(root, f"seq_{s:03d}", "camera", f"cam{c}")
+            os.makedirs(os.path.dirname(currcam) if video else currcam, exist_ok=True)
+
+            texture = rng.integers(0, 256, (height // 8, width // 8 + frames * pan // 8, 3), dtype=np.uint8)
+            texture = cv2.resize(texture, (texture.shape[1] * 8, height), interpolation=cv2.INTER_LINEAR)
+
+            if video:
+                writer = cv2.VideoWriter(f"{currcam}.mp4", cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height))
+                for f in range(frames):
+                    writer.write(np.ascontiguousarray(texture[:, f * pan: f * pan + width]))
+                writer.release()
+                continue
+
+            for f in range(frames):
+                cv2.imwrite(os.path.join(currcam, f"{f:05d}.png"), texture[:, f * pan: f * pan + width])
+
+    return sequences * cameras * frames
+
+def stub_darknet(vehicles=6, plates=24, seed=0):
+    """
+    Function to build a module standing in for the Darknet wrapper (darknet.darknet). The networks return
+    a fixed number of vehicles per frame and of candidate plates per vehicle, with random confidences so
+    that the detection thresholds still filter them.
+
+    Parameters:
+        vehicles: Number of vehicles detected per frame.
+        plates: Number of candidate plates detected per vehicle.
+        seed: Seed of the synthetic detections.
+    """
+    dn = ModuleType("darknet.darknet")
+    rng = np.random.default_rng(seed)
+
+    class IMAGE(ctypes.Structure):
+        _fields_ = [("w", ctypes.c_int), ("h", ctypes.c_int), ("c", ctypes.c_int),
+                    ("data", ctypes.POINTER(ctypes.c_float))]
+
+    def load_network(config_file, data_file, weights, batch_size=1):
+        kind = "lp" if "lp-" in config_file else "vehicle"
+        return SimpleNamespace(kind=kind, width=416, height=416, batch_size=batch_size), [kind], {}
+
+    def make_image(w, h, c):
+        data = (ctypes.c_float * (w * h * c))()
+        image = IMAGE(w, h, c, ctypes.cast(data, ctypes.POINTER(ctypes.c_float)))
+        image.buffer = data
+        return image
+
+    def predictions(network, thresh):
+        w, h = network.width, network.height
+        if network.kind == "vehicle":
+            size = rng.uniform(40, 160, (vehicles, 2))
+            centre = rng.uniform(size / 2, np.array([w, h]) - size / 2)
+            scores = rng.uniform(0.2, 1, vehicles)
+        else:
+            # candidates scattered around a single plate in the lower half of the vehicle
+            size = np.array([w / 4, h / 8]) * rng.uniform(0.8, 1.2, (plates, 2))
+            centre = np.array([w / 2, h * 3 / 4]) + rng.normal(0, 6, (plates, 2))
+            scores = rng.uniform(0, 1, plates)
+
+        return [(network.kind, score, (x, y, bw, bh))
+                for (x, y), (bw, bh), score in zip(centre, size, scores) if score >= thresh]
+
+    def network_predict_batch(network, image, batch_size, w, h, thresh, hier, map, relative, letter):
+        return [SimpleNamespace(num=None, dets=predictions(network, thresh)) for _ in range(batch_size)]
+
+    def decode_detection(detections):
+        return [(str(label), str(round(confidence * 100, 2)), bbox) for label, confidence, bbox in detections]
+
+    def bbox2points(bbox):
+        x, y, w, h = bbox
+        return int(round(x - (w / 2))), int(round(y - (h / 2))), int(round(x + (w / 2))), int(round(y + (h / 2)))
+
+    dn.POINTER, dn.c_float, dn.IMAGE = ctypes.POINTER, ctypes.c_float, IMAGE
+    dn.load_network = load_network
+    dn.network_width = lambda network: network.width
+    dn.network_height = lambda network: network.height
+    dn.make_image = make_image
+    dn.free_image = lambda image: None
+    dn.network_predict_batch = network_predict_batch
+    dn.do_nms_sort = lambda detections, num, classes, nms: None
+    dn.remove_negatives = lambda detections, class_names, num: detections
+    dn.decode_detection = decode_detection
+    dn.free_batch_detections = lambda detections, batch_size: None
+    dn.bbox2points = bbox2points
+
+    return dn
+
+def stub_retinaface(faces=3, seed=0):
+    """
+    Function to build a module standing in for retinaface, detecting a fixed number of faces per frame.
+
+    Parameters:
+        faces: Number of faces detected per frame.
+        seed: Seed of the synthetic detections.
+    """
+    module = ModuleType("retinaface")
+    rng = np.random.default_rng(seed)
+
+    class RetinaFace:
+        @staticmethod
+        def detect_faces(img_path, threshold=0.9):
+            height, width = img_path.shape[:2]
+            result = {}
+            for i in range(faces):
+                size = int(rng.uniform(20, 120))
+                x1, y1 = int(rng.uniform(0, width - size)), int(rng.uniform(0, height - size))
+                result[f"face_{i + 1}"] = {'score': float(rng.uniform(threshold, 1)), 'facial_area': [x1, y1, x1 + size, y1 + size]}
+            return result
+
+    module.RetinaFace = RetinaFace
+    return module
+
+def install_stubs(vehicles=6, plates=24, faces=3):
+    """
+    Function to make the stub detectors importable in place of Darknet and RetinaFace.
+
+    Parameters:
+        vehicles, plates, faces: Number of vehicles per frame, candidate plates per vehicle and faces per frame.
+    """
+    darknet = ModuleType("darknet")
+    darknet.darknet = stub_darknet(vehicles, plates)
+    sys.modules["darknet"] = darknet
+    sys.modules["darknet.darknet"] = darknet.darknet
+    sys.modules["retinaface"] = stub_retinaface(faces)
+
+def measure(function, frames, repeat):
+    """
+    Function to measure the throughput and peak memory of a benchmark. The timed calls run without
+    tracemalloc, the memory is measured on one extra call.
+
+    Parameters:
+        function: Benchmark, processing a number of frames per call.
+        frames: Number of frames processed per call.
+        repeat: Number of timed calls.
+
+    Return:
+        Dictionary with frames per second and peak memory allocated during a call in MB.
+    """
+    function()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'fps': frames * repeat / elapsed, 'peak_mb': peak / 2 ** 20}
+
+def clustered_boxes(rng, vehicles, plates):
+    """
+    Function to generate candidate plate boxes for a frame, a cluster of overlapping boxes per vehicle.
+
+    Return:
+        List with an integer array of shape (plates, 4) for every vehicle.
+    """
+    result = []
+    for _ in range(vehicles):
+        centre = rng.uniform((100, 100), (1800, 1000))
+        points = centre + rng.normal(0, 4, (plates, 2))
+        size = rng.uniform((50, 15), (70, 25), (plates, 2))
+        result.append(np.hstack([points - size / 2, points + size / 2]).astype(int))
+    return result
+
+def bench_nms(args, rng):
+    from run import non_max_suppression_fast
+
+    frame_boxes = clustered_boxes(rng, args.vehicles, args.plates)
+
+    def function():
+        for boxes in frame_boxes:
+            non_max_suppression_fast(boxes, 0.3)
+
+    return measure(function, 1, args.repeat)
+
+def bench_batched_nms(args, rng):
+    from run import batched_nms
+
+    frame_boxes = clustered_boxes(rng, args.vehicles, args.plates)
+    boxes = np.vstack(frame_boxes)
+    groups = np.repeat(np.arange(args.vehicles), args.plates)
+    scores = rng.uniform(0, 1, len(boxes))
+
+    def function():
+        batched_nms(boxes, 0.3, groups=groups, scores=scores)
+
+    return measure(function, 1, args.repeat)
+
+def bench_tracker(args, rng):
+    from centroidtracker import CentroidTracker
+
+    start = clustered_boxes(rng, 1, args.vehicles)[0]
+    drift = rng.normal(0, 3, (args.frames, args.vehicles, 2)).cumsum(axis=0).astype(int)
+
+    def function():
+        tracker = CentroidTracker(maxDisappeared=20, maxDistance=90)
+        for step in drift:
+            tracker.update(start + np.hstack([step, step]))
+
+    return measure(function, args.frames, args.repeat)
+
+def bench_blur(args, rng):
+    from run import blur_image
+
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    blur = frame.copy()
+    sizes = rng.uniform(20, 200, (args.faces + args.vehicles, 2)).astype(int)
+    corners = rng.uniform(0, (args.width - 200, args.height - 200), (len(sizes), 2)).astype(int)
+
+    def function():
+        np.copyto(blur, frame)
+        for (x1, y1), (w, h) in zip(corners, sizes):
+            blur_image(blur, x1, y1, x1 + w, y1 + h)
+
+    return measure(function, 1, args.repeat)
+
+def bench_scaling(args, rng):
+    from detect import scaling, reset_crop
+
+    boxes = rng.uniform(0, 416, (args.vehicles, args.plates, 4))
+    crops = rng.uniform(0, 1000, (args.vehicles, 4))
+
+    def function():
+        for crop, vehicle_boxes in zip(crops, boxes):
+            for box in vehicle_boxes:
+                reset_crop(crop, scaling((120, 200), (416, 416), box))
+
+    return measure(function, 1, args.repeat)
+
+def bench_annotations(args, rng):
+    from run import save_annotation
+    from frame import Frame
+
+    frame = Frame("00000.png", np.zeros((1, 1, 3), dtype=np.uint8))
+    faces = {f"face_{i}": {'Confidence': 0.99, 'Bounding box': [1, 2, 3, 4]} for i in range(args.faces)}
+    plates = {i: {i: {'Confidence': 0.5, 'Bounding box': [[1, 2, 3, 4]]}} for i in range(args.vehicles)}
+
+    with tempfile.TemporaryDirectory() as folder:
+        def function():
+            for result in (faces, plates):
+                save_annotation(folder, frame, result)
+                with open(os.path.join(folder, "00000.json"), 'r') as f:
+                    json.loads(f.read())
+
+        return measure(function, 1, args.repeat)
+
+def bench_annotation_store(args, rng):
+    from annotationstore import AnnotationStore
+
+    faces = {f"face_{i}": {'Confidence': 0.99, 'Bounding box': [1, 2, 3, 4]} for i in range(args.faces)}
+    plates = {i: {i: {'Confidence': 0.5, 'Bounding box': [[1, 2, 3, 4]]}} for i in range(args.vehicles)}
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = AnnotationStore(os.path.join(folder, "cam"))
+
+        def function():
+            store.append("00000.png", faces, plates)
+            store.flush()
+            store.annotations("00000.png")
+
+        return measure(function, 1, args.repeat)
+
+def bench_faces(backend, scales):
+    def bench(args, rng):
+        from facedetect import detect_faces
+        from frame import Frame
+
+        frame = Frame("00000.png", rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+
+        #Warm-up run, which also tells whether the detector is available here
+        try:
+            detect_faces(frame, 0.5, backend, scales)
+        except (RuntimeError, cv2.error) as error:
+            print(f"Skipping the {backend} face detector : {error}")
+            return None
+
+        def function():
+            detect_faces(frame, 0.5, backend, scales)
+
+        return measure(function, 1, max(1, args.repeat // 10))
+
+    return bench
+
+def bench_encode(format, quality=None):
+    def bench(args, rng):
+        from imageoutput import ImageEncoder
+
+        encoder = ImageEncoder(format, quality)
+
+        #Smooth texture like the frames of make_dataset, noise would be the worst case of every encoder
+        texture = rng.integers(0, 256, (args.height // 8, args.width // 8, 3), dtype=np.uint8)
+        frame = cv2.resize(texture, (args.width, args.height), interpolation=cv2.INTER_LINEAR)
+
+        with tempfile.TemporaryDirectory() as root:
+            path = encoder.path(root, "00000")
+
+            def function():
+                encoder.save(path, frame)
+
+            return measure(function, 1, max(1, args.repeat // 10))
+
+    return bench
+
+def bench_run(video=False, pan=8, duplicate_tolerance=None, profile=False):
+    def bench(args, rng):
+        import run as pipeline
+        from run import run
+        from profiler import profiler
+
+        #Every timed run processes all the frames
+        pipeline.RESUME = False
+        pipeline.DUPLICATE_TOLERANCE = duplicate_tolerance
+
+        #Runs with --profile record the stages of windows skipping the detectors too
+        profiler.enabled = profile
+
+        with tempfile.TemporaryDirectory() as root:
+            frames = make_dataset(root, args.sequences, args.cameras, args.frames, args.width, args.height, video=video, pan=pan)
+
+            def function():
+                run(root, False)
+
+            try:
+                return measure(function, frames, 1)
+            finally:
+                profiler.enabled = False
+                profiler.samples(reset=True)
+
+    return bench
+
+BENCHMARKS = {
+    'non_max_suppression_fast': bench_nms,
+    'batched_nms': bench_batched_nms,
+    'CentroidTracker.update': bench_tracker,
+    'blur_image': bench_blur,
+    'scaling/reset_crop': bench_scaling,
+    'annotation I/O': bench_annotations,
+    'annotation store': bench_annotation_store,
+    'faces retinaface': bench_faces("retinaface", (1.0,)),
+    'faces retinaface x0.5': bench_faces("retinaface", (0.5,)),
+    'faces haar': bench_faces("haar", (1.0,)),
+    'faces haar x0.5': bench_faces("haar", (0.5,)),
+    'faces yunet': bench_faces("yunet", (1.0,)),
+    'faces yunet x0.5': bench_faces("yunet", (0.5,)),
+    'encode png': bench_encode("png"),
+    'encode png level 1': bench_encode("png", 1),
+    'encode jpg 90': bench_encode("jpg", 90),
+    'encode webp lossless': bench_encode("webp", "lossless"),
+    'run': bench_run(),
+    'run video': bench_run(video=True),
+    'run still': bench_run(pan=0),
+    'run still, duplicates': bench_run(pan=0, duplicate_tolerance=0.02),
+    'run still, duplicates, profiled': bench_run(pan=0, duplicate_tolerance=0.02, profile=True),
+}
+
+def compare(results, baseline, tolerance):
+    """
+    Function to print the results next to the baseline and find regressions.
+
+    Parameters:
+        results: Results of the benchmarks.
+        baseline: Stored results to compare against.
+        tolerance: Allowed relative drop in throughput and rise in peak memory.
+
+    Return:
+        List of names of the benchmarks that regressed.
+    """
+    regressions = []
+
+    print(f"{'benchmark':<32}{'fps':>12}{'baseline':>12}{'peak MB':>10}{'baseline':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<32}{result['fps']:>12.1f}{'-':>12}{result['peak_mb']:>10.1f}{'-':>10}")
+            continue
+
+        regressed = (result['fps'] < base['fps'] * (1 - tolerance) or
+                     result['peak_mb'] > base['peak_mb'] * (1 + tolerance) + 1)
+        if regressed:
+            regressions.append(name)
+
+        print(f"{name:<32}{result['fps']:>12.1f}{base['fps']:>12.1f}{result['peak_mb']:>10.1f}{base['peak_mb']:>10.1f}"
+              + ("  REGRESSION" if regressed else ""))
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the detection and blurring pipeline")
+    parser.add_argument("--real", help="Use the installed Darknet and RetinaFace instead of stub detectors", action="store_true")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run (default all)")
+    parser.add_argument("--repeat", type=int, default=50, help="Number of timed calls for the stage benchmarks")
+    parser.add_argument("--sequences", type=int, default=2, help="Sequences in the synthetic dataset")
+    parser.add_argument("--cameras", type=int, default=2, help="Cameras per sequence in the synthetic dataset")
+    parser.add_argument("--frames", type=int, default=16, help="Frames per camera in the synthetic dataset")
+    parser.add_argument("--width", type=int, default=1920, help="Width of the synthetic frames")
+    parser.add_argument("--height", type=int, default=1080, help="Height of the synthetic frames")
+    parser.add_argument("--vehicles", type=int, default=6, help="Vehicles per frame")
+    parser.add_argument("--plates", type=int, default=24, help="Candidate plates per vehicle")
+    parser.add_argument("--faces", type=int, default=3, help="Faces per frame")
+    parser.add_argument("--baseline", help="Baseline 'json' file to compare against, created by the first run and completed with the "
+                                           "benchmarks it doesn't have yet (default benchmark-baseline.json, benchmark-baseline-real.json with --real)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (default 0.2)")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline 'json' file, replacing it")
+
+    args = parser.parse_args()
+
+    if not args.real:
+        install_stubs(args.vehicles, args.plates, args.faces)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        result = BENCHMARKS[name](args, np.random.default_rng(0))
+        if result is not None:
+            results[name] = result
+
+    #Stub and real detectors have baselines of their own
+    path = args.baseline or ("benchmark-baseline-real.json" if args.real else "benchmark-baseline.json")
+
+    baseline = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            baseline = json.loads(f.read())
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    #Benchmarks run for the first time become part of the baseline
+    new = [name for name in results if name not in baseline]
+    if new:
+        with open(path, "w") as f:
+            f.write(json.dumps({**baseline, **{name: results[name] for name in new}}, indent=4))
+        print(f"Baseline of {', '.join(new)} saved to {path}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(json.dumps(results, indent=4))
+
+    if regressions:
+        print(f"Regressions found in : {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,112 @@
+"""
+This file contains the blurring of the license plates filled by the postprocessing in tracking.py, which weren't
+detected when the frames were blurred. Only the plates filled by the latest postprocessing are blurred, the blurred
+frames are saved again and recorded in the run manifest.
+"""
+
+import os
+import cv2
+from regionblur import blur_regions
+from tracking import load_annotations, frame_sources
+from manifest import update_camera
+from video import is_video, video_info, read_video, VideoOutput, VIDEO_CODEC
+from imageoutput import ImageEncoder
+
+def filled_boxes(plates):
+    """
+    Function to get the bounding boxes of the filled license plates of a frame, annotated with a confidence of -1.
+
+    Parameters:
+        plates: License plate annotations of the frame.
+    """
+    return [box for objects in plates.values() for detection in objects.values() if detection['Confidence'] == -1
+            for box in detection['Bounding box']]
+
+def blur_video(path, boxes, method="box", radius=20, codec=VIDEO_CODEC):
+    """
+    Function to blur regions of some frames of a blurred video, which is encoded again.
+
+    Parameters:
+        path: Location of the video.
+        boxes: Dictionary of the bounding boxes to be blurred in each frame, by frame index.
+        method, radius: Blur method and strength, see regionblur.
+        codec: FourCC code of the video.
+
+    Return:
+        Path, size and checksum of the video file.
+    """
+    output = VideoOutput(path, video_info(path)[0], codec)
+    for index, frame in enumerate(read_video(path)):
+        image = frame.bgr
+        if index in boxes:
+            image = blur_regions(image, boxes[index], method, radius)
+        output.write(image)
+    return output.close()
+
+def blurring(dataset, method="box", radius=20, codec=VIDEO_CODEC, encoder=None, filled=None):
+    """
+    Function to blur the filled license plates in the blurred frames and videos of a dataset.
+
+    Parameters:
+        dataset: Directory of the dataset.
+        method, radius: Blur method and strength, see regionblur.
+        codec: FourCC code of the blurred videos.
+        encoder: ImageEncoder the blurred frames were saved with, PNG with OpenCV's default compression if it
+                 isn't given.
+        filled: Plates filled by tracking.finding_missing_detections, the only ones blurred. Every plate annotated
+                with a confidence of -1 is blurred if it isn't given.
+    """
+    encoder = encoder or ImageEncoder()
+    root = os.path.join(os.getcwd(), dataset)
+
+    for dir in sorted(os.listdir(root)):
+        currdir = os.path.join(root, dir)
+        camera = os.path.join(currdir, "camera")
+        if not os.path.isdir(camera):
+            continue
+
+        for cam in sorted(os.listdir(camera)):
+            if not (os.path.isfile(os.path.join(currdir, "annotations", f"{cam}.frames")) or
+                    os.path.isdir(os.path.join(currdir, "annotations", "license-plates", cam))):
+                continue
+
+            if filled is not None:
+                if (currdir, cam) not in filled:
+                    continue
+                camera_boxes = filled[(currdir, cam)]
+            else:
+                _, names, plates = load_annotations(currdir, cam)
+                camera_boxes = {name: filled_boxes(frame_plates) for name, frame_plates in zip(names, plates)}
+
+            blur_folder_path = os.path.join(currdir, "privacy", cam)
+            source = frame_sources(currdir, cam)
+
+            #Blurred video, frames are named after their index. It is encoded again only if plates were filled
+            if is_video(blur_folder_path):
+                boxes = {int(os.path.splitext(name)[0]): frame_boxes for name, frame_boxes in camera_boxes.items() if frame_boxes}
+                if boxes:
+                    written = blur_video(blur_folder_path, boxes, method, radius, codec)
+                    if written is not None:
+                        update_camera(currdir, cam, {source(cam): [written]})
+
+                print(f"Filled license plates of {cam} of {dir} have been blurred")
+                continue
+
+            outputs = {}
+            for name, boxes in camera_boxes.items():
+                if not boxes:
+                    continue
+
+                #Same path as the blurred frame saved by run.py
+                path = encoder.path(blur_folder_path, os.path.splitext(name)[0])
+                image = cv2.imread(path)
+                if image is None:
+                    continue
+
+                #The image may be a hard link to the source frame, it is replaced instead of being written through
+                outputs[source(name)] = [encoder.save(path, blur_regions(image, boxes, method, radius))]
+
+            #Blurred frames saved again are up to date
+            update_camera(currdir, cam, outputs)
+
+            print(f"Filled license plates of {cam} of {dir} have been blurred")
@@ -1,20 +1,52 @@
 # import the necessary packages
 from scipy.spatial import distance as dist
+from scipy.optimize import linear_sum_assignment
 from collections import OrderedDict
 import numpy as np
 
+# costs used for matching objects to input rectangles
+COSTS = ("centroid", "iou")
 
-class CentroidTracker:
-    def __init__(self, maxDisappeared=50, maxDistance=50):
-        # initialize the next unique object ID along with two ordered
-        # dictionaries used to keep track of mapping a given object
-        # ID to its centroid and number of consecutive frames it has
-        # been marked as "disappeared", respectively
+# cost of a pair which must not be matched, larger than any
+# allowed cost so that the assignment matches as many allowed
+# pairs as possible
+FORBIDDEN = 1e9
+
+
+class TrackStream:
+    def __init__(self):
+        # state of the objects tracked in a stream (e.g. a camera),
+        # one row per object: its ID, centroid, bounding box and
+        # number of consecutive frames it has been marked as
+        # "disappeared"
         self.nextObjectID = 0
-        self.objects = OrderedDict()
-        self.disappeared = OrderedDict()
-        self.bbox = OrderedDict()  # CHANGE
+        self.ids = np.zeros(0, dtype=int)
+        self.centroids = np.zeros((0, 2), dtype=int)
+        self.bbox = np.zeros((0, 4), dtype=int)
+        self.disappeared = np.zeros(0, dtype=int)
+
+    def keep(self, mask):
+        # keep the objects selected by a boolean mask
+        self.ids = self.ids[mask]
+        self.centroids = self.centroids[mask]
+        self.bbox = self.bbox[mask]
+        self.disappeared = self.disappeared[mask]
+
+    def register(self, centroids, rects):
+        # register new objects with the next available object IDs
+        ids = self.nextObjectID + np.arange(len(rects))
+        self.nextObjectID += len(rects)
 
+        self.ids = np.concatenate([self.ids, ids])
+        self.centroids = np.concatenate([self.centroids, centroids])
+        self.bbox = np.concatenate([self.bbox, rects])
+        self.disappeared = np.concatenate([self.disappeared, np.zeros(len(rects), dtype=int)])
+
+        return ids
+
+
+class CentroidTracker:
+    def __init__(self, maxDisappeared=50, maxDistance=50, cost="centroid", minIoU=0.1):
         # store the number of maximum consecutive frames a given
         # object is allowed to be marked as "disappeared" until we
         # need to deregister the object from tracking
@@ -25,147 +57,127 @@ class CentroidTracker:
         # distance we'll start to mark the object as "disappeared"
         self.maxDistance = maxDistance
 
-    def register(self, centroid, inputRect):
-        # when registering an object we use the next available object
-        # ID to store the centroid
-        self.objects[self.nextObjectID] = centroid
-        self.bbox[self.nextObjectID] = inputRect  # CHANGE
-        self.disappeared[self.nextObjectID] = 0
-        self.nextObjectID += 1
-
-    def deregister(self, objectID):
-        # to deregister an object ID we delete the object ID from
-        # both of our respective dictionaries
-        del self.objects[objectID]
-        del self.disappeared[objectID]
-        del self.bbox[objectID]  # CHANGE
-
-    def update(self, rects):
-        # check to see if the list of input bounding box rectangles
-        # is empty
-        if len(rects) == 0:
-            # loop over any existing tracked objects and mark them
-            # as disappeared
-            for objectID in list(self.disappeared.keys()):
-                self.disappeared[objectID] += 1
-
-                # if we have reached a maximum number of consecutive
-                # frames where a given object has been marked as
-                # missing, deregister it
-                if self.disappeared[objectID] > self.maxDisappeared:
-                    self.deregister(objectID)
-
-            # return early as there are no centroids or tracking info
-            # to update
-            # return self.objects
-            return self.bbox
-
-        # initialize an array of input centroids for the current frame
-        inputCentroids = np.zeros((len(rects), 2), dtype="int")
-        inputRects = []
-        # loop over the bounding box rectangles
-        for (i, (startX, startY, endX, endY)) in enumerate(rects):
-            # use the bounding box coordinates to derive the centroid
-            cX = int((startX + endX) / 2.0)
-            cY = int((startY + endY) / 2.0)
-            inputCentroids[i] = (cX, cY)
-            inputRects.append(rects[i])  # CHANGE
-
-        # if we are currently not tracking any objects take the input
-        # centroids and register each of them
-        if len(self.objects) == 0:
-            for i in range(0, len(inputCentroids)):
-                self.register(inputCentroids[i], inputRects[i])  # CHANGE
-
-        # otherwise, are are currently tracking objects so we need to
-        # try to match the input centroids to existing object
-        # centroids
-        else:
-            # grab the set of object IDs and corresponding centroids
-            objectIDs = list(self.objects.keys())
-            objectCentroids = list(self.objects.values())
-
-            # compute the distance between each pair of object
-            # centroids and input centroids, respectively -- our
-            # goal will be to match an input centroid to an existing
-            # object centroid
-            D = dist.cdist(np.array(objectCentroids), inputCentroids)
-
-            # in order to perform this matching we must (1) find the
-            # smallest value in each row and then (2) sort the row
-            # indexes based on their minimum values so that the row
-            # with the smallest value as at the *front* of the index
-            # list
-            rows = D.min(axis=1).argsort()
-
-            # next, we perform a similar process on the columns by
-            # finding the smallest value in each column and then
-            # sorting using the previously computed row index list
-            cols = D.argmin(axis=1)[rows]
-
-            # in order to determine if we need to update, register,
-            # or deregister an object we need to keep track of which
-            # of the rows and column indexes we have already examined
-            usedRows = set()
-            usedCols = set()
-
-            # loop over the combination of the (row, column) index
-            # tuples
-            for (row, col) in zip(rows, cols):
-                # if we have already examined either the row or
-                # column value before, ignore it
-                if row in usedRows or col in usedCols:
-                    continue
-
-                # if the distance between centroids is greater than
-                # the maximum distance, do not associate the two
-                # centroids to the same object
-                if D[row, col] > self.maxDistance:
-                    continue
-
-                # otherwise, grab the object ID for the current row,
-                # set its new centroid, and reset the disappeared
-                # counter
-                objectID = objectIDs[row]
-                self.objects[objectID] = inputCentroids[col]
-                self.bbox[objectID] = inputRects[col]  # CHANGE
-                self.disappeared[objectID] = 0
-
-                # indicate that we have examined each of the row and
-                # column indexes, respectively
-                usedRows.add(row)
-                usedCols.add(col)
-
-            # compute both the row and column index we have NOT yet
-            # examined
-            unusedRows = set(range(0, D.shape[0])).difference(usedRows)
-            unusedCols = set(range(0, D.shape[1])).difference(usedCols)
-
-            # in the event that the number of object centroids is
-            # equal or greater than the number of input centroids
-            # we need to check and see if some of these objects have
-            # potentially disappeared
-            if D.shape[0] >= D.shape[1]:
-                # loop over the unused row indexes
-                for row in unusedRows:
-                    # grab the object ID for the corresponding row
-                    # index and increment the disappeared counter
-                    objectID = objectIDs[row]
-                    self.disappeared[objectID] += 1
-
-                    # check to see if the number of consecutive
-                    # frames the object has been marked "disappeared"
-                    # for warrants deregistering the object
-                    if self.disappeared[objectID] > self.maxDisappeared:
-                        self.deregister(objectID)
-
-            # otherwise, if the number of input centroids is greater
-            # than the number of existing object centroids we need to
-            # register each new input centroid as a trackable object
-            else:
-                for col in unusedCols:
-                    self.register(inputCentroids[col], inputRects[col])
-
-        # return the set of trackable objects
-        # return self.objects
-        return self.bbox
+        # objects are matched by the distance between centroids
+        # ("centroid") or by the overlap of the bounding boxes
+        # ("iou"), in which case they must overlap at least minIoU
+        if cost not in COSTS:
+            raise ValueError(f"Unknown cost {cost}, expected one of {', '.join(COSTS)}.")
+        self.cost = cost
+        self.minIoU = minIoU
+
+        # every stream (e.g. camera) is tracked independently
+        self.streams = {}
+
+    def stream(self, stream=None):
+        # state of a stream, created on its first frame
+        if stream not in self.streams:
+            self.streams[stream] = TrackStream()
+        return self.streams[stream]
+
+    def state(self, stream=None):
+        # return the state of a stream as plain lists, so that it
+        # can be saved and tracking can be resumed later on
+        s = self.stream(stream)
+        return {
+            "nextObjectID": s.nextObjectID,
+            "ids": s.ids.tolist(),
+            "centroids": s.centroids.tolist(),
+            "bbox": s.bbox.tolist(),
+            "disappeared": s.disappeared.tolist(),
+        }
+
+    def restore(self, state, stream=None):
+        # resume tracking a stream from a state returned by state()
+        s = self.stream(stream)
+        s.nextObjectID = state["nextObjectID"]
+        s.ids = np.array(state["ids"], dtype=int)
+        s.centroids = np.array(state["centroids"], dtype=int).reshape(-1, 2)
+        s.bbox = np.array(state["bbox"], dtype=int).reshape(-1, 4)
+        s.disappeared = np.array(state["disappeared"], dtype=int)
+
+    def states(self):
+        # return the state of every stream, keyed by stream name
+        # ("" for the default stream) so that it can be saved as
+        # JSON
+        return {("" if stream is None else stream): self.state(stream)
+                for stream in self.streams}
+
+    def restore_states(self, states):
+        # resume tracking every stream from the states returned by
+        # states(), a single state (saved before every stream was
+        # saved) is the state of the default stream
+        if "nextObjectID" in states:
+            states = {"": states}
+
+        for stream, state in states.items():
+            self.restore(state, None if stream == "" else stream)
+
+    def costs(self, s, rects, centroids):
+        # cost of matching every object (rows) to every input
+        # rectangle (columns), pairs which are too far apart are
+        # forbidden
+        if self.cost == "centroid":
+            D = dist.cdist(s.centroids, centroids)
+            D[D > self.maxDistance] = FORBIDDEN
+            return D
+
+        x1 = np.maximum(s.bbox[:, None, 0], rects[None, :, 0])
+        y1 = np.maximum(s.bbox[:, None, 1], rects[None, :, 1])
+        x2 = np.minimum(s.bbox[:, None, 2], rects[None, :, 2])
+        y2 = np.minimum(s.bbox[:, None, 3], rects[None, :, 3])
+        inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+
+        area = lambda b: (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        union = area(s.bbox)[:, None] + area(rects)[None, :] - inter
+        iou = inter / np.maximum(union, 1)
+
+        D = 1 - iou
+        D[iou < self.minIoU] = FORBIDDEN
+        return D
+
+    def track(self, rects, stream=None):
+        # update a stream with all the input bounding box
+        # rectangles of a frame at once, and return the object ID
+        # of every rectangle
+        s = self.stream(stream)
+        rects = np.asarray(rects, dtype=float).reshape(-1, 4).astype(int)
+
+        # use the bounding box coordinates to derive the centroids
+        centroids = ((rects[:, :2] + rects[:, 2:]) / 2.0).astype(int)
+
+        ids = np.full(len(rects), -1, dtype=int)
+        s.disappeared += 1
+
+        if len(s.ids) and len(rects):
+            # optimal one to one assignment of the objects to the
+            # input rectangles, minimising the total cost
+            D = self.costs(s, rects, centroids)
+            rows, cols = linear_sum_assignment(D)
+            matched = D[rows, cols] < FORBIDDEN
+            rows, cols = rows[matched], cols[matched]
+
+            # set the new centroids and bounding boxes of the
+            # matched objects, and reset their disappeared counters
+            ids[cols] = s.ids[rows]
+            s.centroids[rows] = centroids[cols]
+            s.bbox[rows] = rects[cols]
+            s.disappeared[rows] = 0
+
+        # deregister the objects which have been missing for too
+        # many consecutive frames
+        s.keep(s.disappeared <= self.maxDisappeared)
+
+        # register every unmatched input rectangle as a new object
+        new = ids < 0
+        ids[new] = s.register(centroids[new], rects[new])
+
+        return ids
+
+    def update(self, rects, stream=None):
+        # update a stream with the input bounding box rectangles of
+        # a frame, and return the bounding boxes of all the objects
+        # tracked in it
+        self.track(rects, stream)
+
+        s = self.stream(stream)
+        return OrderedDict(zip(s.ids.tolist(), s.bbox))
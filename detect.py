@@ -3,11 +3,13 @@ This file contains the code for the functions for vehicle and license plate dete
 utility functions which are needed for doing related tasks like scaling, cropping and saving bounding box dimensions.
 """
 
-import darknet.darknet as dn # importing darknet wrapper for python
 import cv2
-import os
 import numpy as np
-import shutil
+import threading
+from frame import Frame
+from imagepool import ImagePool
+from profiler import profiler
+from detectioncache import detection_cache, file_digest
 
 # loading necessary files for vehicle detecting network
 VEHICLE_DETECTOR_CFG = "data/vehicle-detection.cfg"
@@ -23,66 +25,193 @@ LP_DETECTOR_NAMES = "data/lp-detection-layout-classification.names"
 LP_DETECTOR_WEIGHTS = "data/lp-detection-layout-classification.weights"
 LP_THRESHOLD = 0.01
 
-# Loading vehicle and lp detector network
-vehicle_network, vehicle_class_names, class_colors = dn.load_network(VEHICLE_DETECTOR_CFG, VEHICLE_DETECTOR_DATA, VEHICLE_DETECTOR_WEIGHTS)
-vehicle_width, vehicle_height = dn.network_width(vehicle_network), dn.network_height(vehicle_network)
-vehicle_network_shape = (vehicle_height, vehicle_width)
+# number of images the networks process in a single forward pass, frames for the vehicle network
+# and vehicle crops for the lp network
+VEHICLE_BATCH_SIZE = 4
+LP_BATCH_SIZE = 16
 
-lp_network, lp_class_names, class_colors = dn.load_network(LP_DETECTOR_CFG, LP_DETECTOR_DATA, LP_DETECTOR_WEIGHTS)
-lp_width, lp_height = dn.network_width(lp_network), dn.network_height(lp_network)
-lp_network_shape = (lp_height, lp_width)
+# Darknet wrapper, networks and pool of Darknet images, loaded once per process by load_models, on the first
+# detection which isn't in the detection cache. Importing this file stays cheap for tools which never run inference.
+dn = None
+networks = {}
+image_pool = None
+_load_lock = threading.Lock()
 
-def prepare_image(network, image_path):
+def load_models():
     """
-    This function converts image from OpenCV format to Darknet format. It rescales the image and takes
-    its byte copy which is required by Darknet for prediction.
+    Function to load the Darknet wrapper and the vehicle and lp detecting networks, if this process hasn't loaded
+    them yet. Darknet images used as network inputs are reused instead of being allocated for every batch.
+
+    Return:
+        Dictionary with, for 'vehicle' and 'lp', the network, its class names and its batch size.
+    """
+    global dn, image_pool
+
+    with _load_lock:
+        if not networks:
+            import darknet.darknet as darknet # importing darknet wrapper for python
+            dn = darknet
+
+            vehicle_network, vehicle_class_names, _ = dn.load_network(VEHICLE_DETECTOR_CFG, VEHICLE_DETECTOR_DATA, VEHICLE_DETECTOR_WEIGHTS, batch_size=VEHICLE_BATCH_SIZE)
+            lp_network, lp_class_names, _ = dn.load_network(LP_DETECTOR_CFG, LP_DETECTOR_DATA, LP_DETECTOR_WEIGHTS, batch_size=LP_BATCH_SIZE)
+            image_pool = ImagePool(dn.make_image, dn.free_image)
+
+            networks['vehicle'] = (vehicle_network, vehicle_class_names, VEHICLE_BATCH_SIZE)
+            networks['lp'] = (lp_network, lp_class_names, LP_BATCH_SIZE)
+
+    return networks
+
+def warm_up():
+    """
+    Function to load the networks and run a blank batch through each of them, so that the first frames of a
+    process (e.g. a worker) don't pay for the loading and the first allocations of the networks.
+    """
+    for network, class_names, batch_size in load_models().values():
+        detect_batch_images(network, class_names, [], 1, batch_size)
+
+def change_vehicle_threshold(threshold):
+    """
+    Function to change the detection threshold of the vehicle detecting network.
+
+    Parameters:
+        threshold: New threshold.
+    """
+    global VEHICLE_DETECTOR_THRESHOLD
+    VEHICLE_DETECTOR_THRESHOLD = threshold
+
+def change_lp_threshold(threshold):
+    """
+    Function to change the detection threshold of the lp detecting network.
+
+    Parameters:
+        threshold: New threshold.
+    """
+    global LP_THRESHOLD
+    LP_THRESHOLD = threshold
+
+def prepare_image(network, images, batch_size=1):
+    """
+    This function converts images from OpenCV format to Darknet format. It rescales the images and packs
+    them in a single Darknet image, one after the other, which is required by Darknet for batch prediction.
+    Unused slots of the batch are left blank. The Darknet image comes from image_pool and has to be released
+    once the prediction is done.
 
     Parameters:
         network: Loaded network object, the rescaling size is obtained from here.
-        image_path: Path of the image to be converted.
+        images: List of Frame objects, or crops of a frame in OpenCV's BGR format.
+        batch_size: Batch size of the network.
+
+    Return:
+        Darknet image of the batch and list of original resolutions of the images.
     """
     width = dn.network_width(network)
     height = dn.network_height(network)
-    darknet_image = dn.make_image(width, height, 3)
+    darknet_image = image_pool.acquire(width, height, 3 * batch_size)
+    batch = np.ctypeslib.as_array(darknet_image.data, shape=(batch_size, 3, height, width))
+    batch[len(images):] = 0
 
-    image = cv2.imread(image_path)
-    image_shape = image.shape[:2]
+    image_shapes = []
+    for i, image in enumerate(images):
+        if isinstance(image, Frame):
+            image_shapes.append(image.shape)
+            image_resized = image.resized(width, height)
+        else:
+            image_shapes.append(image.shape[:2])
 
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    image_resized = cv2.resize(image_rgb, (width, height),
-                               interpolation=cv2.INTER_LINEAR)
+            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            image_resized = cv2.resize(image_rgb, (width, height),
+                                       interpolation=cv2.INTER_LINEAR)
 
-    dn.copy_image_from_bytes(darknet_image, image_resized.tobytes())
+        # Darknet expects planar RGB scaled to [0, 1]
+        np.divide(image_resized.transpose(2, 0, 1), 255.0, out=batch[i])
 
-    return darknet_image, image_shape
+    return darknet_image, image_shapes
 
-def save_image(image_path, save_path, image_name, box= None):
+def detect_batch(model, images, thresh, hier_thresh=.5, nms=.45):
     """
-    Function to save image from a location to a given location after cropping, if bounding box coordinates
-    are provided.
+    Function to run a network on a list of images, a batch at a time. The last batch is padded with blank
+    images if there aren't enough images to fill it.
 
     Parameters:
-        image_path: Location of image to be saved.
-        save_path: Location where image has to be saved, if it doesn't exist, it will be created.
-        image_name: Name of the image file.
-        box: Bounding box coordinates.
+        model: Name of the network, 'vehicle' or 'lp'.
+        images: List of Frame objects, or crops of a frame in OpenCV's BGR format.
+        thresh: Detection threshold.
+
+    Return:
+        List of detections for every image, in the same order as the images. Each detection is a tuple of
+        label, confidence and bounding box rescaled to the image's original resolution.
+    """
+    if not images:
+        return []
+
+    network, class_names, batch_size = load_models()[model]
+    return detect_batch_images(network, class_names, images, thresh, batch_size, hier_thresh, nms)
+
+def detect_batch_images(network, class_names, images, thresh, batch_size, hier_thresh=.5, nms=.45):
     """
-    if box:
-        for point in box:
-            if point < 0:
-                return False
+    Function to run a loaded network on a list of images, see detect_batch. An empty list of images still runs
+    a single blank batch.
+
+    Parameters:
+        network: Loaded network object.
+        class_names: Class names of the network.
+        images, thresh: See detect_batch.
+        batch_size: Batch size the network was loaded with.
+    """
+    width = dn.network_width(network)
+    height = dn.network_height(network)
+
+    results = []
+    for start in range(0, max(len(images), 1), batch_size):
+        batch_images = images[start:start + batch_size]
+        darknet_image, image_shapes = prepare_image(network, batch_images, batch_size)
 
-    if save_path:
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+        try:
+            batch_detections = dn.network_predict_batch(network, darknet_image, batch_size, width, height,
+                                                        thresh, hier_thresh, None, 0, 0)
+        finally:
+            image_pool.release(darknet_image)
 
-        image = cv2.imread(image_path)
-        box = [int(item) for item in box]
-        image = image[box[1]: box[3], box[0]: box[2]]
+        for i in range(len(batch_images)):
+            num = batch_detections[i].num
+            detections = batch_detections[i].dets
+            if nms:
+                dn.do_nms_sort(detections, num, len(class_names), nms)
 
-        cv2.imwrite(os.path.join(save_path, image_name), image)
+            predictions = dn.decode_detection(dn.remove_negatives(detections, class_names, num))
+            predictions = sorted(predictions, key=lambda x: x[1])
 
-        return True
+            results.append([(label, confidence, scaling(image_shapes[i], (height, width), dn.bbox2points(bbox)))
+                            for label, confidence, bbox in predictions])
+
+        dn.free_batch_detections(batch_detections, batch_size)
+
+    return results
+
+def crop_image(image, box):
+    """
+    Function to crop an image as per the given bounding box. The crop is a NumPy view of the image,
+    so no pixels are copied and nothing is written to disk.
+
+    Parameters:
+        image: Image in OpenCV format.
+        box: Bounding box coordinates.
+
+    Return:
+        If the bounding box lies partly outside the image or is empty, NoneType object is returned.
+        Else, view of the cropped region.
+    """
+    for point in box:
+        if point < 0:
+            return None
+
+    box = [int(item) for item in box]
+    crop = image[box[1]: box[3], box[0]: box[2]]
+
+    if crop.size == 0:
+        return None
+
+    return crop
 
 def scaling(image_shape, network_shape, box):
     """
@@ -120,113 +249,220 @@ def reset_crop(crop_location, bounding_box):
 
     return bounding_box
 
-def vehicle_detector(image_path, annot_path):
+def cached_detect_batch(model, images, thresh, keys):
     """
-    Function to detect vehicles in an image.
+    Function to run detect_batch only on the images whose detections aren't in detection_cache already, and
+    cache the new detections. The networks aren't loaded as long as every detection is in the cache.
 
     Parameters:
-        image_path: Path of image to be used for detection.
+        model, images, thresh: See detect_batch.
+        keys: Cache key of every image, NoneType object if the cache is disabled.
 
     Return:
-        If no vehicles are detected, NoneType object is returned.
-        Else, list of locations of cropped images of detected vehicles, name of annotation file,
-        rescaled bounding boxes and save path for annotation file.
+        List of detections for every image, see detect_batch.
     """
-    image, image_shape = prepare_image(vehicle_network, image_path)
-    detections = dn.detect_image(vehicle_network, vehicle_class_names, image, thresh=VEHICLE_DETECTOR_THRESHOLD)
+    if keys is None:
+        return detect_batch(model, images, thresh)
+
+    results = [detection_cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
 
-    image_name = image_path.split('\\')[-1]
-    save_path = os.path.splitext(image_path)[0]
-    result_name = os.path.splitext(image_name)[0] + ".json"
+    if missing:
+        detections = detect_batch(model, [images[i] for i in missing], thresh)
+        for i, result in zip(missing, detections):
+            detection_cache.put(keys[i], result)
+            results[i] = result
+
+    return results
+
+def model_digest(cfg, weights):
+    """
+    Function to get the hash of a network's configuration and weights, for building cache keys.
+    """
+    return file_digest(cfg) + file_digest(weights)
 
-    if not os.path.exists(annot_path):
-        os.makedirs(annot_path)
+def vehicle_detector(frames):
+    """
+    Function to detect vehicles in a list of frames.
 
-    filename = os.path.join(annot_path, result_name)
+    Parameters:
+        frames: List of Frame objects to be used for detection.
 
-    with open(filename, mode="w", encoding="utf-8") as f:
-        pass
+    Return:
+        List with, for every frame, list of cropped images (views of the frame) of detected vehicles and
+        list of rescaled bounding boxes of the crops.
+    """
+    keys = None
+    if detection_cache.enabled:
+        model = model_digest(VEHICLE_DETECTOR_CFG, VEHICLE_DETECTOR_WEIGHTS)
+        keys = [detection_cache.key("vehicle", frame.digest, model, VEHICLE_DETECTOR_THRESHOLD) for frame in frames]
 
-    if(len(detections)):
-        bounding_boxes = [dn.bbox2points(item[2]) for item in detections]
+    batch_detections = cached_detect_batch("vehicle", frames, VEHICLE_DETECTOR_THRESHOLD, keys)
 
-        scaled_bounding_boxes = [scaling(image_shape, vehicle_network_shape, box) for box in bounding_boxes]
-        
+    results = []
+    for frame, detections in zip(frames, batch_detections):
         vehicles = []
+        crop_locations = []
 
-        for i in range(len(scaled_bounding_boxes)):
-            vehicle_name = image_name + "_" + str(i) +".png"
-            if save_image(image_path, save_path=save_path, image_name=vehicle_name, box = scaled_bounding_boxes[i]):
-                vehicles.append(os.path.join(save_path, vehicle_name))
-        
-        return vehicles, result_name, scaled_bounding_boxes, save_path
-    
-    else:
-        return None
+        for _, _, box in detections:
+            vehicle = crop_image(frame.bgr, box)
+            if vehicle is not None:
+                vehicles.append(vehicle)
+                crop_locations.append(box)
 
-def lp_detector(vehicles, result_name, crop_locations, save_path, annot_path):
+        results.append((vehicles, crop_locations))
+
+    return results
+
+def lp_detector(vehicles, crop_locations, digests=None):
     """
-    Function to detect license plates in detected vehicles' cropped images.
+    Function to detect license plates in detected vehicles' cropped images. The crops of all the frames
+    are sent to the network together.
 
     Parameters:
-        vehicles: List of locations where cropped images of vehicles are saved.
-        result_name: File name of annotation file.
-        crop_locations: Bounding box of vehicles, from where their cropped images are obtained.
-        save_path: Path where cropped images are saved.
-        annot_path: Path where annotation file will be saved.
+        vehicles: List with, for every frame, list of cropped images of vehicles.
+        crop_locations: List with, for every frame, bounding box of vehicles, from where their cropped images are obtained.
+        digests: List with the hash of every frame, for caching the detections.
 
     Return:
-        If, no license plates are detected, empty list is returned
-        Else, list of bounding box on original images of license plates.
+        List with, for every frame, dictionary of bounding box on original images of license plates for each
+        vehicle. The dictionary is empty if no license plates are detected.
     """
+    # (frame index, vehicle index) of every crop
+    index = [(i, j) for i in range(len(vehicles)) for j in range(len(vehicles[i]))]
+    crops = [vehicles[i][j] for i, j in index]
+
+    keys = None
+    if detection_cache.enabled and digests is not None:
+        model = model_digest(LP_DETECTOR_CFG, LP_DETECTOR_WEIGHTS)
+        keys = [detection_cache.key("plate", digests[i], crop_locations[i][j], model, LP_THRESHOLD) for i, j in index]
+
+    batch_detections = cached_detect_batch("lp", crops, LP_THRESHOLD, keys)
+
+    results = [{} for _ in vehicles]
+    for (i, j), lp_detections in zip(index, batch_detections):
+        if(len(lp_detections)):
+            vehicle = {}
+            for k, (_, confidence, box) in enumerate(lp_detections):
+                lp = {
+                'confidence': confidence,
+                'bounding box': reset_crop(crop_locations[i][j], box),
+                }
+
+                vehicle[k] = lp
 
-    filename = os.path.join(annot_path, result_name)
+            results[i][j] = vehicle
 
-    if(len(vehicles)):
-        result = {}
+    return results
 
-        for i in range(len(vehicles)):
-            lp_image, lp_image_shape = prepare_image(lp_network, vehicles[i])
-            lp_detections = dn.detect_image(lp_network, lp_class_names, lp_image, thresh=LP_THRESHOLD)
+def detect_frames(frames):
+    """
+    Wrapper function for end-to-end detection of license plates in a list of frames. The vehicle crops are
+    views of the frames and are passed to the license plate network in memory.
 
-            if(len(lp_detections)):
-                bounding_boxes = [dn.bbox2points(item[2]) for item in lp_detections]
+    Parameters:
+        frames: List of Frame objects for detection.
 
-                scaled_bounding_boxes = [scaling(lp_image_shape, lp_network_shape, box) for box in bounding_boxes]
+    Return:
+        List with, for every frame, empty list if no vehicles are found, else dictionary of bounding box on
+        original images of license plates for each vehicle.
+    """
+    if not frames:
+        return []
 
-                original_bounding_boxes = [reset_crop(crop_locations[i], box) for box in scaled_bounding_boxes]
+    with profiler.stage("vehicle detection", frames=len(frames)):
+        detections = vehicle_detector(frames)
 
-                vehicle = {}
-                for j in range(len(lp_detections)):
-                    lp = {
-                    'confidence': lp_detections[j][1],
-                    'bounding box': original_bounding_boxes[j],
-                    }  
+    vehicles = [item[0] for item in detections]
+    crop_locations = [item[1] for item in detections]
 
-                    vehicle[j] = lp
-                    
-                result[i] = vehicle            
-            else:
-                original_bounding_boxes = None
-        
-        shutil.rmtree(save_path)
+    with profiler.stage("plate detection", frames=len(frames)):
+        plates = lp_detector(vehicles, crop_locations, [frame.digest for frame in frames] if detection_cache.enabled else None)
 
-        return result
+    return [result if len(vehicles[i]) else [] for i, result in enumerate(plates)]
 
-def detect(image_path, annot_path):
+def detect_candidates(frames, vehicle_threshold, lp_threshold):
     """
-    Wrapper function for end-to-end detection of license plates.
+    Function to detect every vehicle and license plate scoring above the given thresholds in a list of frames,
+    along with their confidences. Candidates detected at the lowest thresholds of a threshold sweep hold the
+    detections of every higher threshold, see select_detections.
 
     Parameters:
-        image_path: Location of image for detection.
-        annot_path: Path for saving bounding box annotation.
+        frames: List of Frame objects for detection.
+        vehicle_threshold, lp_threshold: Lowest thresholds of the sweep.
 
     Return:
-        If no vehicles are found, empty list is returned.
-        Else, list of bounding box on original images of license plates.
+        List with, for every frame, list of (confidence, bounding box, plates) of the vehicles, plates being the
+        list of (confidence, bounding box on the original image) of the license plates of the vehicle.
     """
-    if vehicle_detector(image_path, annot_path) is None:
+    keys = None
+    if detection_cache.enabled:
+        model = model_digest(VEHICLE_DETECTOR_CFG, VEHICLE_DETECTOR_WEIGHTS)
+        keys = [detection_cache.key("vehicle", frame.digest, model, vehicle_threshold) for frame in frames]
+
+    with profiler.stage("vehicle detection", frames=len(frames)):
+        batch_detections = cached_detect_batch("vehicle", frames, vehicle_threshold, keys)
+
+    vehicles = [[] for _ in frames]
+    for i, (frame, detections) in enumerate(zip(frames, batch_detections)):
+        for _, confidence, box in detections:
+            if crop_image(frame.bgr, box) is not None:
+                vehicles[i].append((confidence, box))
+
+    # (frame index, vehicle index) of every crop
+    index = [(i, j) for i in range(len(frames)) for j in range(len(vehicles[i]))]
+    crops = [crop_image(frames[i].bgr, vehicles[i][j][1]) for i, j in index]
+
+    keys = None
+    if detection_cache.enabled:
+        model = model_digest(LP_DETECTOR_CFG, LP_DETECTOR_WEIGHTS)
+        keys = [detection_cache.key("plate", frames[i].digest, vehicles[i][j][1], model, lp_threshold) for i, j in index]
+
+    with profiler.stage("plate detection", frames=len(frames)):
+        batch_detections = cached_detect_batch("lp", crops, lp_threshold, keys)
+
+    results = [[(confidence, box, []) for confidence, box in frame_vehicles] for frame_vehicles in vehicles]
+    for (i, j), lp_detections in zip(index, batch_detections):
+        for _, confidence, box in lp_detections:
+            results[i][j][2].append((confidence, reset_crop(vehicles[i][j][1], list(box))))
+
+    return results
+
+def select_detections(candidates, vehicle_threshold, lp_threshold):
+    """
+    Function to get the license plates which detection at the given thresholds would have found, out of the
+    candidates detected at lower thresholds. The networks score every box independently of the threshold and the
+    non-maximum suppression keeps the highest scoring boxes first, so dropping the candidates below the
+    thresholds gives the same detections as running the networks again, up to the rounding of the confidences.
+
+    Parameters:
+        candidates: Candidates of a frame, see detect_candidates.
+        vehicle_threshold, lp_threshold: Thresholds, not lower than the ones of the candidates.
+
+    Return:
+        Same as detect: empty list if no vehicles are kept, else dictionary of license plates for each vehicle.
+    """
+    vehicles = [plates for confidence, _, plates in candidates if float(confidence) >= 100 * vehicle_threshold]
+    if not vehicles:
         return []
-    else:
-        vehicles, result_name, crop_locations, save_path = vehicle_detector(image_path, annot_path)
-        return lp_detector(vehicles, result_name, crop_locations, save_path, annot_path)
+
+    results = {}
+    for j, plates in enumerate(vehicles):
+        plates = [(confidence, box) for confidence, box in plates if float(confidence) >= 100 * lp_threshold]
+        if plates:
+            results[j] = {k: {'confidence': confidence, 'bounding box': list(box)} for k, (confidence, box) in enumerate(plates)}
+
+    return results
+
+def detect(frame):
+    """
+    Wrapper function for end-to-end detection of license plates in a single frame.
+
+    Parameters:
+        frame: Frame object for detection.
+
+    Return:
+        If no vehicles are found, empty list is returned.
+        Else, dictionary of bounding box on original images of license plates for each vehicle.
+    """
+    return detect_frames([frame])[0]
@@ -0,0 +1,167 @@
+"""
+This file contains the persistent cache of detections. Raw outputs of the vehicle, license plate and face detectors
+are stored under a key made of the frame's content hash, the model's weights hash and the thresholds, so rerunning
+the pipeline on the same frames with the same settings skips inference. The cache is a single SQLite file whose size
+is bounded, least recently used entries are evicted first.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# hashes of the files already hashed by this process
+_digests = {}
+
+def file_digest(path):
+    """
+    Function to hash a file, e.g. the weights of a network. The hash of a path is computed once per process.
+
+    Parameters:
+        path: Location of the file.
+
+    Return:
+        Hex digest of the file, or of the path if the file doesn't exist.
+    """
+    if path not in _digests:
+        digest = hashlib.sha1()
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+        else:
+            digest.update(path.encode())
+        _digests[path] = digest.hexdigest()
+
+    return _digests[path]
+
+def _to_json(value):
+    # RetinaFace returns NumPy arrays and scalars
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} can't be cached.")
+
+class DetectionCache:
+    """
+    Size-bounded LRU cache of detections stored in SQLite. Until it is opened, the cache is disabled: get always
+    misses and put does nothing.
+    """
+    def __init__(self):
+        self.connection = None
+        self.path = None
+        self.max_bytes = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.connection is not None
+
+    def open(self, path, max_mb=10240):
+        """
+        Function to open (or create) the cache file. Opening an already opened cache again does nothing.
+
+        Parameters:
+            path: Location of the cache file.
+            max_mb: Maximum size of the cached detections in MB.
+        """
+        if self.path == path:
+            return
+
+        self.close()
+
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        # switching the journal mode takes an exclusive lock which processes opening a new cache at once fail to
+        # get, the scheduler creates the cache before starting its workers so that they find it in WAL mode already
+        if self.connection.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS detections "
+                                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS detections_accessed ON detections (accessed)")
+
+        self.path = path
+        self.max_bytes = max_mb * 2 ** 20
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM detections").fetchone()[0]
+
+    def close(self):
+        """
+        Function to close the cache file, the cache is disabled afterwards.
+        """
+        if self.connection is not None:
+            self.connection.close()
+
+        self.connection = None
+        self.path = None
+
+    @staticmethod
+    def key(*parts):
+        """
+        Function to build a cache key.
+
+        Parameters:
+            parts: Everything the cached value depends on, e.g. detector name, frame hash, weights hash and threshold.
+        """
+        return hashlib.sha1(json.dumps(parts, default=_to_json).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Function to look up cached detections.
+
+        Parameters:
+            key: Key built by key.
+
+        Return:
+            Cached detections, or NoneType object on a miss.
+        """
+        if not self.enabled:
+            return None
+
+        row = self.connection.execute("SELECT value FROM detections WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute("UPDATE detections SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Function to store detections, evicting the least recently used entries if the cache gets too large.
+
+        Parameters:
+            key: Key built by key.
+            value: Detections, anything that can be saved as 'json' (NumPy values are converted to lists).
+        """
+        if not self.enabled:
+            return
+
+        value = json.dumps(value, default=_to_json)
+        self.connection.execute("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)",
+                                (key, value, len(value), time.time()))
+        self.size += len(value)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Function to remove least recently used entries until the cache is below 90% of its maximum size.
+        """
+        # other processes may have added or evicted entries in the meantime
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM detections").fetchone()[0]
+
+        while self.size > 0.9 * self.max_bytes:
+            rows = self.connection.execute("SELECT key, size FROM detections ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+
+            self.connection.executemany("DELETE FROM detections WHERE key = ?", [(key,) for key, _ in rows])
+            self.size -= sum(size for _, size in rows)
+
+# Cache shared by all the modules, disabled until opened
+detection_cache = DetectionCache()
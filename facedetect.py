@@ -0,0 +1,206 @@
+"""
+This file contains the face detectors. Every backend returns faces in the format of RetinaFace,
+{'face_<n>': {'score', 'facial_area': [x1, y1, x2, y2]}}, so they can be swapped per deployment. A detector can also
+run on downscaled copies of the frame (a pyramid of scales), the boxes found at every scale are mapped back to the
+full resolution and merged.
+"""
+
+import os
+import cv2
+import numpy as np
+from detectioncache import detection_cache
+from profiler import profiler
+
+# model of the YuNet detector, from the OpenCV model zoo
+YUNET_MODEL = "data/face_detection_yunet_2023mar.onnx"
+
+class RetinaFaceDetector:
+    """
+    RetinaFace, accurate but slow on CPU. TensorFlow is only imported when the first face is detected.
+    """
+    name = "retinaface"
+
+    def __init__(self):
+        self.model = None
+
+    def detect(self, image, threshold):
+        """
+        Function to detect faces in an image.
+
+        Parameters:
+            image: Image in OpenCV format.
+            threshold: Confidence threshold.
+
+        Return:
+            List of (score, bounding box) of the faces.
+        """
+        if self.model is None:
+            from retinaface import RetinaFace
+            self.model = RetinaFace
+
+        faces = self.model.detect_faces(image, threshold=threshold)
+        if not isinstance(faces, dict): # No faces found
+            return []
+
+        return [(float(face['score']), [int(point) for point in face['facial_area']]) for face in faces.values()]
+
+class HaarDetector:
+    """
+    Haar cascade detector of OpenCV, fast on CPU and shipped with opencv-python (up to OpenCV 4), but less
+    accurate. Its scores are the cascade's level weights mapped to (0, 1) with a logistic function.
+    """
+    name = "haar"
+
+    def __init__(self):
+        self.model = None
+
+    def detect(self, image, threshold):
+        """
+        Function to detect faces in an image, see RetinaFaceDetector.detect.
+        """
+        if self.model is None:
+            if not hasattr(cv2, "CascadeClassifier"):
+                raise RuntimeError(f"OpenCV {cv2.__version__} has no Haar cascades, use OpenCV 4 or another face detector.")
+            self.model = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        boxes, _, weights = self.model.detectMultiScale3(gray, scaleFactor=1.1, minNeighbors=5, outputRejectLevels=True)
+
+        faces = []
+        for (x, y, w, h), weight in zip(np.reshape(boxes, (-1, 4)).tolist(), np.reshape(weights, -1).tolist()):
+            score = 1 / (1 + np.exp(-weight))
+            if score >= threshold:
+                faces.append((float(score), [x, y, x + w, y + h]))
+
+        return faces
+
+class YuNetDetector:
+    """
+    YuNet detector of OpenCV (cv2.FaceDetectorYN), a small CNN running fast on CPU. Its model has to be downloaded
+    to YUNET_MODEL.
+    """
+    name = "yunet"
+
+    def __init__(self):
+        self.model = None
+
+    def detect(self, image, threshold):
+        """
+        Function to detect faces in an image, see RetinaFaceDetector.detect.
+        """
+        height, width = image.shape[:2]
+
+        if self.model is None:
+            if not os.path.isfile(YUNET_MODEL):
+                raise RuntimeError(f"{YUNET_MODEL} doesn't exist, download the YuNet model from the OpenCV model zoo.")
+            self.model = cv2.FaceDetectorYN.create(YUNET_MODEL, "", (width, height))
+
+        self.model.setInputSize((width, height))
+        self.model.setScoreThreshold(threshold)
+        _, detections = self.model.detect(image)
+        if detections is None:
+            return []
+
+        # rows of x, y, width, height, 5 landmarks and score
+        return [(float(row[14]), [int(row[0]), int(row[1]), int(row[0] + row[2]), int(row[1] + row[3])]) for row in detections.tolist()]
+
+BACKENDS = {
+    RetinaFaceDetector.name: RetinaFaceDetector,
+    HaarDetector.name: HaarDetector,
+    YuNetDetector.name: YuNetDetector,
+}
+
+# detectors already created by this process
+_detectors = {}
+
+def get_detector(backend):
+    """
+    Function to get the detector of a backend, created once per process.
+
+    Parameters:
+        backend: Name of the backend, one of BACKENDS.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown face detector {backend}, expected one of {', '.join(BACKENDS)}.")
+
+    if backend not in _detectors:
+        _detectors[backend] = BACKENDS[backend]()
+
+    return _detectors[backend]
+
+def warm_up(backend):
+    """
+    Function to create the detector of a backend and run it on a blank image, so that its model is loaded before
+    the first frame.
+
+    Parameters:
+        backend: Name of the backend, one of BACKENDS.
+    """
+    get_detector(backend).detect(np.zeros((480, 640, 3), dtype=np.uint8), 1.0)
+
+def merge_faces(faces, overlap=0.5):
+    """
+    Function to merge the faces found at several scales, keeping the most confident of overlapping faces.
+
+    Parameters:
+        faces: List of (score, bounding box).
+        overlap: Intersection over union above which two faces are the same.
+    """
+    if len(faces) < 2:
+        return faces
+
+    scores = np.array([score for score, _ in faces])
+    boxes = np.array([box for _, box in faces], dtype=float)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    keep = []
+    for i in np.argsort(scores, kind="stable")[::-1]:
+        if keep:
+            w = np.maximum(0, np.minimum(boxes[keep, 2], boxes[i, 2]) - np.maximum(boxes[keep, 0], boxes[i, 0]))
+            h = np.maximum(0, np.minimum(boxes[keep, 3], boxes[i, 3]) - np.maximum(boxes[keep, 1], boxes[i, 1]))
+            iou = w * h / np.maximum(area[keep] + area[i] - w * h, 1)
+            if (iou > overlap).any():
+                continue
+        keep.append(i)
+
+    return [faces[i] for i in keep]
+
+def detect_faces(frame, threshold, backend="retinaface", scales=(1.0,)):
+    """
+    Function to detect the faces of a frame, through the detection cache.
+
+    Parameters:
+        frame: Frame object.
+        threshold: Confidence threshold.
+        backend: Name of the face detector, one of BACKENDS.
+        scales: Scales of the frame the detector runs on, e.g. (0.5,) for half the resolution or (1.0, 0.5) for both.
+
+    Return:
+        Dictionary of faces in the format of RetinaFace.
+    """
+    scales = [float(scale) for scale in scales]
+    key = detection_cache.key("faces", backend, scales, frame.digest, threshold) if detection_cache.enabled else None
+    faces = detection_cache.get(key)
+    if faces is not None:
+        return faces
+
+    detector = get_detector(backend)
+
+    found = []
+    with profiler.stage(backend):
+        for scale in scales:
+            image = frame.bgr
+            if scale != 1:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+            # boxes are mapped back to the full resolution
+            for score, box in detector.detect(image, threshold):
+                found.append((score, [int(round(point / scale)) for point in box]))
+
+    if len(scales) > 1:
+        found = merge_faces(found)
+
+    faces = {f"face_{i + 1}": {'score': score, 'facial_area': box} for i, (score, box) in enumerate(found)}
+    detection_cache.put(key, faces)
+
+    return faces
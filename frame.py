@@ -0,0 +1,123 @@
+"""
+This file contains the Frame class, which decodes a frame of a driving sequence once and hands out the
+views of it that are needed by the detection, blurring and annotation stages.
+"""
+
+import hashlib
+import os
+import cv2
+import numpy as np
+
+class Frame:
+    """
+    A decoded frame. The pixels are read from disk only once, every other representation of the frame
+    is derived from the decoded buffer and cached.
+
+    Parameters:
+        path: Location of the frame.
+        image: Already decoded image in OpenCV (BGR) format, if the frame doesn't come from a file.
+    """
+    def __init__(self, path, image=None):
+        self.path = path
+
+        if image is None:
+            image = cv2.imread(path)
+            if image is None:
+                raise ValueError(f"{path} couldn't be read as an image.")
+
+        self.bgr = image
+        self._rgb = None
+        self._resized = {}
+        self._digest = None
+        self._regions = {}
+
+        # position of the frame in the frame it is a region of
+        self.offset = (0, 0)
+
+    @property
+    def name(self):
+        """
+        File name of the frame.
+        """
+        return os.path.basename(self.path)
+
+    @property
+    def stem(self):
+        """
+        File name of the frame without its extension, used for naming the annotation files.
+        """
+        return os.path.splitext(self.name)[0]
+
+    @property
+    def shape(self):
+        """
+        Resolution (height, width) of the frame.
+        """
+        return self.bgr.shape[:2]
+
+    @property
+    def digest(self):
+        """
+        Hash of the frame's pixels, used for caching its detections.
+        """
+        if self._digest is None:
+            digest = hashlib.blake2b(str(self.bgr.shape).encode(), digest_size=16)
+            digest.update(np.ascontiguousarray(self.bgr).data)
+            self._digest = digest.hexdigest()
+
+        return self._digest
+
+    @property
+    def rgb(self):
+        """
+        Frame in RGB format, as expected by the networks.
+        """
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB)
+
+        return self._rgb
+
+    def resized(self, width, height):
+        """
+        Function to get the RGB frame rescaled to a network's input resolution. The buffer is cached, so
+        networks sharing an input resolution share the resized frame as well.
+
+        Parameters:
+            width, height: Input resolution of the network.
+
+        Return:
+            Resized RGB frame.
+        """
+        if (width, height) not in self._resized:
+            self._resized[(width, height)] = cv2.resize(self.rgb, (width, height),
+                                                        interpolation=cv2.INTER_LINEAR)
+
+        return self._resized[(width, height)]
+
+    def region(self, box):
+        """
+        Function to get a rectangle of the frame as a Frame object sharing its pixels, e.g. the region of interest
+        of a camera. Boxes found in the rectangle are moved back to the frame by adding its offset. The rectangle
+        is cached, so the stages running on it share its representations as well.
+
+        Parameters:
+            box: Bounding box (x1, y1, x2, y2) of the rectangle.
+
+        Return:
+            Frame object of the rectangle.
+        """
+        box = tuple(int(point) for point in box)
+        if box not in self._regions:
+            x1, y1, x2, y2 = box
+            region = Frame(self.path, self.bgr[y1:y2, x1:x2])
+            region.offset = (self.offset[0] + x1, self.offset[1] + y1)
+            self._regions[box] = region
+
+        return self._regions[box]
+
+    def copy(self):
+        """
+        Function to get a writable copy of the BGR frame, used for blurring and drawing so that the
+        detections keep working on the original pixels.
+        """
+        return self.bgr.copy()
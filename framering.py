@@ -0,0 +1,344 @@
+"""
+This file contains the shared memory transport of frames between the processes of run.py. Frames are decoded by
+decoder processes into the slots of a ring buffer in shared memory, the detector (the main process) reads them in
+place, and encoder processes blur and save them from the same slots. The processes only exchange slot indices,
+frame shapes and bounding boxes through queues, never the pixels. The time the processes spend decoding, blurring
+and saving each frame is sent back with it and added to the profile.
+
+A slot is reference counted: it is taken by a decoder, held by every process still reading it, and goes back to the
+free slots once the last of them releases it. A full ring holds the decoders back until frames are released.
+"""
+
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+from frame import Frame
+from profiler import profiler
+from regionblur import blur_regions
+
+class FrameRing:
+    """
+    Ring buffer of frame slots in shared memory. It is passed to the processes sharing it as an argument of the
+    processes.
+
+    Parameters:
+        slots: Number of frames the ring holds.
+        shape: Largest shape (height, width, channels) of the frames.
+        context: Multiprocessing context of the processes sharing the ring.
+    """
+    def __init__(self, slots, shape, context=None):
+        context = context or mp.get_context("spawn")
+
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.slot_size = int(np.prod(self.shape))
+
+        self._memory = shared_memory.SharedMemory(create=True, size=slots * self.slot_size)
+        self._owner = True
+        self._counts = context.Array("i", slots)
+        self._free = context.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+
+    def __getstate__(self):
+        return {'name': self._memory.name, 'slots': self.slots, 'shape': self.shape, 'counts': self._counts, 'free': self._free}
+
+    def __setstate__(self, state):
+        self.slots = state['slots']
+        self.shape = state['shape']
+        self.slot_size = int(np.prod(self.shape))
+
+        self._memory = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._counts = state['counts']
+        self._free = state['free']
+
+    def array(self, slot, shape):
+        """
+        Function to get the pixels of a slot, as a NumPy array in shared memory.
+
+        Parameters:
+            slot: Index of the slot.
+            shape: Shape of the frame in the slot.
+        """
+        if int(np.prod(shape)) > self.slot_size:
+            raise ValueError(f"A frame of shape {tuple(shape)} doesn't fit in the slots of shape {self.shape}.")
+
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._memory.buf, offset=slot * self.slot_size)
+
+    def acquire(self):
+        """
+        Function to take a free slot, waiting for one if the ring is full. The slot is held by the caller.
+
+        Return:
+            Index of the slot.
+        """
+        slot = self._free.get()
+        with self._counts.get_lock():
+            self._counts[slot] = 1
+        return slot
+
+    def retain(self, slot):
+        """
+        Function to hold a slot once more, e.g. before handing it to another process.
+        """
+        with self._counts.get_lock():
+            self._counts[slot] += 1
+
+    def release(self, slot):
+        """
+        Function to release a slot, which is free again once every holder has released it.
+        """
+        with self._counts.get_lock():
+            self._counts[slot] -= 1
+            free = self._counts[slot] == 0
+
+        if free:
+            self._free.put(slot)
+
+    def close(self):
+        """
+        Function to detach this process from the ring, the process which created it also frees the memory.
+        """
+        try:
+            self._memory.close()
+        except BufferError:
+            # arrays of the slots are still referenced, the memory is unmapped once they are collected
+            pass
+
+        if self._owner:
+            self._memory.unlink()
+
+def decode_frames(ring, paths, claimed, output):
+    """
+    Function run by the decoder processes, decoding frames into the ring. The decoders claim the frames and their
+    slots in order, so the slots are never all taken by frames which are needed after a frame still waiting for one.
+
+    Parameters:
+        ring: FrameRing of the camera.
+        paths: Paths of the frames of the camera, in order.
+        claimed: Shared number of frames claimed by the decoders.
+        output: Queue of (index, path, slot, shape, decoding time in seconds) of the decoded frames, (index, path,
+                None, error message, decoding time) if a frame couldn't be decoded. A NoneType object is put once
+                there are no frames left.
+    """
+    while True:
+        with claimed.get_lock():
+            index = claimed.value
+            if index >= len(paths):
+                break
+            claimed.value += 1
+            slot = ring.acquire()
+
+        path = paths[index]
+        start = time.perf_counter()
+        try:
+            image = cv2.imread(path)
+            if image is None:
+                raise ValueError(f"{path} couldn't be read as an image.")
+            ring.array(slot, image.shape)[...] = image
+        except ValueError as error:
+            ring.release(slot)
+            output.put((index, path, None, str(error), time.perf_counter() - start))
+            continue
+
+        output.put((index, path, slot, image.shape, time.perf_counter() - start))
+
+    output.put(None)
+    ring.close()
+
+def encode_frames(ring, tasks, results):
+    """
+    Function run by the encoder processes, blurring and saving frames of the ring.
+
+    Parameters:
+        ring: FrameRing of the camera.
+        tasks: Queue of (task index, slot, shape, path, boxes, ImageEncoder, blur method, blur radius), a NoneType
+               object stops the process.
+        results: Queue of (task index, (path, size, checksum) of the saved image, error message, dictionary of the
+                 time in seconds taken by the 'blur' and 'image save' stages).
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        index, slot, shape, path, boxes, encoder, method, radius = task
+        try:
+            blur = ring.array(slot, shape).copy()
+        finally:
+            ring.release(slot)
+
+        timings = {}
+        try:
+            start = time.perf_counter()
+            blur_regions(blur, boxes, method, radius)
+            timings['blur'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            written = encoder.save(path, blur)
+            timings['image save'] = time.perf_counter() - start
+
+            results.put((index, written, None, timings))
+        except Exception as error:
+            results.put((index, None, f"{path} couldn't be saved: {error}", timings))
+
+    ring.close()
+
+class FrameProcesses:
+    """
+    Decoder and encoder processes of a camera, sharing the frames with this process through a FrameRing. Frames
+    given by frames() have to be released with release() once this process is done with them.
+
+    Parameters:
+        paths: Paths of the frames of the camera, in order.
+        slots: Number of frames in the ring.
+        decoders, encoders: Number of decoder and encoder processes.
+    """
+    def __init__(self, paths, slots, decoders=1, encoders=1):
+        self.paths = list(paths)
+        context = mp.get_context("spawn")
+
+        # slots are as large as the first frame, the frames of a camera have the same resolution
+        self.ring = FrameRing(slots, cv2.imread(self.paths[0]).shape, context) if self.paths else None
+
+        self._decoded = context.Queue()
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._next_task = 0
+
+        # kept by this process until the decoders are done, they share its lock
+        self._claimed = context.Value("i", 0)
+        self._decoders = [context.Process(target=decode_frames, args=(self.ring, self.paths, self._claimed, self._decoded), daemon=True)
+                          for _ in range(decoders if self.paths else 0)]
+        self._encoders = [context.Process(target=encode_frames, args=(self.ring, self._tasks, self._results), daemon=True)
+                          for _ in range(encoders if self.paths else 0)]
+        for process in self._decoders + self._encoders:
+            process.start()
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def frames(self):
+        """
+        Generator of the frames of the camera in order, their pixels being in the ring.
+
+        Return:
+            Yields Frame objects, with the index of their slot as 'slot' attribute.
+        """
+        ready = {}
+        finished = 0
+        for index in range(len(self.paths)):
+            while index not in ready:
+                try:
+                    item = self._decoded.get(timeout=1)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in self._decoders):
+                        raise RuntimeError("The decoder processes stopped before decoding every frame.")
+                    continue
+                if item is None:
+                    finished += 1
+                    if finished == len(self._decoders):
+                        raise RuntimeError("The decoder processes stopped before decoding every frame.")
+                    continue
+                ready[item[0]] = item
+
+            _, path, slot, shape, seconds = ready.pop(index)
+            if profiler.enabled:
+                profiler.record("decode", seconds)
+            if slot is None:
+                raise ValueError(shape)
+
+            frame = Frame(path, self.ring.array(slot, shape))
+            frame.slot = slot
+            yield frame
+
+    def release(self, frame):
+        """
+        Function to release the slot of a frame, once this process doesn't need its pixels anymore.
+        """
+        self.ring.release(frame.slot)
+
+    def encode(self, frame, boxes, path, encoder, method, radius):
+        """
+        Function to have a frame blurred and saved by the encoder processes.
+
+        Parameters:
+            frame: Frame object given by frames().
+            boxes: Bounding boxes to be blurred.
+            path: Location of the image.
+            encoder: ImageEncoder of the image.
+            method, radius: Blur method and strength, see regionblur.
+
+        Return:
+            Future of the path, size and checksum of the image file.
+        """
+        future = Future()
+        with self._lock:
+            index = self._next_task
+            self._next_task += 1
+            self._futures[index] = future
+
+        self.ring.retain(frame.slot)
+        self._tasks.put((index, frame.slot, frame.bgr.shape, path, [list(map(int, box)) for box in boxes], encoder, method, radius))
+
+        return future
+
+    def _collect(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+
+            index, result, error, timings = item
+            if profiler.enabled:
+                for name, seconds in timings.items():
+                    profiler.record(name, seconds)
+
+            with self._lock:
+                future = self._futures.pop(index)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def close(self, wait=True):
+        """
+        Function to stop the processes and free the ring.
+
+        Parameters:
+            wait: Let the encoder processes finish the frames given to them, else stop every process right away.
+        """
+        if wait:
+            for _ in self._encoders:
+                self._tasks.put(None)
+            for process in self._encoders + self._decoders:
+                process.join()
+        else:
+            for process in self._encoders + self._decoders:
+                process.terminate()
+                process.join()
+
+        self._results.put(None)
+        self._collector.join()
+
+        with self._lock:
+            for future in self._futures.values():
+                future.set_exception(RuntimeError("The encoder processes stopped before saving the frame."))
+            self._futures.clear()
+
+        if self.ring is not None:
+            self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None)
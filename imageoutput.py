@@ -0,0 +1,165 @@
+"""
+This file contains the encoding of the blurred frames saved by run.py. The format and the compression level are
+configurable, and a frame without anything to blur can be passed through: if its source file is in the output format
+already, it is hard-linked (or copied across file systems) into the privacy folder instead of being encoded again.
+
+Output images are always written to a temporary file which then replaces the image, so that an image which is a hard
+link to a source frame is replaced instead of being written through, which would overwrite the source frame.
+"""
+
+import hashlib
+import os
+import shutil
+import cv2
+
+# formats of the blurred frames, and the extensions of their files
+FORMATS = {
+    "png": (".png",),
+    "jpg": (".jpg", ".jpeg"),
+    "webp": (".webp",),
+}
+
+def parse_quality(quality):
+    """
+    Function to parse a quality given on the command line.
+
+    Parameters:
+        quality: 'lossless' or a number, see ImageEncoder.
+    """
+    if quality is None or quality == "lossless":
+        return quality
+    return int(quality)
+
+def encode_params(format, quality=None):
+    """
+    Function to get the parameters of cv2.imencode for a format and a quality.
+
+    Parameters:
+        format: Format of the images, one of FORMATS.
+        quality: NoneType object for OpenCV's default, 'lossless', or the PNG compression level (0 to 9, higher is
+                 smaller but slower) or the JPEG or WebP quality (0 to 100).
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown image format {format}, expected one of {', '.join(FORMATS)}.")
+
+    if quality is None:
+        return []
+
+    if format == "png":
+        # PNG is always lossless
+        return [] if quality == "lossless" else [cv2.IMWRITE_PNG_COMPRESSION, quality]
+
+    if format == "jpg":
+        if quality == "lossless":
+            raise ValueError("JPEG images can't be lossless, use png or webp.")
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    # WebP is lossless above a quality of 100
+    return [cv2.IMWRITE_WEBP_QUALITY, 101 if quality == "lossless" else quality]
+
+def file_info(path):
+    """
+    Function to get the path, size and checksum of a file.
+    """
+    checksum = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(chunk)
+
+    return path, os.path.getsize(path), checksum.hexdigest()
+
+def replace_file(path, data):
+    """
+    Function to write a file through a temporary file in the same folder, which then replaces it.
+
+    Parameters:
+        path: Location of the file.
+        data: Content of the file.
+    """
+    partial = f"{path}.part"
+    with open(partial, "wb") as f:
+        f.write(data)
+    os.replace(partial, path)
+
+class ImageEncoder:
+    """
+    Encoder of the blurred frames.
+
+    Parameters:
+        format: Format of the images, one of FORMATS.
+        quality: Compression level or quality, see encode_params.
+        pass_through: Save the frames without anything to blur as a hard link to (or a copy of) their source file,
+                      if it is in the same format.
+    """
+    def __init__(self, format="png", quality=None, pass_through=False):
+        self.params = encode_params(format, quality)
+        self.format = format
+        self.extension = FORMATS[format][0]
+        self.pass_through = pass_through
+
+    def passes(self, source):
+        """
+        Function to tell whether a frame without anything to blur is passed through.
+
+        Parameters:
+            source: Location of the source frame.
+        """
+        return self.pass_through and os.path.splitext(source)[1].lower() in FORMATS[self.format]
+
+    def path(self, folder, stem):
+        """
+        Function to get the location of an encoded image.
+
+        Parameters:
+            folder: Privacy folder of the camera.
+            stem: Name of the frame without its extension.
+        """
+        return os.path.join(folder, stem + self.extension)
+
+    def save(self, path, image):
+        """
+        Function to encode and save an image.
+
+        Parameters:
+            path: Location of the image.
+            image: Image in OpenCV format.
+
+        Return:
+            Path, size and checksum of the image file.
+        """
+        success, data = cv2.imencode(self.extension, image, self.params)
+        if not success:
+            raise ValueError(f"{path} couldn't be encoded as {self.format}.")
+
+        data = data.tobytes()
+        replace_file(path, data)
+
+        return path, len(data), hashlib.sha1(data).hexdigest()
+
+    def link(self, source, path):
+        """
+        Function to save a frame untouched, as a hard link to its source file or a copy of it if they are on
+        different file systems.
+
+        Parameters:
+            source: Location of the source frame.
+            path: Location of the image.
+
+        Return:
+            Path, size and checksum of the image file.
+        """
+        # linked by an earlier run already, renaming a link over another link to the same file does nothing
+        if os.path.isfile(path) and os.path.samefile(source, path):
+            return file_info(path)
+
+        partial = f"{path}.part"
+        if os.path.lexists(partial):
+            os.remove(partial)
+
+        try:
+            os.link(source, partial)
+        except OSError:
+            shutil.copyfile(source, partial)
+        os.replace(partial, path)
+
+        return file_info(path)
@@ -0,0 +1,171 @@
+"""
+This file contains a pool of reusable Darknet images, so that the input buffers of the networks are allocated
+once per input shape instead of once per frame or vehicle crop.
+
+Running it as a script soaks the input path of the networks, with the stub Darknet of benchmark.py or the real one,
+and fails if the resident memory doesn't stay flat after warm-up:
+    python imagepool.py [frames] [--real]
+"""
+
+from contextlib import contextmanager
+import os
+import threading
+import sys
+import numpy as np
+
+class ImagePool:
+    """
+    Thread-safe pool of Darknet images keyed by their shape (width, height, channels).
+
+    Parameters:
+        make_image: Function allocating an image of a given width, height and channels (dn.make_image).
+        free_image: Function freeing an image (dn.free_image).
+        max_free: Maximum number of idle images kept for each shape, extra images are freed on release.
+    """
+    def __init__(self, make_image, free_image, max_free=8):
+        self.make_image = make_image
+        self.free_image = free_image
+        self.max_free = max_free
+
+        self._lock = threading.Lock()
+        self._free = {}
+        self._in_use = {}
+
+    def acquire(self, width, height, channels):
+        """
+        Function to get an image of the given shape, reusing an idle one if there is any. The contents of
+        a reused image are whatever the previous user left in it.
+
+        Parameters:
+            width, height, channels: Shape of the image.
+
+        Return:
+            Darknet image, which has to be given back with release.
+        """
+        key = (width, height, channels)
+
+        with self._lock:
+            idle = self._free.get(key)
+            image = idle.pop() if idle else None
+
+        if image is None:
+            image = self.make_image(width, height, channels)
+
+        with self._lock:
+            self._in_use[id(image)] = image
+
+        return image
+
+    def release(self, image):
+        """
+        Function to give an image back to the pool.
+
+        Parameters:
+            image: Darknet image obtained from acquire.
+        """
+        with self._lock:
+            if self._in_use.pop(id(image), None) is None:
+                raise ValueError("Image doesn't belong to the pool or has already been released.")
+
+            idle = self._free.setdefault((image.w, image.h, image.c), [])
+            if len(idle) < self.max_free:
+                idle.append(image)
+                return
+
+        self.free_image(image)
+
+    @contextmanager
+    def borrow(self, width, height, channels):
+        """
+        Context manager acquiring an image and releasing it on exit.
+
+        Parameters:
+            width, height, channels: Shape of the image.
+        """
+        image = self.acquire(width, height, channels)
+        try:
+            yield image
+        finally:
+            self.release(image)
+
+    def close(self):
+        """
+        Function to free all idle images of the pool. Images in use are freed when they are released.
+        """
+        with self._lock:
+            idle = [image for images in self._free.values() for image in images]
+            self._free.clear()
+            self.max_free = 0
+
+        for image in idle:
+            self.free_image(image)
+
+    def __len__(self):
+        """
+        Number of images currently held by the pool, idle or in use.
+        """
+        with self._lock:
+            return len(self._in_use) + sum(len(images) for images in self._free.values())
+
+def resident_memory():
+    """
+    Function to get the current resident memory of this process in MB, read from /proc (Linux only). Unlike the
+    peak given by getrusage, it goes down when memory is given back, so it shows growth after warm-up.
+    """
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+def soak(frames=100000, width=640, height=360, crops=1, warm_up=10000, report_every=10000, tolerance=16, real=False):
+    """
+    Function to run frames through the input path of the networks, the path which used to leak a Darknet image per
+    frame and per vehicle crop: detect.prepare_image, prediction and free_batch_detections (see
+    detect.detect_batch_images), for the vehicle network and for the lp network on crops of the frames. The
+    resident memory is sampled along the way, and it has to stay flat after warm-up. 100k frames take about ten
+    minutes with the stub Darknet.
+
+    Parameters:
+        frames: Number of frames to run.
+        width, height: Resolution of the frames.
+        crops: Number of vehicle crops per frame run through the lp network.
+        warm_up: Number of frames after which the resident memory is taken as reference.
+        report_every: Number of frames between two memory samples.
+        tolerance: Growth of the resident memory over the reference, in MB, above which the soak fails.
+        real: Use the Darknet library and weights, instead of the stub Darknet of benchmark.py.
+
+    Return:
+        Largest growth of the resident memory over the reference, in MB.
+    """
+    if not real:
+        from benchmark import install_stubs
+        install_stubs()
+    import detect
+
+    networks = detect.load_models()
+    vehicle_network, vehicle_class_names, vehicle_batch_size = networks['vehicle']
+    lp_network, lp_class_names, lp_batch_size = networks['lp']
+
+    image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    crop = image[height // 4: height * 3 // 4, width // 4: width * 3 // 4]
+
+    reference = None
+    growth = 0.0
+    for frame in range(vehicle_batch_size, frames + vehicle_batch_size, vehicle_batch_size):
+        detect.detect_batch_images(vehicle_network, vehicle_class_names, [image] * vehicle_batch_size, 0.5, vehicle_batch_size)
+        detect.detect_batch_images(lp_network, lp_class_names, [crop] * (crops * vehicle_batch_size), 0.5, lp_batch_size)
+
+        if frame % report_every < vehicle_batch_size:
+            rss = resident_memory()
+            if reference is None and frame >= warm_up:
+                reference = rss
+            if reference is not None:
+                growth = max(growth, rss - reference)
+            print(f"{frame} frames : RSS {rss:.1f} MB ({rss - (reference or rss):+.1f} MB after warm-up), {len(detect.image_pool)} images in pool")
+
+    if growth > tolerance:
+        raise RuntimeError(f"Resident memory grew by {growth:.1f} MB after warm-up, more than {tolerance} MB.")
+
+    return growth
+
+if __name__ == "__main__":
+    soak(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, real="--real" in sys.argv)
@@ -0,0 +1,190 @@
+"""
+This file contains the keyframe mode of run.py. Consecutive frames of a driving sequence are very similar, so the
+detectors only run on keyframes: every few frames, or earlier when the scene changes. The faces and license plates of
+the frames in between are moved from one keyframe to the next along their tracks, with the interpolation of
+tracking.py, and their boxes are dilated by a margin so that the estimated boxes still cover them.
+
+When the capture vehicle is stopped, consecutive keyframes can be near duplicates of each other. A keyframe which
+barely differs from the last frame the detectors ran on reuses its faces and license plates instead.
+"""
+
+import cv2
+import numpy as np
+from tracking import fill_gaps
+
+# resolution of the thumbnails compared for detecting scene changes
+THUMBNAIL_SIZE = (64, 36)
+
+def thumbnail(frame):
+    """
+    Function to get a small grayscale version of a frame, for comparing frames cheaply.
+
+    Parameters:
+        frame: Frame object.
+    """
+    gray = cv2.cvtColor(frame.bgr, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def dilate(boxes, margin):
+    """
+    Function to grow bounding boxes on every side by a fraction of their size.
+
+    Parameters:
+        boxes: Bounding boxes (x1, y1, x2, y2).
+        margin: Fraction of the width (height) added on the left and right (top and bottom) of a box.
+
+    Return:
+        Array of shape (N, 4) of the dilated boxes.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    pad = margin * (boxes[:, 2:] - boxes[:, :2])
+    return np.hstack([boxes[:, :2] - pad, boxes[:, 2:] + pad])
+
+class KeyframeSelector:
+    """
+    Decides which frames are keyframes, the frames are given in order. A frame is a keyframe if it is the first one,
+    if interval frames have passed since the last keyframe, or if it differs from the last keyframe by more than
+    scene_threshold (mean absolute difference of the thumbnails, as a fraction of the intensity range).
+
+    Parameters:
+        interval: Number of frames from a keyframe to the next one, at most.
+        scene_threshold: Difference from the last keyframe above which a frame is a keyframe.
+    """
+    def __init__(self, interval, scene_threshold=0.15):
+        self.interval = interval
+        self.scene_threshold = scene_threshold
+        self.last = None
+        self.since = 0
+
+    def __call__(self, frame):
+        self.since += 1
+        if self.last is not None and self.since < self.interval:
+            small = thumbnail(frame)
+            if np.abs(small - self.last).mean() / 255 <= self.scene_threshold:
+                return False
+            self.last = small
+        else:
+            self.last = thumbnail(frame)
+
+        self.since = 0
+        return True
+
+class DuplicateFilter:
+    """
+    Tells whether frames are near duplicates of the last frame the detectors ran on, the frames are given in order.
+    A frame is a near duplicate if no pixel of its thumbnail differs from the thumbnail of that frame by more than
+    tolerance (as a fraction of the intensity range). The largest difference rather than the mean is compared, so
+    that a small change, e.g. a pedestrian walking into a still scene, isn't averaged out.
+
+    Parameters:
+        tolerance: Difference up to which a frame is a near duplicate, 0 for identical thumbnails only.
+    """
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.last = None
+
+    def __call__(self, frame):
+        small = thumbnail(frame)
+        if self.last is not None and np.abs(small - self.last).max() / 255 <= self.tolerance:
+            return True
+
+        # the detectors run on the frame, the next frames are compared with it
+        self.last = small
+        return False
+
+class Propagator:
+    """
+    Boxes of the tracked objects of a kind (faces or license plates) at the last keyframe. Tracks found at two
+    consecutive keyframes are interpolated in the frames between them, tracks lost by the next keyframe keep moving
+    at their last speed, and tracks new at the next keyframe keep their box in the frames before it.
+    """
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=int)
+        self.boxes = np.zeros((0, 4))
+        self.labels = []
+        self.velocity = {}
+
+    def segment(self, ids, boxes, labels, length):
+        """
+        Function to get the boxes in the frames between the last keyframe and the next one, and move on to the
+        next keyframe.
+
+        Parameters:
+            ids: Track IDs of the objects at the next keyframe.
+            boxes: Bounding boxes of the objects at the next keyframe.
+            labels: Anything kept along with every object, e.g. the vehicle of a plate.
+            length: Number of frames from the last keyframe to the next one.
+
+        Return:
+            List with, for every frame in between, list of (label, track ID, bounding box).
+        """
+        ids = np.asarray(ids, dtype=int).reshape(-1)
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        labels = list(labels)
+
+        last = {objectId: i for i, objectId in enumerate(self.ids.tolist())}
+        following = {objectId: j for j, objectId in enumerate(ids.tolist())}
+        common = [objectId for objectId in last if objectId in following]
+
+        frames = [[] for _ in range(length - 1)]
+        if length > 1:
+            # tracks found at both keyframes, one gap per track
+            if common:
+                tracks = np.repeat(common, 2)
+                rows = np.tile([0, length], len(common))
+                ends = np.empty((2 * len(common), 4))
+                ends[0::2] = self.boxes[[last[objectId] for objectId in common]]
+                ends[1::2] = boxes[[following[objectId] for objectId in common]]
+
+                before, filled_frames, filled_boxes = fill_gaps(rows, tracks, ends, length - 1)
+                for row, i, box in zip(before.tolist(), filled_frames.tolist(), filled_boxes):
+                    objectId = int(tracks[row])
+                    frames[i - 1].append((self.labels[last[objectId]], objectId, box))
+
+            steps = np.arange(1, length)[:, None]
+
+            # tracks lost by the next keyframe
+            for objectId, i in last.items():
+                if objectId not in following:
+                    moved = self.boxes[i] + steps * self.velocity.get(objectId, np.zeros(4))
+                    for frame, box in zip(frames, moved):
+                        frame.append((self.labels[i], objectId, box))
+
+            # tracks new at the next keyframe
+            for objectId, j in following.items():
+                if objectId not in last:
+                    for frame in frames:
+                        frame.append((labels[j], objectId, boxes[j]))
+
+        self.velocity = {objectId: (boxes[following[objectId]] - self.boxes[last[objectId]]) / length for objectId in common}
+        self.ids, self.boxes, self.labels = ids, boxes, labels
+
+        return frames
+
+def keyframe_windows(frames, is_keyframe, size):
+    """
+    Generator grouping frames in windows holding a given number of keyframes, so that the keyframes of a window are
+    detected in a single batch. Every window but the last one ends with a keyframe.
+
+    Parameters:
+        frames: Frames in order.
+        is_keyframe: Function telling whether a frame is a keyframe, e.g. a KeyframeSelector.
+        size: Number of keyframes per window.
+
+    Return:
+        Yields lists of (frame, whether it is a keyframe).
+    """
+    window = []
+    keyframes = 0
+    for frame in frames:
+        key = is_keyframe(frame)
+        window.append((frame, key))
+        keyframes += key
+
+        if keyframes == size:
+            yield window
+            window = []
+            keyframes = 0
+
+    if window:
+        yield window
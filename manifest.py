@@ -0,0 +1,163 @@
+"""
+This file contains the run manifest of a dataset, which records for every processed frame its source file, the
+parameters it was processed with and the checksums of its outputs. A rerun uses it to process only the frames that
+are new, changed or stale. Outputs rewritten after a frame was processed, e.g. by the postprocessing, are recorded
+again so that the frame stays up to date. The manifest is a SQLite file, so every update is written atomically and
+worker processes can share it.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+# name of the manifest file in the dataset folder
+MANIFEST_NAME = ".run-manifest.db"
+
+def params_digest(params):
+    """
+    Function to hash the parameters a frame is processed with.
+
+    Parameters:
+        params: Dictionary of parameters, e.g. thresholds, model hashes and blur settings.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def source_signature(path):
+    """
+    Function to get the signature (size, modification time) of a source frame, a frame whose signature changes
+    is processed again.
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def update_camera(currdir, cam, outputs):
+    """
+    Function to record outputs of a camera rewritten after it was processed, in the manifest of its dataset if
+    there is one.
+
+    Parameters:
+        currdir: Directory of the sequence.
+        cam: Name of the camera, a folder of frames or a video file.
+        outputs: Dictionary of the files rewritten for every frame, {source path: [(path, size, checksum)]}, the
+                 source of every frame of a video being the video.
+    """
+    path = os.path.join(os.path.dirname(currdir), MANIFEST_NAME)
+    if not outputs or not os.path.isfile(path):
+        return
+
+    manifest = RunManifest(path)
+    try:
+        manifest.update_outputs(f"{os.path.basename(currdir)}/{cam}", list(outputs.items()))
+    finally:
+        manifest.close()
+
+class RunManifest:
+    """
+    Manifest of the frames processed in a dataset.
+
+    Parameters:
+        path: Location of the manifest file, output paths are stored relative to its folder.
+    """
+    def __init__(self, path):
+        self.root = os.path.dirname(os.path.abspath(path))
+
+        self.connection = sqlite3.connect(path, timeout=60)
+        # like the detection cache, the manifest is created before the workers of the scheduler open it
+        if self.connection.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS frames (camera TEXT, frame TEXT, size INTEGER, "
+                                    "mtime INTEGER, params TEXT, outputs TEXT, state TEXT, PRIMARY KEY (camera, frame))")
+
+    def _outputs_exist(self, outputs):
+        for path, size, _ in json.loads(outputs):
+            path = os.path.join(self.root, path)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+        return True
+
+    def resume_point(self, camera, frame_paths, params, annotated=None):
+        """
+        Function to find where processing of a camera has to start. Frames are processed in order because of
+        tracking, so everything after the first frame that is new, changed, processed with other parameters or
+        whose outputs are missing is processed again.
+
+        Parameters:
+            camera: Key of the camera, e.g. '<sequence>/<cam>'.
+            frame_paths: Paths of the frames of the camera, in order.
+            params: Hash of the current parameters.
+            annotated: Container of the names of the frames whose annotations are in the annotation store, if
+                       the annotations aren't recorded as outputs.
+
+        Return:
+            Index of the first frame to be processed and the tracker state to start from, NoneType object if
+            the tracker has to start from scratch.
+        """
+        records = {frame: (size, mtime, frame_params, outputs, state) for frame, size, mtime, frame_params, outputs, state in
+                   self.connection.execute("SELECT frame, size, mtime, params, outputs, state FROM frames WHERE camera = ?",
+                                           (camera,))}
+
+        start = 0
+        for path in frame_paths:
+            record = records.get(os.path.basename(path))
+            if (record is None or record[:2] != source_signature(path) or record[2] != params
+                    or not self._outputs_exist(record[3]) or (annotated is not None and os.path.basename(path) not in annotated)):
+                break
+            start += 1
+
+        if start == 0:
+            return 0, None
+
+        # tracking goes on from the state saved after the last up to date frame
+        return start, json.loads(records[os.path.basename(frame_paths[start - 1])][4])
+
+    def record(self, camera, entries, params):
+        """
+        Function to record processed frames, in a single transaction.
+
+        Parameters:
+            camera: Key of the camera.
+            entries: List of (frame path, outputs, state of the tracker streams after the frame), outputs
+                     being a list of (path, size, checksum) of the files written for the frame.
+            params: Hash of the parameters the frames were processed with.
+        """
+        if not entries:
+            return
+
+        rows = []
+        for path, outputs, state in entries:
+            outputs = [(os.path.relpath(output, self.root), size, checksum) for output, size, checksum in outputs]
+            rows.append((camera, os.path.basename(path), *source_signature(path), params, json.dumps(outputs),
+                         json.dumps(state)))
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def update_outputs(self, camera, entries):
+        """
+        Function to record outputs of processed frames which were rewritten since, in a single transaction. The other
+        outputs of the frames are kept, and frames which aren't recorded are left out.
+
+        Parameters:
+            camera: Key of the camera.
+            entries: List of (frame path, outputs), outputs being a list of (path, size, checksum) of the files
+                     rewritten for the frame.
+        """
+        with self.connection:
+            for path, outputs in entries:
+                row = self.connection.execute("SELECT outputs FROM frames WHERE camera = ? AND frame = ?",
+                                              (camera, os.path.basename(path))).fetchone()
+                if row is None:
+                    continue
+
+                recorded = {output: (size, checksum) for output, size, checksum in json.loads(row[0])}
+                for output, size, checksum in outputs:
+                    recorded[os.path.relpath(output, self.root)] = (size, checksum)
+
+                self.connection.execute("UPDATE frames SET outputs = ? WHERE camera = ? AND frame = ?",
+                                        (json.dumps([(output, *info) for output, info in recorded.items()]), camera,
+                                         os.path.basename(path)))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,173 @@
+"""
+This file contains the building blocks of the streaming pipeline used by run.py. Decoding frames and writing
+outputs happen in thread pools and overlap with inference, while bounded queues between the stages apply
+backpressure so that a slow stage holds the others back instead of piling frames up in memory.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+import queue
+import threading
+
+def prefetch(items, load, workers=2, depth=8):
+    """
+    Generator loading items in a thread pool ahead of their use. Results are yielded in the order of the items.
+
+    Parameters:
+        items: Iterable of items to be loaded, e.g. frame paths.
+        load: Function loading an item, e.g. Frame.
+        workers: Number of loading threads.
+        depth: Maximum number of items loaded ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for item in items:
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+            pending.append(executor.submit(load, item))
+
+        while pending:
+            yield pending.popleft().result()
+
+def background(items, depth=8):
+    """
+    Generator going through an iterable in a background thread ahead of its use, for sources which can only be
+    read in order, e.g. the frames of a video. An exception raised by the iterable is raised again by the generator.
+
+    Parameters:
+        items: Iterable to be gone through, e.g. a generator decoding frames.
+        depth: Maximum number of items produced ahead of the consumer.
+    """
+    ready = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(entry):
+        # waits for room in the queue, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as error:
+            put((end, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        # releases the producer if the consumer stopped early
+        stop.set()
+        thread.join()
+
+def batched(iterable, size):
+    """
+    Generator grouping the items of an iterable in lists of a given size, the last list may be shorter.
+
+    Parameters:
+        iterable: Items to be grouped.
+        size: Size of the groups.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def completed(function, *args, **kwargs):
+    """
+    Function to run a task right away, with the same interface as Writer.submit.
+
+    Return:
+        Finished future holding the result of the task.
+    """
+    future = Future()
+    future.set_result(function(*args, **kwargs))
+    return future
+
+class Writer:
+    """
+    Pool of background threads for output tasks like saving images and annotations. submit blocks once
+    max_pending tasks are waiting, and an exception raised by a task is raised again by the next call to
+    submit or close.
+
+    Parameters:
+        workers: Number of writing threads.
+        max_pending: Maximum number of tasks submitted but not finished yet.
+    """
+    def __init__(self, workers=2, max_pending=16):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def _done(self, future):
+        self._slots.release()
+
+        if future.exception() is not None:
+            with self._lock:
+                self._errors.append(future.exception())
+
+    def _raise_errors(self):
+        with self._lock:
+            if self._errors:
+                error = self._errors[0]
+                self._errors.clear()
+                raise error
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Function to run a task in the background, waiting for a free slot if too many tasks are pending.
+
+        Parameters:
+            function: Task to be run.
+            args, kwargs: Arguments of the task.
+
+        Return:
+            Future of the task.
+        """
+        self._raise_errors()
+
+        self._slots.acquire()
+        future = self._executor.submit(function, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def close(self):
+        """
+        Function to wait for all the pending tasks to finish.
+        """
+        self._executor.shutdown(wait=True)
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,150 @@
+"""
+This file contains the profiler used for timing the stages of the pipeline. Every module records its stages on the
+shared profiler instance, which does nothing until it is enabled (run.py --profile).
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import json
+import time
+import numpy as np
+
+class Profiler:
+    """
+    Collects per-frame timings of named stages and reports their distribution. Thread-safe, so stages running
+    in the decoding and writing threads can be recorded too.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+        self._frames = defaultdict(float)
+        self._start = time.perf_counter()
+
+    def record(self, name, seconds, frame=None, frames=1):
+        """
+        Function to record the time taken by a stage.
+
+        Parameters:
+            name: Name of the stage.
+            seconds: Time taken.
+            frame: Key of the frame (e.g. its path), the times of all the calls for the same frame are added
+                   up. Meant for stages called once per box.
+            frames: Number of frames processed together by a batched stage, the time is split evenly. Nothing is
+                    recorded for a batch of no frames.
+        """
+        with self._lock:
+            if frame is not None:
+                self._frames[(name, frame)] += seconds
+            elif frames:
+                self._samples[name].extend([seconds / frames] * frames)
+
+    @contextmanager
+    def stage(self, name, frame=None, frames=1):
+        """
+        Context manager timing the code inside it as a stage, see record for the parameters.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, frame, frames)
+
+    def timed(self, name, function):
+        """
+        Function wrapping a function so that every call to it is timed as a stage.
+
+        Parameters:
+            name: Name of the stage.
+            function: Function to be timed.
+        """
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def samples(self, reset=False):
+        """
+        Function to get the per-frame times of every stage, used for merging the profiles of worker processes.
+
+        Parameters:
+            reset: Clear the recorded times.
+
+        Return:
+            Dictionary of stage name to list of times in seconds.
+        """
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+            for (name, _), seconds in self._frames.items():
+                samples.setdefault(name, []).append(seconds)
+
+            if reset:
+                self._samples.clear()
+                self._frames.clear()
+
+        return samples
+
+    def merge(self, samples):
+        """
+        Function to add the times recorded by another profiler.
+
+        Parameters:
+            samples: Output of samples of the other profiler.
+        """
+        with self._lock:
+            for name, values in samples.items():
+                self._samples[name].extend(values)
+
+    def report(self):
+        """
+        Function to summarise the recorded times.
+
+        Return:
+            Dictionary with the wall time and, for every stage, the number of frames, total time and the mean,
+            p50, p95, p99 and max per-frame times in milliseconds.
+        """
+        stages = {}
+        for name, values in sorted(self.samples().items()):
+            values = np.array(values) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stages[name] = {
+                'count': len(values),
+                'total_ms': float(values.sum()),
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99),
+                'max_ms': float(values.max()),
+            }
+
+        return {
+            'wall_time_s': time.perf_counter() - self._start,
+            'stages': stages,
+        }
+
+    def save(self, path):
+        """
+        Function to save the report as a 'json' file and print it as a table.
+
+        Parameters:
+            path: Location of the report.
+        """
+        report = self.report()
+
+        with open(path, "w") as f:
+            f.write(json.dumps(report, indent=4))
+
+        print(f"{'stage':<24}{'frames':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name, stats in report['stages'].items():
+            print(f"{name:<24}{stats['count']:>8}{stats['total_ms'] / 1000:>10.1f}"
+                  f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+        print(f"Profile saved to {path}")
+
+# Profiler shared by all the modules
+profiler = Profiler()
@@ -0,0 +1,91 @@
+"""
+This file contains the blur engine used for hiding faces and license plates. All the regions of a frame are blurred
+in place on the frame's NumPy buffer, with methods whose cost doesn't depend on the blur radius.
+"""
+
+import argparse
+import cv2
+import numpy as np
+
+METHODS = ("box", "downscale", "pixelate", "gaussian")
+
+def parse_radius(radius):
+    """
+    Function to parse a blur radius given on the command line, which is at least one pixel.
+
+    Parameters:
+        radius: Number of pixels.
+    """
+    radius = int(radius)
+    if radius < 1:
+        raise argparse.ArgumentTypeError(f"The blur radius is {radius} pixels, it has to be at least 1.")
+    return radius
+
+def clip_boxes(boxes, shape):
+    """
+    Function to clip bounding boxes to an image and drop the ones left empty.
+
+    Parameters:
+        boxes: Bounding boxes (x1, y1, x2, y2).
+        shape: Resolution (height, width) of the image.
+
+    Return:
+        Integer array of shape (N, 4) of the clipped boxes.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4).astype(int)
+    height, width = shape[:2]
+
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+
+    return boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+
+def blur_region(region, method="box", radius=20):
+    """
+    Function to blur an image region.
+
+    Parameters:
+        region: Image region in OpenCV format.
+        method: 'box' for a separable box blur (running sums), 'downscale' for shrinking the region and
+                scaling it back up, 'pixelate' for the same with blocky upscaling, 'gaussian' for the
+                Gaussian blur, whose cost grows with the radius.
+        radius: Strength of the blur, in pixels.
+
+    Return:
+        Blurred region.
+    """
+    if radius < 1:
+        raise ValueError(f"The blur radius is {radius} pixels, it has to be at least 1.")
+
+    height, width = region.shape[:2]
+
+    if method == "box":
+        return cv2.blur(region, (2 * radius + 1, 2 * radius + 1), borderType=cv2.BORDER_REPLICATE)
+
+    if method in ("downscale", "pixelate"):
+        small = cv2.resize(region, (max(1, width // radius), max(1, height // radius)), interpolation=cv2.INTER_AREA)
+        interpolation = cv2.INTER_LINEAR if method == "downscale" else cv2.INTER_NEAREST
+        return cv2.resize(small, (width, height), interpolation=interpolation)
+
+    if method == "gaussian":
+        return cv2.GaussianBlur(region, (0, 0), radius)
+
+    raise ValueError(f"Unknown blur method {method}, expected one of {', '.join(METHODS)}.")
+
+def blur_regions(image, boxes, method="box", radius=20):
+    """
+    Function to blur all the given regions of an image in place.
+
+    Parameters:
+        image: Image in OpenCV format, modified in place.
+        boxes: Bounding boxes (x1, y1, x2, y2) of the regions, e.g. all the faces and plates of a frame.
+        method: Blur method, see blur_region.
+        radius: Strength of the blur, in pixels.
+
+    Return:
+        The image.
+    """
+    for x1, y1, x2, y2 in clip_boxes(boxes, image.shape):
+        image[y1:y2, x1:x2] = blur_region(image[y1:y2, x1:x2], method, radius)
+
+    return image
@@ -0,0 +1,91 @@
+"""
+This file contains the regions of interest of the cameras. The cameras are rigidly mounted, so parts of every frame
+(the hood of the ego vehicle, the sky, the mounting bracket) never hold a face or a license plate. A camera's region of
+interest is a mask image next to it, camera/<cam>.mask.png, white where faces and plates can appear and black
+elsewhere. The detectors only run on the bounding rectangle of the mask, and detections centred on masked pixels are
+dropped.
+"""
+
+import hashlib
+import os
+import cv2
+import numpy as np
+
+# suffix of the mask of a camera, after the name of the camera
+MASK_SUFFIX = ".mask.png"
+
+def is_mask(path):
+    """
+    Function to tell whether an entry of a camera folder is a mask rather than a camera.
+    """
+    return path.lower().endswith(MASK_SUFFIX)
+
+class RegionOfInterest:
+    """
+    Region of interest of a camera.
+
+    Parameters:
+        mask: Boolean array of the resolution of the frames, True where faces and plates can appear.
+    """
+    def __init__(self, mask):
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            raise ValueError("The mask of the region of interest is empty.")
+
+        self.mask = mask
+        self.box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        self.digest = hashlib.sha1(np.packbits(mask).tobytes() + str(mask.shape).encode()).hexdigest()
+
+    @classmethod
+    def load(cls, currcam):
+        """
+        Function to load the region of interest of a camera.
+
+        Parameters:
+            currcam: Location of the camera, a folder of frames or a video file.
+
+        Return:
+            RegionOfInterest object, NoneType object if the camera has no mask.
+        """
+        path = currcam + MASK_SUFFIX
+        if not os.path.isfile(path):
+            return None
+
+        mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError(f"{path} couldn't be read as an image.")
+
+        return cls(mask > 127)
+
+    def crop(self, frame):
+        """
+        Function to get the bounding rectangle of the region in a frame, the part of the frame the detectors run on.
+
+        Parameters:
+            frame: Frame object of the camera.
+
+        Return:
+            Frame object of the rectangle, see Frame.region.
+        """
+        if frame.shape != self.mask.shape:
+            raise ValueError(f"{frame.path} has a resolution of {frame.shape}, the mask of its camera of {self.mask.shape}.")
+
+        return frame.region(self.box)
+
+    def covers(self, boxes):
+        """
+        Function to tell which boxes are centred in the region.
+
+        Parameters:
+            boxes: Bounding boxes (x1, y1, x2, y2) in the frame.
+
+        Return:
+            Boolean array, True for the boxes to be kept.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        height, width = self.mask.shape
+
+        x = np.clip(((boxes[:, 0] + boxes[:, 2]) / 2).astype(int), 0, width - 1)
+        y = np.clip(((boxes[:, 1] + boxes[:, 3]) / 2).astype(int), 0, height - 1)
+
+        return self.mask[y, x]
@@ -2,22 +2,134 @@
 The file will be detecting and blurring the faces and the license plates for all the frames in a folder.
 """
 
-from detect import detect, change_vehicle_threshold, change_lp_threshold
-from tracking import finding_missing_detections
-from boxes import blurring
-from PIL import Image, ImageFilter
-from retinaface import RetinaFace
-from matplotlib import pyplot as plt
-from centroidtracker import CentroidTracker
+from detect import detect_frames, change_vehicle_threshold, change_lp_threshold, VEHICLE_BATCH_SIZE
+from frame import Frame
+from pipeline import prefetch, background, completed, Writer
+from profiler import profiler
+from regionblur import blur_regions, parse_radius, METHODS
+from detectioncache import detection_cache
+from manifest import RunManifest, MANIFEST_NAME, params_digest
+from annotationstore import AnnotationStore, frame_record, check_name
+from facedetect import detect_faces, BACKENDS
+from keyframes import KeyframeSelector, DuplicateFilter, Propagator, keyframe_windows, dilate
+from video import is_video, video_info, read_video, VideoOutput
+from imageoutput import ImageEncoder, FORMATS, parse_quality
+from roi import RegionOfInterest, is_mask
+from framering import FrameProcesses
+from collections import deque
+from contextlib import nullcontext
+import detect
+import hashlib
+from centroidtracker import CentroidTracker, COSTS
 import json
+import multiprocessing as mp
 import os 
 import cv2 
-import pathlib
 import time
 import numpy as np
 import argparse
 
+#Pick overlapping plates by confidence instead of by bottom coordinate during NMS
+NMS_BY_SCORE = False
+
+#Blur method and strength for faces and plates, see regionblur
+BLUR_METHOD = "box"
+BLUR_RADIUS = 20
+
+#Face detector, its confidence threshold and the scales of the frame it runs on (see facedetect)
+FACE_BACKEND = "retinaface"
+FACE_THRESHOLD = 0.5
+FACE_SCALES = (1.0,)
+
+#Detection cache file and its maximum size in MB, detections aren't cached if there is no file
+CACHE_PATH = None
+CACHE_SIZE_MB = 10240
+
+#Only process the frames which are new, changed or stale according to the run manifest of the dataset
+RESUME = True
+
+#Plates are matched to the tracked ones by the distance between centroids ("centroid") or by overlap ("iou")
+TRACKER_COST = "centroid"
+
+#Detectors only run on keyframes: one frame every KEYFRAME_INTERVAL frames (every frame if 1), or a frame differing from
+#the last keyframe by more than SCENE_CHANGE_THRESHOLD. Boxes moved to the frames in between grow by KEYFRAME_MARGIN
+KEYFRAME_INTERVAL = 1
+SCENE_CHANGE_THRESHOLD = 0.15
+KEYFRAME_MARGIN = 0.15
+
+#Keyframes differing from the last frame the detectors ran on by at most DUPLICATE_TOLERANCE reuse its annotations
+#(see keyframes.DuplicateFilter), every keyframe is detected if None
+DUPLICATE_TOLERANCE = None
+
+#Annotations of a camera are kept in a single annotation store ("store"), or in a 'json' file per frame ("json")
+ANNOTATIONS = "store"
+
+#FourCC code of the blurred videos, for cameras which are video files
+VIDEO_CODEC = "mp4v"
+
+#Format and quality of the blurred frames (see imageoutput), frames without anything to blur can be hard-linked or
+#copied from their source file instead of being encoded again
+IMAGE_FORMAT = "png"
+IMAGE_QUALITY = None
+PASS_THROUGH = False
+
+#Number of threads writing the outputs, and number of outputs which can wait for them
+OUTPUT_WORKERS = 2
+OUTPUT_QUEUE = 16
+
+#Number of decoder processes and of encoder processes of a camera, which share the frames with the detector through
+#shared memory (see framering). Frames are decoded and encoded by threads of the detector's process if 0
+FRAME_PROCESSES = 0
+
+#Module level settings which are passed on to worker processes
+SETTINGS = ("NMS_BY_SCORE", "BLUR_METHOD", "BLUR_RADIUS", "FACE_BACKEND", "FACE_THRESHOLD", "FACE_SCALES", "CACHE_PATH", "CACHE_SIZE_MB", "RESUME", "ANNOTATIONS", "TRACKER_COST",
+            "KEYFRAME_INTERVAL", "SCENE_CHANGE_THRESHOLD", "KEYFRAME_MARGIN", "DUPLICATE_TOLERANCE", "VIDEO_CODEC",
+            "IMAGE_FORMAT", "IMAGE_QUALITY", "PASS_THROUGH", "OUTPUT_WORKERS", "OUTPUT_QUEUE", "FRAME_PROCESSES")
+
 #NMS for best bounding box
+def batched_nms(boxes, overlapThresh, groups=None, scores=None):
+    """
+    Function implementing non max suppression for all the license plates detected in a frame at once. Boxes
+    only suppress boxes of the same group (e.g. of the same vehicle). The overlaps of all pairs of boxes are
+    computed in one go, and a box suppresses the boxes covered by it more than the threshold.
+
+    Parameters:
+        boxes: Bounding boxes, array of shape (N, 4)
+        overlapThresh: Threshold for overlapping
+        groups: Group of every box, all boxes are in the same group if not given
+        scores: Confidence of every box. If given, boxes are picked by decreasing confidence, else by
+                decreasing bottom coordinate
+
+    Return:
+        Indices of the boxes kept, in the order they were picked
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=int)
+
+    x1, y1, x2, y2 = boxes.T
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    #Overlap of every pair, as a fraction of the area of the second box
+    w = np.maximum(0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]) + 1)
+    h = np.maximum(0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]) + 1)
+    suppress = (w * h) / area[None, :] > overlapThresh
+
+    if groups is not None:
+        groups = np.asarray(groups)
+        suppress &= groups[:, None] == groups[None, :]
+
+    order = np.argsort(scores if scores is not None else y2, kind="stable")[::-1]
+
+    pick = []
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    for i in order:
+        if not suppressed[i]:
+            pick.append(i)
+            suppressed |= suppress[i]
+
+    return np.array(pick, dtype=int)
+
 def non_max_suppression_fast(boxes, overlapThresh):
     """
     Function implementing non max suppression for reducing number of license plates detected in a 
@@ -28,228 +140,596 @@ def non_max_suppression_fast(boxes, overlapThresh):
         overlapThresh: Threshold for overlapping
     
     Return:
-        Single bounding box after NMS
+        Bounding boxes after NMS
     """
-    try:
-        if len(boxes) == 0:
-            return []
+    if len(boxes) == 0:
+        return []
 
-        if boxes.dtype.kind == "i":
-            boxes = boxes.astype("float")
+    return np.asarray(boxes)[batched_nms(boxes, overlapThresh)].astype("int")
 
-        pick = []
+#Blur the detections
+def blur_image(blur, x1, y1, x2, y2):
+    """
+    Function to blur detected objects of image given its bounding boxes
 
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
+    Parameters:
+        blur: Writable copy of the frame in OpenCV format
+        x1, y1, x2, y2 : Bounding box coordinates
 
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-        idxs = np.argsort(y2)
+    Return:
+        None, blurs the bbox patch in place
+    """
+    blur_regions(blur, [(x1, y1, x2, y2)], BLUR_METHOD, BLUR_RADIUS)
 
-        while len(idxs) > 0:
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
+#Write the annotations
+def save_annotation(annot_path, frame, result):
+    """
+    Function to save the annotations of a frame as a 'json' file named after the frame
 
-            xx1 = np.maximum(x1[i], x1[idxs[:last]])
-            yy1 = np.maximum(y1[i], y1[idxs[:last]])
-            xx2 = np.minimum(x2[i], x2[idxs[:last]])
-            yy2 = np.minimum(y2[i], y2[idxs[:last]])
+    Parameters:
+        annot_path: Directory of the annotation files
+        frame: Frame object the annotations belong to
+        result: Annotations of the frame
 
-            w = np.maximum(0, xx2 - xx1 + 1)
-            h = np.maximum(0, yy2 - yy1 + 1)
+    Return:
+        Path, size and checksum of the annotation file
+    """
+    path = os.path.join(annot_path, f"{frame.stem}.json")
+    data = json.dumps(result).encode()
 
-            overlap = (w * h) / area[idxs[:last]]
+    with open(path, "wb") as f:
+        f.write(data)
 
-            idxs = np.delete(idxs, np.concatenate(([last],
-                                                   np.where(overlap > overlapThresh)[0])))
+    return path, len(data), hashlib.sha1(data).hexdigest()
 
-        return boxes[pick].astype("int")
-    except Exception as e:
-        print("Exception occurred in non_max_suppression : {}".format(e))
+#Parameters of a run
+def run_parameters():
+    """
+    Function to get every parameter the outputs of a frame depend on, frames processed with other parameters
+    are stale
 
-#Blur the detections
-def blur_image(blur, x1, y1, x2, y2):
+    Return:
+        Dictionary of parameters
     """
-    Function to blur detected objects of image given its bounding boxes
+    return {
+        'vehicle_model': detect.model_digest(detect.VEHICLE_DETECTOR_CFG, detect.VEHICLE_DETECTOR_WEIGHTS),
+        'vehicle_threshold': detect.VEHICLE_DETECTOR_THRESHOLD,
+        'lp_model': detect.model_digest(detect.LP_DETECTOR_CFG, detect.LP_DETECTOR_WEIGHTS),
+        'lp_threshold': detect.LP_THRESHOLD,
+        'faces': [FACE_BACKEND, FACE_THRESHOLD, list(FACE_SCALES)],
+        'nms_by_score': NMS_BY_SCORE,
+        'blur': [BLUR_METHOD, BLUR_RADIUS],
+        'annotations': ANNOTATIONS,
+        'tracker': ["optimal", TRACKER_COST],
+        'keyframes': [KEYFRAME_INTERVAL, SCENE_CHANGE_THRESHOLD, KEYFRAME_MARGIN],
+        'duplicates': DUPLICATE_TOLERANCE,
+        'video_codec': VIDEO_CODEC,
+        'image': [IMAGE_FORMAT, IMAGE_QUALITY, PASS_THROUGH],
+    }
+
+#Detect and track the faces and plates of a frame
+def annotate_frame(frame, plates, tracker, roi=None):
+    """
+    Function to detect faces in a frame and track its license plates
 
     Parameters:
-        blur: Image instance 
-        x1, y1, x2, y2 : Bounding box coordinates
+        frame: Frame object
+        plates: License plates detected in the frame, or in the region of interest of the frame if there is one
+        tracker: Tracker for the license plates
+        roi: RegionOfInterest of the camera, faces and plates are only detected in it
+
+    Return:
+        Face annotations and license plate annotations of the frame
+    """
+    #Detections in the region of interest are moved back to the frame
+    region = roi.crop(frame) if roi is not None else frame
+    offset = np.tile(region.offset, 2)
+
+    #Face detection
+    faces = detect_faces(region, FACE_THRESHOLD, FACE_BACKEND, FACE_SCALES)
+
+    #Face annotations
+    face_result = {}
+    for face in faces:
+        #Faces detected
+        if(len(face) != 0):
+            box = (np.array(faces[face]['facial_area']).astype(int) + offset).tolist()
+            if roi is not None and not roi.covers([box])[0]:
+                continue
+
+            face_result[face] = {
+                'Confidence': faces[face]['score'],
+                'Bounding box': box
+            } 
+
+    #License plate annotations
+    lic_result = {}
+    if plates is not None: 
+
+        #All the candidate plates of the frame, along with their vehicles
+        boxes = []
+        scores = []
+        vehicle_ids = []
+        for vehicles in plates:
+            for detections in plates[vehicles]:
+                boxes.append(plates[vehicles][detections]['bounding box'])
+                scores.append(float(plates[vehicles][detections]['confidence']))
+                vehicle_ids.append(vehicles)
+
+        #NMS for every vehicle at once, on the plates centred in the region of interest
+        boundingboxes = np.array(boxes).astype(int).reshape(-1, 4) + offset
+        scores = np.array(scores)
+        vehicle_ids = np.array(vehicle_ids)
+        if roi is not None:
+            inside = roi.covers(boundingboxes)
+            boundingboxes, scores, vehicle_ids = boundingboxes[inside], scores[inside], vehicle_ids[inside]
+        with profiler.stage("nms", frame=frame.path):
+            keep = batched_nms(boundingboxes, 0.3, groups=vehicle_ids, scores=scores if NMS_BY_SCORE else None)
+
+        #Track all the plates of the frame at once
+        with profiler.stage("tracker update", frame=frame.path):
+            objectIds = tracker.track(boundingboxes[keep])
+
+        #License plates
+        for objectId, box, vehicles, confidence in zip(objectIds.tolist(), boundingboxes[keep].tolist(),
+                                                       vehicle_ids[keep].tolist(), scores[keep].tolist()):
+            lic_result.setdefault(vehicles, {})[objectId] = {
+                'Confidence': confidence,
+                'Bounding box': [box],
+            }
+
+    return face_result, lic_result
+
+#Blur and save a frame
+def save_frame(frame, face_result, lic_result, face_path, lic_path, blur_folder_path, visualize, writer=None, store=None, video=None, encoder=None, shared=None, source=None):
+    """
+    Function to blur the faces and license plates of a frame and save the annotations along with the
+    blurred frame
+
+    Parameters:
+        frame: Frame object
+        face_result, lic_result: Face and license plate annotations of the frame
+        face_path, lic_path: Directories for face and license plate annotations
+        blur_folder_path: Directory for blurred frames
+        visualize: Show the detections instead of saving the blurred frame
+        writer: Writer saving the annotations and the blurred frame in the background, they are saved
+                right away if it isn't given
+        store: Annotation store of the camera, the annotations are saved as 'json' files in face_path and
+               lic_path if it isn't given
+        video: VideoOutput the blurred frame is appended to, it is saved as an image in blur_folder_path if it
+               isn't given
+        encoder: ImageEncoder of the blurred frame, PNG with OpenCV's default compression if it isn't given
+        shared: FrameProcesses the frame comes from, its encoder processes blur and save the frame
+        source: File name of the frame the annotations were reused from, NoneType object if they were detected
+                in the frame. Without an annotation store, the record of the frame (see annotationstore.frame_record)
+                is saved in the 'frames' folder next to the 'faces' folder of face_path
 
     Return:
-        None, blurs the bbox patch and pastes it onto the image instance
+        List of futures of the files written for the frame, each one giving their path, size and checksum
     """
-    face = blur.crop((x1, y1, x2, y2))
-    face_blur = face.filter(ImageFilter.GaussianBlur(radius=20))
-    blur.paste(face_blur, (x1, y1, x2, y2))
+    #Output tasks go to the background writer if there is one
+    write = writer.submit if writer is not None else completed
+    outputs = []
+
+    #Regions to be blurred, all of them are blurred together at the end
+    blur_boxes = [face['Bounding box'] for face in face_result.values()]
+    blur_boxes += [box for objects in lic_result.values() for plate in objects.values() for box in plate['Bounding box']]
+
+    if store is not None:
+        store.append(frame.name, face_result, lic_result, source)
+    else:
+        frame_path = os.path.join(os.path.dirname(os.path.dirname(face_path)), "frames", os.path.basename(face_path))
+        outputs.append(write(profiler.timed("annotation write", save_annotation), face_path, frame, face_result))
+        outputs.append(write(profiler.timed("annotation write", save_annotation), lic_path, frame, lic_result))
+        outputs.append(write(profiler.timed("annotation write", save_annotation), frame_path, frame, frame_record(source)))
+
+    if visualize:
+        dt = frame.copy()
+
+        #Coordinates of faces
+        for face in face_result.values():
+            x1, y1, x2, y2 = [int(point) for point in face['Bounding box']]
+            cv2.rectangle(dt, (x1, y1), (x2, y2), (255, 0, 0), 2)
+
+        #Coordinates of plates
+        for objects in lic_result.values():
+            for objectId, plate in objects.items():
+                for box in plate['Bounding box']:
+                    x1, y1, x2, y2 = [int(point) for point in box]
+                    cv2.rectangle(dt, (x1, y1), (x2, y2), (0, 0, 255), 2)
+                    text = "ID: {}".format(objectId)
+                    cv2.putText(dt, text, (x1, y1-5), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (0, 0, 255), 1)
+
+        # Visualization
+        from matplotlib import pyplot as plt
+        plt.figure(figsize=(20, 20))
+        plt.imshow(dt[:, :, ::-1])
+        plt.show()
+    elif video is None and not blur_boxes and encoder is not None and encoder.passes(frame.path):
+        #Nothing to blur, the source frame is saved untouched
+        outputs.append(write(profiler.timed("image save", encoder.link), frame.path, encoder.path(blur_folder_path, frame.stem)))
+    elif shared is not None and video is None:
+        #Blurred and saved by the encoder processes, straight from shared memory
+        encoder = encoder or ImageEncoder()
+        outputs.append(shared.encode(frame, blur_boxes, encoder.path(blur_folder_path, frame.stem), encoder, BLUR_METHOD, BLUR_RADIUS))
+    else:
+        #Blur the faces and plates
+        blur = frame.copy()
+        with profiler.stage("blur"):
+            blur_regions(blur, blur_boxes, BLUR_METHOD, BLUR_RADIUS)
+
+        # Save the image
+        if video is not None:
+            video.write(blur)
+        else:
+            encoder = encoder or ImageEncoder()
+            outputs.append(write(profiler.timed("image save", encoder.save), encoder.path(blur_folder_path, frame.stem), blur))
+
+    return outputs
+
+#Reuse the faces and plates of the last detected frame
+def reuse(face_result, lic_result):
+    """
+    Function to copy the annotations of the last frame the detectors ran on to a near duplicate of it
+
+    Parameters:
+        face_result, lic_result: Face and license plate annotations of the last frame the detectors ran on
+
+    Return:
+        Face and license plate annotations of the near duplicate, with the confidences of the detections
+    """
+    faces = {}
+    for face in face_result:
+        faces[face] = {
+            'Confidence': face_result[face]['Confidence'],
+            'Bounding box': list(face_result[face]['Bounding box']),
+        }
+
+    plates = {}
+    for vehicles in lic_result:
+        for objectId in lic_result[vehicles]:
+            plates.setdefault(vehicles, {})[objectId] = {
+                'Confidence': lic_result[vehicles][objectId]['Confidence'],
+                'Bounding box': [list(box) for box in lic_result[vehicles][objectId]['Bounding box']],
+            }
+
+    return faces, plates
+
+#Move the faces and plates of the last keyframe to the frames up to the next one
+def propagate(motion, face_result, lic_result, tracker, length, bounds):
+    """
+    Function to estimate the faces and license plates of the frames between two keyframes
+
+    Parameters:
+        motion: Propagator of the faces and Propagator of the plates
+        face_result, lic_result: Annotations of the next keyframe, NoneType objects if there is no next keyframe
+        tracker: Tracker for the license plates, its "faces" stream tracks the faces from a keyframe to the next
+        length: Number of frames from the last keyframe to the next one
+        bounds: Rectangle (x1, y1, x2, y2) the boxes are clipped to, the frame or its region of interest
+
+    Return:
+        List of face and license plate annotations of every frame in between, with a confidence of -2. Unlike the
+        plates filled by the postprocessing (confidence -1), they are blurred in the saved frames already
+    """
+    face_motion, plate_motion = motion
+
+    face_boxes, face_ids = [], []
+    plate_boxes, plate_ids, vehicle_ids = [], [], []
+    if face_result is not None:
+        face_boxes = [face['Bounding box'] for face in face_result.values()]
+        face_ids = tracker.track(face_boxes, stream="faces")
+
+        for vehicles in lic_result:
+            for objectId in lic_result[vehicles]:
+                plate_boxes.append(lic_result[vehicles][objectId]['Bounding box'][0])
+                plate_ids.append(objectId)
+                vehicle_ids.append(vehicles)
+
+    faces = face_motion.segment(face_ids, face_boxes, [None] * len(face_boxes), length)
+    plates = plate_motion.segment(plate_ids, plate_boxes, vehicle_ids, length)
+
+    #Estimated boxes are dilated, and clipped to the frame or its region of interest
+    def box(estimate):
+        x1, y1, x2, y2 = dilate(estimate, KEYFRAME_MARGIN)[0].round().astype(int).tolist()
+        return [max(x1, bounds[0]), max(y1, bounds[1]), min(x2, bounds[2]), min(y2, bounds[3])]
+
+    results = []
+    for frame_faces, frame_plates in zip(faces, plates):
+        between_faces = {}
+        for i, (_, _, estimate) in enumerate(frame_faces):
+            between_faces[f"face_{i + 1}"] = {
+                'Confidence': -2,
+                'Bounding box': box(estimate),
+            }
+
+        between_plates = {}
+        for vehicles, objectId, estimate in frame_plates:
+            between_plates.setdefault(vehicles, {})[objectId] = {
+                'Confidence': -2,
+                'Bounding box': [box(estimate)],
+            }
+
+        results.append((between_faces, between_plates))
+
+    return results
+
+#Output folders
+def prepare_sequence(currdir):
+    """
+    Function to create the privacy and annotation folders of a sequence
+
+    Parameters:
+        currdir: Directory of the sequence
+    """
+    #Create privacy folder
+    privacy_folder_path = os.path.join(currdir, "privacy")
+    if not os.path.exists(privacy_folder_path):
+        os.mkdir(privacy_folder_path)
+
+    #Create folder to store annotations
+    annotations = os.path.join(currdir, "annotations")
+    if not os.path.exists(annotations):
+        os.mkdir(annotations)
+    
+    #Create folders for plates and faces
+    license_path = os.path.join(currdir, os.path.join("annotations", "license-plates"))
+    if not os.path.exists(license_path):
+        os.mkdir(license_path)
+
+    faces_path = os.path.join(currdir, os.path.join("annotations", "faces"))
+    if not os.path.exists(faces_path):
+        os.mkdir(faces_path) 
+
+    #Create folder for the records of the frames, telling whether their annotations were reused
+    frames_path = os.path.join(currdir, os.path.join("annotations", "frames"))
+    if not os.path.exists(frames_path):
+        os.mkdir(frames_path)
+
+#Process a camera
+def run_camera(currdir, cam, visualize=False):
+    """
+    Function to process all the frames of a camera of a sequence, in order. Every camera has its own tracker,
+    so cameras can be processed independently of each other. A camera which is a video file is decoded as a
+    stream and its blurred frames are encoded in a video of the same name in the privacy folder. A camera with a
+    mask (see roi) is only searched for faces and plates in its region of interest
+
+    Parameters:
+        currdir: Directory of the sequence, prepared with prepare_sequence
+        cam: Name of the camera, a folder of frames or a video file
+        visualize: Show the detections instead of saving the blurred frames
+
+    Return:
+        Number of frames processed
+    """
+    #Object tracking
+    tracker = CentroidTracker(maxDisappeared=20, maxDistance=90, cost=TRACKER_COST)
+
+    if CACHE_PATH is not None:
+        detection_cache.open(CACHE_PATH, CACHE_SIZE_MB)
+
+    currcam = os.path.join(currdir, "camera", cam)
+    video = is_video(currcam)
+
+    #Region of interest of the camera, the detectors run on its bounding rectangle only
+    roi = RegionOfInterest.load(currcam)
+    crop = roi.crop if roi is not None else (lambda frame: frame)
+    bounds = lambda frame: roi.box if roi is not None else (0, 0, frame.shape[1], frame.shape[0])
+
+    #Create directory to store blurred images, a video camera is saved as a single video instead
+    blur_folder_path = os.path.join(currdir, "privacy", cam)
+    if not video and not os.path.exists(blur_folder_path):
+        os.mkdir(blur_folder_path)
+
+    #Create directories to store annotations
+    lic_path = os.path.join(currdir, "annotations", "license-plates", cam)
+    face_path = os.path.join(currdir, "annotations", "faces", cam)
+    frame_path = os.path.join(currdir, "annotations", "frames", cam)
+
+    store = None
+    if ANNOTATIONS == "store":
+        store = AnnotationStore(os.path.join(currdir, "annotations", cam))
+    else:
+        for path in (lic_path, face_path, frame_path):
+            if not os.path.exists(path):
+                os.mkdir(path)
+
+    #Frames are processed in order, a window at a time, so that the networks run in batches
+    if video:
+        #A video is recorded in the manifest as a whole, it can't be resumed in the middle of its output
+        frame_paths = [currcam]
+    else:
+        frame_files = sorted(frame_file for frame_file in os.listdir(currcam) if os.path.isfile(os.path.join(currcam, frame_file)))
+        frame_paths = [os.path.join(currcam, frame_file) for frame_file in frame_files]
+
+        #Names too long for the store are rejected before any frame is processed
+        if store is not None:
+            for frame_file in frame_files:
+                check_name(frame_file)
+
+    #Skip the frames which are up to date, and resume tracking where it was left
+    manifest = None
+    if RESUME and not visualize:
+        manifest = RunManifest(os.path.join(os.path.dirname(currdir), MANIFEST_NAME))
+        camera_key = f"{os.path.basename(currdir)}/{cam}"
+        params = params_digest({**run_parameters(), 'roi': roi.digest if roi is not None else None})
+
+        start, state = manifest.resume_point(camera_key, frame_paths, params, None if video else store)
+        if state is not None:
+            tracker.restore_states(state)
+        if start:
+            print(f"{cam} is up to date" if video else f"{start} frames of {cam} are up to date")
+
+        frame_paths = frame_paths[start:]
+
+    #Blurred frames are encoded by the output threads
+    encoder = ImageEncoder(IMAGE_FORMAT, IMAGE_QUALITY, PASS_THROUGH)
+
+    #Frames whose outputs are being written, recorded in the manifest in order once their outputs are written
+    pending = deque()
+
+    #Outputs of a video, recorded once the whole video is written
+    video_outputs = []
+    processed = 0
+
+    def record(wait=False):
+        entries = []
+        while pending and (wait or all(output.done() for output in pending[0][1])):
+            path, outputs, state = pending.popleft()
+            entries.append((path, [output.result() for output in outputs], state))
+        manifest.record(camera_key, entries, params)
+
+    #Frames are decoded ahead in the background and outputs are written in the background, both overlapping with inference
+    blurred_video = None
+    shared = None
+    #Workers of the scheduler's pool can't start processes of their own, their cameras use threads
+    if not video and FRAME_PROCESSES > 0 and frame_paths and not visualize and not mp.current_process().daemon:
+        #The detector holds the frames of a window at most, every keyframe and the frames before it
+        shared = FrameProcesses(frame_paths, VEHICLE_BATCH_SIZE * (KEYFRAME_INTERVAL + 2) + 2 * FRAME_PROCESSES, FRAME_PROCESSES, FRAME_PROCESSES)
+        frames = shared.frames()
+    elif not video:
+        frames = prefetch(frame_paths, profiler.timed("decode", Frame), depth=2 * VEHICLE_BATCH_SIZE)
+    elif frame_paths:
+        frames = background(read_video(currcam), depth=2 * VEHICLE_BATCH_SIZE)
+        if not visualize:
+            blurred_video = VideoOutput(blur_folder_path, video_info(currcam)[0], VIDEO_CODEC)
+    else:
+        frames = []
+
+    #Keyframes, and faces and plates moved from one keyframe to the next
+    selector = KeyframeSelector(KEYFRAME_INTERVAL, SCENE_CHANGE_THRESHOLD)
+    motion = (Propagator(), Propagator())
+
+    #Near duplicates of the last frame the detectors ran on, and the name and annotations of that frame
+    duplicates = DuplicateFilter(DUPLICATE_TOLERANCE) if DUPLICATE_TOLERANCE is not None else (lambda frame: False)
+    detected = None
+
+    #Frames since the last keyframe, and state of every tracker stream after the last keyframe
+    between = []
+    state = tracker.states()
+
+    with Writer(OUTPUT_WORKERS, OUTPUT_QUEUE) as writer, shared or nullcontext():
+        def finish(frame, face_result, lic_result, state, source=None):
+            nonlocal processed
+            processed += 1
+
+            outputs = save_frame(frame, face_result, lic_result, face_path, lic_path, blur_folder_path, visualize, writer, store, blurred_video, encoder, shared, source)
+            if shared is not None:
+                shared.release(frame)
+            if manifest is not None:
+                if video:
+                    video_outputs.extend(outputs)
+                else:
+                    pending.append((frame.path, outputs, state))
+
+            print(f"{frame.name} has been processed")
+
+        def flush():
+            #Annotations of the window are written together, before the frames are recorded
+            if store is not None:
+                with profiler.stage("annotation write"):
+                    store.flush()
+
+            if manifest is not None and not video:
+                record()
+
+        #Scene changes are looked for in the region of interest, the rest of the frames doesn't change
+        for window in keyframe_windows(frames, lambda frame: selector(crop(frame)), VEHICLE_BATCH_SIZE):
+            #Keyframes which are near duplicates skip the detectors
+            with profiler.stage("duplicate check"):
+                reused = [key and duplicates(crop(frame)) for frame, key in window]
+
+            #License plate detection, on the keyframes only. A window may have none, e.g. at the end of the frames
+            keyframes = [crop(frame) for (frame, key), same in zip(window, reused) if key and not same]
+            window_plates = iter(detect_frames(keyframes) if keyframes else [])
+
+            for (frame, key), same in zip(window, reused):
+                if not key:
+                    between.append(frame)
+                    continue
+
+                source = None
+                if same:
+                    source = detected[0]
+                    face_result, lic_result = reuse(*detected[1:])
+                else:
+                    face_result, lic_result = annotate_frame(frame, next(window_plates), tracker, roi)
+                    detected = frame.name, face_result, lic_result
+
+                if KEYFRAME_INTERVAL > 1:
+                    #Also run on the first keyframe, which has no frames before it, to start the motion of its boxes
+                    with profiler.stage("propagation", frames=len(between)) if between else nullcontext():
+                        results = propagate(motion, face_result, lic_result, tracker, len(between) + 1, bounds(frame))
+                    for between_frame, (between_faces, between_plates) in zip(between, results):
+                        finish(between_frame, between_faces, between_plates, state)
+                    between = []
+
+                state = tracker.states()
+                finish(frame, face_result, lic_result, state, source)
+
+            flush()
+
+        #Frames after the last keyframe
+        if between:
+            for between_frame, (between_faces, between_plates) in zip(between, propagate(motion, None, None, tracker, len(between) + 1, bounds(between[0]))):
+                finish(between_frame, between_faces, between_plates, state)
+            flush()
+
+    #Wait for the end of the video
+    if blurred_video is not None:
+        with profiler.stage("video write"):
+            written = blurred_video.close()
+        if written is not None:
+            video_outputs.append(completed(lambda: written))
+
+    if store is not None:
+        store.close()
+
+    if manifest is not None:
+        if video and frame_paths:
+            pending.append((currcam, video_outputs, tracker.states()))
+        record(wait=True)
+        manifest.close()
+
+    return processed
 
 #Main script
-def run(dataset, visualize):
+def run(dataset, visualize, workers=1):
     """
     Main script for object detection
+
+    Parameters:
+        dataset: Name of dataset folder
+        visualize: Show the detections instead of saving the blurred frames
+        workers: Number of worker processes, the cameras are spread over them if it is more than one
     """
     start  = time.time()
 
-    #Object tracking
-    tracker = CentroidTracker(maxDisappeared=20, maxDistance=90)
-
     #Path
     root = os.path.join(os.getcwd(), dataset)
 
-    #Iterate through root directory
-    for dir in os.listdir(root):
-
-        #Current directory
-        currdir = os.path.join(root, dir)
-
-        #Create privacy folder
-        privacy_folder_path = os.path.join(currdir, "privacy")
-        if not os.path.exists(privacy_folder_path):
-            os.mkdir(privacy_folder_path)
-
-        #Camera folder
-        camera = os.path.join(currdir, "camera")
-
-        #Create folder to store annotations
-        annotations = os.path.join(currdir, "annotations")
-        if not os.path.exists(annotations):
-            os.mkdir(annotations)
-        
-        #Create folders for plates and faces
-        license_path = os.path.join(currdir, os.path.join("annotations", "license-plates"))
-        if not os.path.exists(license_path):
-            os.mkdir(license_path)
-
-        faces_path = os.path.join(currdir, os.path.join("annotations", "faces"))
-        if not os.path.exists(faces_path):
-            os.mkdir(faces_path) 
-
-        #Iterate through 'cam' directories
-        for cam in os.listdir(camera):
-            currcam = os.path.join(camera, cam)
-
-            #Create directory to store blurred images
-            blur_folder_path = os.path.join(privacy_folder_path, cam)
-            if not os.path.exists(blur_folder_path):
-                os.mkdir(blur_folder_path)
-
-            #Create directories to store annotations
-            lic_path = os.path.join(license_path, cam)
-            if not os.path.exists(lic_path):
-                os.mkdir(lic_path)
-
-            face_path = os.path.join(faces_path, cam)
-            if not os.path.exists(face_path):
-                os.mkdir(face_path)
-
-            for frame in os.listdir(currcam):
-                #Image path
-                frame_path = os.path.join(currcam, frame)
-                file_name = pathlib.Path(frame_path).stem
-
-                #Open the image
-                if os.path.isfile(frame_path):
-                    dt = cv2.imread(frame_path)
-                    blur = Image.open(frame_path)
-
-                #License plate detection
-                plates = detect(frame_path, lic_path)
-
-                #Face detection
-                faces = RetinaFace.detect_faces(frame_path, threshold=0.5) 
-
-                #Face annotations
-                face_result = {}
-                for face in faces:
-                    #Faces detected
-                    if(len(face) != 0):
-                    
-                        #If detected
-                        detection = faces[face]
-
-                        #Coordinates
-                        facial_area = detection['facial_area']
-                        x1, y1 = facial_area[0], facial_area[1]
-                        x2, y2 = facial_area[2], facial_area[3]
-
-                        #Coordinates of face
-                        cv2.rectangle(dt, (x1, y1), (x2, y2), (255, 0, 0), 2)
-
-                        #Blur the face
-                        blur_image(blur, x1, y1, x2, y2)
-
-                        #Annotations
-                        face_result[face] = {
-                            'Confidence': faces[face]['score'],
-                            'Bounding box': [int(point) for point in faces[face]['facial_area']]
-                        } 
-                        
-                    with open(f"{face_path}/{file_name}.json", "w") as f:
-                        f.write(json.dumps(face_result))
-
-                    #License plate annotations
-                    lic_result = {}
-                    if plates is not None: 
-
-                        #License plates
-                        for vehicles in plates:
-                            boxes = []
-                            confidence = 0
-                            for detections in plates[vehicles]:
-                                for bbox in plates[vehicles][detections]:
-                                    if bbox != "confidence":
-                                        boxes.append(plates[vehicles][detections][bbox])
-                                    else:
-                                        confidence = max(confidence, float(plates[vehicles][detections][bbox])) 
-
-                            #NMS
-                            boundingboxes = np.array(boxes)
-                            boundingboxes = boundingboxes.astype(int)
-                            box = non_max_suppression_fast(boundingboxes, 0.3)
-
-                            objects = tracker.update(box)
-                            for (objectId, bbox) in objects.items():
-                                x1, y1, x2, y2 = bbox
-                                x1 = int(x1)
-                                y1 = int(y1)
-                                x2 = int(x2)
-                                y2 = int(y2)
-
-                                #Coordinates of plate
-                                cv2.rectangle(dt, (x1, y1), (x2, y2), (0, 0, 255), 2)
-                                text = "ID: {}".format(objectId)
-                                cv2.putText(dt, text, (x1, y1-5), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (0, 0, 255), 1)
-
-                                #Blur the plate
-                                blur_image(blur, x1, y1, x2, y2)
-
-                                #Annotations
-                                lic_result[vehicles] = {
-                                    objectId: {
-                                        'Confidence': confidence,
-                                        'Bounding box': box.tolist(),
-                                    }
-                                }
-
-                    with open(f"{lic_path}/{file_name}.json", "w") as f:
-                        f.write(json.dumps(lic_result))
-
-                    if visualize:
-                        # Visualization
-                        plt.figure(figsize=(20, 20))
-                        plt.imshow(dt[:, :, ::-1])
-                        plt.show()
-                    else:
-                        # Save the image
-                        blur.save(f"{blur_folder_path}\{file_name}.png")
-
-                print(f"{frame} has been processed")
-
-            print(f"Detection for {cam} of {dir} has been completed")
-        
-        print(f"Detection for {dir} has been completed")
+    if workers > 1 and not visualize:
+        from scheduler import schedule
+        settings = {name: globals()[name] for name in SETTINGS}
+        schedule(root, workers, profile=profiler.enabled, settings=settings)
+    else:
+        #Iterate through root directory
+        for dir in os.listdir(root):
+
+            #Current directory
+            currdir = os.path.join(root, dir)
+            if not os.path.isdir(os.path.join(currdir, "camera")):
+                continue
+            prepare_sequence(currdir)
+
+            #Iterate through 'cam' directories
+            for cam in os.listdir(os.path.join(currdir, "camera")):
+                if is_mask(cam):
+                    continue
+                run_camera(currdir, cam, visualize)
+
+                print(f"Detection for {cam} of {dir} has been completed")
+            
+            print(f"Detection for {dir} has been completed")
 
     #Training/testing time
     end = time.time()
@@ -263,6 +743,30 @@ if __name__ == "__main__":
 
     parser.add_argument("--visualize", help="Visualize results of detections", action="store_true")
     parser.add_argument("--data", help="Name of dataset folder")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each one loads its own copy of the models")
+    parser.add_argument("--nms_by_score", help="Keep the most confident of overlapping plates instead of the lowest one", action="store_true")
+    parser.add_argument("--blur", choices=METHODS, default=BLUR_METHOD, help=f"Blur method for faces and plates (default {BLUR_METHOD})")
+    parser.add_argument("--blur_radius", type=parse_radius, default=BLUR_RADIUS, help=f"Strength of the blur in pixels (default {BLUR_RADIUS})")
+    parser.add_argument("--cache", help="Detection cache file, reruns on the same frames with the same models and thresholds skip inference")
+    parser.add_argument("--cache_size", type=int, default=CACHE_SIZE_MB, help=f"Maximum size of the detection cache in MB (default {CACHE_SIZE_MB})")
+    parser.add_argument("--tracker_cost", choices=COSTS, default=TRACKER_COST, help=f"Match plates to the tracked ones by centroid distance or by overlap (default {TRACKER_COST})")
+    parser.add_argument("--face_detector", choices=list(BACKENDS), default=FACE_BACKEND, help=f"Face detector (default {FACE_BACKEND})")
+    parser.add_argument("--face_threshold", type=float, default=FACE_THRESHOLD, help=f"Confidence threshold of the face detector (default {FACE_THRESHOLD})")
+    parser.add_argument("--face_scales", type=float, nargs="+", default=FACE_SCALES, help="Scales of the frame the face detector runs on, e.g. 0.5 for half the resolution (default 1)")
+    parser.add_argument("--keyframe_interval", type=int, default=KEYFRAME_INTERVAL, help="Run the detectors every this many frames and move the boxes in between (default 1, every frame)")
+    parser.add_argument("--scene_change", type=float, default=SCENE_CHANGE_THRESHOLD, help=f"Difference from the last keyframe making a frame a keyframe (default {SCENE_CHANGE_THRESHOLD})")
+    parser.add_argument("--keyframe_margin", type=float, default=KEYFRAME_MARGIN, help=f"Fraction of their size added around the boxes moved between keyframes (default {KEYFRAME_MARGIN})")
+    parser.add_argument("--annotations", choices=("store", "json"), default=ANNOTATIONS, help=f"Keep the annotations of a camera in a single store or in a 'json' file per frame (default {ANNOTATIONS})")
+    parser.add_argument("--image_format", choices=list(FORMATS), default=IMAGE_FORMAT, help=f"Format of the blurred frames (default {IMAGE_FORMAT})")
+    parser.add_argument("--image_quality", type=parse_quality, default=IMAGE_QUALITY, help="PNG compression level (0-9), JPEG or WebP quality (0-100), or 'lossless' (default OpenCV's default)")
+    parser.add_argument("--pass_through", help="Hard-link (or copy) the frames without anything to blur instead of encoding them again", action="store_true")
+    parser.add_argument("--output_workers", type=int, default=OUTPUT_WORKERS, help=f"Number of threads writing the blurred frames and annotations (default {OUTPUT_WORKERS})")
+    parser.add_argument("--output_queue", type=int, default=OUTPUT_QUEUE, help=f"Number of outputs which can wait for the writing threads (default {OUTPUT_QUEUE})")
+    parser.add_argument("--frame_processes", type=int, default=FRAME_PROCESSES, help="Number of decoder and of encoder processes per camera, sharing the frames through shared memory (default 0, threads)")
+    parser.add_argument("--duplicate_tolerance", type=float, default=DUPLICATE_TOLERANCE, help="Reuse the detections of the last detected frame for frames differing from it by at most this fraction of the intensity range (default off)")
+    parser.add_argument("--video_codec", default=VIDEO_CODEC, help=f"FourCC code of the blurred videos of the cameras which are video files (default {VIDEO_CODEC})")
+    parser.add_argument("--force", help="Process every frame again, even the ones which are up to date", action="store_true")
+    parser.add_argument("--profile", nargs="?", const="profile.json", help="Time every stage and save the report as 'json' (default profile.json)")
 
     args = parser.parse_args()
 
@@ -272,15 +776,59 @@ if __name__ == "__main__":
     if args.lp_threshold is not None:
         change_lp_threshold(args.lp_threshold)
 
+    if args.nms_by_score:
+        NMS_BY_SCORE = True
+
+    BLUR_METHOD = args.blur
+    BLUR_RADIUS = args.blur_radius
+
+    CACHE_PATH = args.cache
+    CACHE_SIZE_MB = args.cache_size
+
+    RESUME = not args.force
+
+    ANNOTATIONS = args.annotations
+
+    VIDEO_CODEC = args.video_codec
+
+    IMAGE_FORMAT = args.image_format
+    IMAGE_QUALITY = args.image_quality
+    PASS_THROUGH = args.pass_through
+
+    OUTPUT_WORKERS = args.output_workers
+    OUTPUT_QUEUE = args.output_queue
+
+    FRAME_PROCESSES = args.frame_processes
+
+    TRACKER_COST = args.tracker_cost
+
+    FACE_BACKEND = args.face_detector
+    FACE_THRESHOLD = args.face_threshold
+    FACE_SCALES = tuple(args.face_scales)
+
+    KEYFRAME_INTERVAL = args.keyframe_interval
+    SCENE_CHANGE_THRESHOLD = args.scene_change
+    KEYFRAME_MARGIN = args.keyframe_margin
+    DUPLICATE_TOLERANCE = args.duplicate_tolerance
+
+    if args.profile:
+        profiler.enabled = True
+
     if args.visualize:
         visualize = True
     else:
         visualize = False
     
-    run(args.data, visualize)
+    run(args.data, visualize, args.workers)
+
+    if args.profile:
+        profiler.save(args.profile)
+
+    from tracking import finding_missing_detections
+    from boxes import blurring
 
     #Postprocessing
-    finding_missing_detections(args.data)
+    filled = finding_missing_detections(args.data)
 
-    #Blur the new detections after postprocessing
-    blurring(args.data)
+    #Blur the plates filled by the postprocessing
+    blurring(args.data, BLUR_METHOD, BLUR_RADIUS, VIDEO_CODEC, ImageEncoder(IMAGE_FORMAT, IMAGE_QUALITY), filled)
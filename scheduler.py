@@ -0,0 +1,142 @@
+"""
+This file contains the scheduler which spreads the cameras of all the sequences in a dataset over a pool of
+worker processes. A camera is always processed by a single worker, frame after frame, so that tracking stays
+correct, while different cameras and sequences run in parallel.
+"""
+
+from profiler import profiler
+import multiprocessing as mp
+import os
+import time
+
+# run_camera of the worker, set once the worker has loaded its models
+_run_camera = None
+
+# error raised while the worker loaded its models
+_init_error = None
+
+def list_jobs(root):
+    """
+    Function to list every camera of every sequence in a dataset, and prepare the output folders of the sequences.
+
+    Parameters:
+        root: Directory of the dataset.
+
+    Return:
+        List of (sequence directory, camera, number of frames), largest cameras first so that the pool
+        doesn't wait on a long camera picked up last.
+    """
+    from run import prepare_sequence
+    from video import is_video, video_info
+    from roi import is_mask
+
+    jobs = []
+    for dir in os.listdir(root):
+        currdir = os.path.join(root, dir)
+        camera = os.path.join(currdir, "camera")
+        if not os.path.isdir(camera):
+            continue
+
+        prepare_sequence(currdir)
+
+        for cam in os.listdir(camera):
+            if is_mask(cam):
+                continue
+
+            currcam = os.path.join(camera, cam)
+            if is_video(currcam):
+                frames = video_info(currcam)[1]
+            else:
+                frames = sum(1 for frame in os.listdir(currcam) if os.path.isfile(os.path.join(currcam, frame)))
+            jobs.append((currdir, cam, frames))
+
+    return sorted(jobs, key=lambda job: job[2], reverse=True)
+
+def _init_worker(vehicle_threshold, lp_threshold, profile, settings):
+    """
+    Initializer of the worker processes. Every worker loads its own copy of the models, once, before taking
+    its first camera.
+
+    Parameters:
+        vehicle_threshold, lp_threshold: Detection thresholds of the parent process.
+        profile: Time the stages of the pipeline.
+        settings: Module level settings of run.py to be used by the worker.
+    """
+    global _run_camera, _init_error
+
+    profiler.enabled = profile
+
+    import detect
+    detect.VEHICLE_DETECTOR_THRESHOLD = vehicle_threshold
+    detect.LP_THRESHOLD = lp_threshold
+
+    import run
+    for name, value in settings.items():
+        setattr(run, name, value)
+
+    # the pool replaces a worker whose initializer raises, forever if every worker fails the same way, so the
+    # error is raised by the first camera of the worker instead and stops the run
+    try:
+        import facedetect
+        detect.warm_up()
+        facedetect.warm_up(run.FACE_BACKEND)
+    except Exception as error:
+        _init_error = RuntimeError(f"The worker couldn't load the models: {error!r}")
+        return
+
+    _run_camera = run.run_camera
+
+def _process(job):
+    """
+    Function run by the workers for a single camera.
+
+    Parameters:
+        job: (sequence directory, camera, number of frames)
+
+    Return:
+        The job, the time taken to process it and the stage timings recorded meanwhile.
+    """
+    if _init_error is not None:
+        raise _init_error
+
+    start = time.time()
+    _run_camera(job[0], job[1])
+
+    return job, time.time() - start, profiler.samples(reset=True)
+
+def schedule(root, workers=None, profile=False, settings=None):
+    """
+    Function to process a dataset with a pool of worker processes and print the aggregated progress.
+
+    Parameters:
+        root: Directory of the dataset.
+        workers: Number of worker processes, defaults to the number of CPUs.
+        profile: Time the stages in the workers and merge the timings into the profiler of this process.
+        settings: Module level settings of run.py (name to value) to be used by the workers.
+    """
+    import detect
+
+    jobs = list_jobs(root)
+    total_frames = sum(job[2] for job in jobs)
+    processed_frames = 0
+
+    # the detection cache and the run manifest shared by the workers are created once, see DetectionCache.open
+    settings = settings or {}
+    if settings.get("RESUME", True):
+        from manifest import RunManifest, MANIFEST_NAME
+        RunManifest(os.path.join(root, MANIFEST_NAME)).close()
+    if settings.get("CACHE_PATH") is not None:
+        from detectioncache import detection_cache
+        detection_cache.open(settings["CACHE_PATH"], settings["CACHE_SIZE_MB"])
+        detection_cache.close()
+
+    # 'spawn' so that no worker inherits a half-initialised CUDA or TensorFlow context from the parent
+    context = mp.get_context("spawn")
+    initargs = (detect.VEHICLE_DETECTOR_THRESHOLD, detect.LP_THRESHOLD, profile, settings)
+
+    with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        for i, ((currdir, cam, frames), duration, samples) in enumerate(pool.imap_unordered(_process, jobs)):
+            profiler.merge(samples)
+            processed_frames += frames
+            print(f"[{i + 1}/{len(jobs)} cameras, {processed_frames}/{total_frames} frames] "
+                  f"Detection for {cam} of {os.path.basename(currdir)} has been completed in {int(duration)} seconds")
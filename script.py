@@ -1,10 +1,15 @@
 """
 This module has functions to delete unnecessary files for ablation study and produce results for it.
 """
-from detect import detect
+from detect import detect, detect_candidates, select_detections, VEHICLE_BATCH_SIZE
+from frame import Frame
+from pipeline import prefetch, batched
+from regionblur import blur_regions
+from detectioncache import detection_cache
+from facedetect import detect_faces
 import os 
 import cv2 
-from PIL import Image, ImageFilter
+import json
 import time
 import sys
 
@@ -63,11 +68,8 @@ def ablation_study(path):
         if not os.path.exists(ablation_path):
             os.mkdir(ablation_path)
 
-        annotations_path = os.path.join(currdir, os.path.join(os.path.join("annotations", path), "license-plates")) # Path where annotations should be saved
-
         for cam in os.listdir(privacy_path): # Iterating through different camera frames in privacy folder
             currcam = os.path.join(privacy_path, cam) # Camera directory
-            annot_path = os.path.join(annotations_path, cam) # Annotations file location
             
             study_path = os.path.join(ablation_path, cam) # 'cam' directory inside study_path
             if not os.path.exists(study_path):
@@ -78,23 +80,22 @@ def ablation_study(path):
                 save_path = os.path.join(study_path, frame) # Path of image for ablation study
 
                 if os.path.isfile(frame_path): # Checking whether path is a file or not
-                    dt = cv2.imread(frame_path) # Creating two instances of frame
-                    blur = Image.open(frame_path)
+                    frame_image = Frame(frame_path) # Decoding the frame once
+                    dt = frame_image.copy() # Creating two instances of frame
+                    blur = frame_image.copy()
 
-                    boxes = detect(frame_path, annot_path) # Getting bounding boxes of license plates in the frame
+                    boxes = detect(frame_image) # Getting bounding boxes of license plates in the frame
 
                     if boxes is not None: # If there are license plates in the frame
                         print(f"{len(boxes)} license plates were found in {frame}") 
                         for box in boxes:
                             left, top, right, bottom = [int(item) for item in box] # Converting bounding box coordinates to integer type
 
-                            # Drawing rectangle on license plate, cropping it from one instance and pasting it on another
+                            # Drawing rectangle on license plate and blurring it on the other instance
                             cv2.rectangle(dt, (left, top), (right, bottom), (255, 0, 0), 2) 
-                            face = blur.crop((left, top, right, bottom))
-                            face_blur = face.filter(ImageFilter.GaussianBlur(radius=20))
-                            blur.paste(face_blur, (left, top, right, bottom)) 
+                            blur_regions(blur, [(left, top, right, bottom)])
 
-                            blur.save(save_path) # Saving resulting image
+                            cv2.imwrite(save_path, blur) # Saving resulting image
                 
             print(f"Detection for {cam} of {dir} has been completed")
         
@@ -102,10 +103,116 @@ def ablation_study(path):
 
     print(f"Total time elapsed : {int(time.time() - start)//60} minutes {int(time.time() - start)%60} seconds.") # Total elapsed time in whole operation
 
+def read_studies(path="ablation-study.txt"):
+    """
+    Function to read the thresholds of the studies from the ablation study file.
+
+    Parameters:
+        path: Location of the ablation study file.
+
+    Return:
+        Dictionary of (vehicle threshold, license plate threshold, face threshold) of every study.
+    """
+    thresholds = {}
+    study = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("study-"):
+                study = line.split()[0].rstrip(":") # e.g. 'study-0 (base):'
+                thresholds[study] = {}
+            elif study is not None and "=" in line:
+                name, value = line.split("=")
+                thresholds[study][name.strip()] = float(value)
+
+    return {study: (values["vehicle detection threshold"], values["license plate detection threshold"],
+                    values["face detection threshold"]) for study, values in thresholds.items()}
+
+def save_json(path, result):
+    """
+    Function to save annotations of a frame.
+    """
+    with open(path, "w") as f:
+        f.write(json.dumps(result))
+
+def sweep(studies):
+    """
+    Function to generate images and annotations of all the studies with a single detection pass. The networks run
+    once at the lowest thresholds of the studies, and the detections of every study are selected from the
+    candidates found, see select_detections.
+
+    Parameters:
+        studies: Dictionary of (vehicle threshold, license plate threshold, face threshold) of every study.
+    """
+    vehicle_threshold = min(thresholds[0] for thresholds in studies.values())
+    lp_threshold = min(thresholds[1] for thresholds in studies.values())
+    face_threshold = min(thresholds[2] for thresholds in studies.values())
+
+    for dir in os.listdir(root): # Iterating through all the sequences in the root directory
+        currdir = os.path.join(root, dir) # Sequence directory
+        privacy_path = os.path.join(currdir, "privacy") # Directory of privacy folder in the sequence
+        if not os.path.isdir(privacy_path):
+            continue
+
+        for cam in os.listdir(privacy_path): # Iterating through different camera frames in privacy folder
+            currcam = os.path.join(privacy_path, cam) # Camera directory
+
+            # Folders of the images, license plate annotations and face annotations of every study
+            paths = {}
+            for study in studies:
+                paths[study] = [os.path.join(currdir, study, cam),
+                                os.path.join(currdir, "annotations", study, "license-plates", cam),
+                                os.path.join(currdir, "annotations", study, "faces", cam)]
+                for path in paths[study]:
+                    os.makedirs(path, exist_ok=True)
+
+            frame_paths = [os.path.join(currcam, frame) for frame in sorted(os.listdir(currcam))]
+            frame_paths = [path for path in frame_paths if os.path.isfile(path)]
+
+            for window in batched(prefetch(frame_paths, Frame), VEHICLE_BATCH_SIZE):
+                candidates = detect_candidates(window, vehicle_threshold, lp_threshold) # Single inference pass for all the studies
+
+                for frame, frame_candidates in zip(window, candidates):
+                    faces = detect_faces(frame, face_threshold)
+
+                    for study, (study_vehicle_threshold, study_lp_threshold, study_face_threshold) in studies.items():
+                        study_path, lic_path, face_path = paths[study]
+
+                        plates = select_detections(frame_candidates, study_vehicle_threshold, study_lp_threshold)
+                        boxes = [plate['bounding box'] for vehicle in plates for plate in plates[vehicle].values()] if plates else []
+
+                        face_result = {}
+                        for face, detection in faces.items():
+                            if detection['score'] >= study_face_threshold:
+                                face_result[face] = {
+                                    'Confidence': float(detection['score']),
+                                    'Bounding box': [int(point) for point in detection['facial_area']]
+                                }
+                                boxes.append(face_result[face]['Bounding box'])
+
+                        save_json(os.path.join(lic_path, f"{frame.stem}.json"), plates)
+                        save_json(os.path.join(face_path, f"{frame.stem}.json"), face_result)
+
+                        cv2.imwrite(os.path.join(study_path, frame.name), blur_regions(frame.copy(), boxes)) # Saving resulting image
+
+                print(f"{len(window)} frames of {cam} of {dir} have been processed for {len(studies)} studies")
+
+            print(f"Detection for {cam} of {dir} has been completed")
+
+        print(f"Detection for {dir} has been completed")
+
+    print(f"Total time elapsed : {int(time.time() - start)//60} minutes {int(time.time() - start)%60} seconds.") # Total elapsed time in whole operation
+
 
 if __name__ == "__main__":
     if sys.argv[1] == "delete": # For delete operation
         delete()
+    elif sys.argv[1] == "sweep": # For producing images of all the studies in ablation-study.txt with a single detection pass
+        if len(sys.argv) > 2:
+            detection_cache.open(sys.argv[2])
+        sweep(read_studies())
     else: # For producing images for ablation study inside the directory of the given name
         path = sys.argv[1]
+        if len(sys.argv) > 2: # Detection cache file, shared between studies and reruns
+            detection_cache.open(sys.argv[2])
         ablation_study(path)
\ No newline at end of file
@@ -0,0 +1,327 @@
+"""
+This file contains the detection server, a long lived process keeping the networks and the face detector loaded. It
+takes encoded images over HTTP, on a TCP port or a Unix socket, and answers with the faces and license plates found
+in them, in the format of the annotations of run.py, along with the blurred image if asked for. Requests arriving
+within a short window are detected together, in a single batch of the vehicle and lp networks.
+
+    python server.py --port 8080
+    python server.py --socket /tmp/detector.sock
+
+    curl --data-binary @frame.png "http://localhost:8080/detect?blur=png"
+    curl --unix-socket /tmp/detector.sock --data-binary @frame.png http://localhost/detect
+
+POST /detect: body is an encoded image (PNG, JPEG, ...), the optional query parameter 'blur' is the format of the
+blurred image sent back (png, jpg or webp, base64 encoded in the 'image' field).
+GET /health: status of the server.
+"""
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import base64
+import json
+import os
+import socket
+import threading
+import time
+import cv2
+import numpy as np
+import detect
+import facedetect
+from detect import detect_frames, VEHICLE_BATCH_SIZE
+from facedetect import detect_faces, BACKENDS
+from frame import Frame
+from imageoutput import ImageEncoder, FORMATS
+from regionblur import blur_regions, parse_radius, METHODS
+from run import batched_nms, NMS_BY_SCORE
+
+# longest time, in milliseconds, a request waits for others to be detected with
+BATCH_WINDOW_MS = 10
+
+class MicroBatcher:
+    """
+    Groups the items submitted by several threads in batches processed by a single thread. A batch is processed
+    as soon as it is full, or once the window has passed since its first item arrived.
+
+    Parameters:
+        function: Function processing a list of items and returning the list of their results.
+        max_batch: Maximum number of items in a batch.
+        window: Longest time in seconds the first item of a batch waits for others.
+    """
+    def __init__(self, function, max_batch=VEHICLE_BATCH_SIZE, window=BATCH_WINDOW_MS / 1000):
+        self.function = function
+        self.max_batch = max_batch
+        self.window = window
+
+        self._items = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """
+        Function to add an item to the next batch.
+
+        Return:
+            Future of the result of the item.
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The batcher is closed.")
+            self._items.append((item, future))
+            self._condition.notify()
+
+        return future
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if not self._items:
+                return None
+
+            # the batch fills up until the window of its first item is over
+            deadline = time.monotonic() + self.window
+            while len(self._items) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch, self._items = self._items[:self.max_batch], self._items[self.max_batch:]
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                results = self.function([item for item, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self):
+        """
+        Function to process the items left and stop the batching thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+class DetectionService:
+    """
+    Faces and license plates detection of single frames, with the models loaded once.
+
+    Parameters:
+        face_backend, face_threshold, face_scales: Face detector, see facedetect.detect_faces.
+        blur_method, blur_radius: Blur of the images sent back, see regionblur.
+        max_batch: Maximum number of frames detected together.
+        window: Longest time in seconds a frame waits for others to be detected with.
+        nms_by_score: Pick overlapping plates by confidence instead of by bottom coordinate, as run.py does with
+                      --nms_by_score.
+    """
+    def __init__(self, face_backend="retinaface", face_threshold=0.5, face_scales=(1.0,), blur_method="box",
+                 blur_radius=20, max_batch=VEHICLE_BATCH_SIZE, window=BATCH_WINDOW_MS / 1000, nms_by_score=NMS_BY_SCORE):
+        self.face_backend = face_backend
+        self.face_threshold = face_threshold
+        self.face_scales = face_scales
+        self.blur_method = blur_method
+        self.blur_radius = blur_radius
+        self.nms_by_score = nms_by_score
+
+        detect.warm_up()
+        facedetect.warm_up(face_backend)
+
+        self.batcher = MicroBatcher(self.detect_batch, max_batch, window)
+
+    def annotate(self, frame, plates):
+        """
+        Function to detect the faces of a frame and keep the best of overlapping license plates.
+
+        Parameters:
+            frame: Frame object.
+            plates: License plates detected in the frame, see detect.detect_frames.
+
+        Return:
+            Face annotations and license plate annotations of the frame, plates being numbered per vehicle
+            instead of by track.
+        """
+        faces = detect_faces(frame, self.face_threshold, self.face_backend, self.face_scales)
+        face_result = {name: {'Confidence': float(face['score']), 'Bounding box': [int(point) for point in face['facial_area']]}
+                       for name, face in faces.items()}
+
+        lic_result = {}
+        if plates:
+            candidates = [(vehicle, float(plate['confidence']), plate['bounding box'])
+                          for vehicle, vehicle_plates in plates.items() for plate in vehicle_plates.values()]
+            boxes = np.array([box for _, _, box in candidates]).astype(int).reshape(-1, 4)
+            vehicles = np.array([vehicle for vehicle, _, _ in candidates])
+            scores = np.array([score for _, score, _ in candidates])
+
+            # same NMS as run.py, so that both give the same plates for a frame
+            for i in batched_nms(boxes, 0.3, groups=vehicles, scores=scores if self.nms_by_score else None).tolist():
+                vehicle = lic_result.setdefault(int(vehicles[i]), {})
+                vehicle[len(vehicle)] = {'Confidence': float(scores[i]), 'Bounding box': [boxes[i].tolist()]}
+
+        return face_result, lic_result
+
+    def detect_batch(self, frames):
+        """
+        Function to detect the faces and license plates of a batch of frames, run by the batching thread only.
+        """
+        return [self.annotate(frame, plates) for frame, plates in zip(frames, detect_frames(frames))]
+
+    def detect(self, data, blur=None):
+        """
+        Function to detect the faces and license plates of an encoded image.
+
+        Parameters:
+            data: Encoded image.
+            blur: Format the blurred image is sent back in, NoneType object for the detections only.
+
+        Return:
+            Dictionary with the face and license plate annotations, and the base64 encoded blurred image if asked for.
+        """
+        if not data:
+            raise ValueError("The body is empty, an encoded image was expected.")
+
+        # OpenCV raises on some bodies instead of returning None
+        try:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            image = None
+        if image is None:
+            raise ValueError("The body couldn't be decoded as an image.")
+
+        face_result, lic_result = self.batcher.submit(Frame("request", image)).result()
+        response = {'faces': face_result, 'license-plates': lic_result}
+
+        if blur is not None:
+            encoder = ImageEncoder(blur)
+            boxes = [face['Bounding box'] for face in face_result.values()]
+            boxes += [box for objects in lic_result.values() for plate in objects.values() for box in plate['Bounding box']]
+            blurred = blur_regions(image, boxes, self.blur_method, self.blur_radius)
+            response['image'] = base64.b64encode(cv2.imencode(encoder.extension, blurred, encoder.params)[1].tobytes()).decode()
+
+        return response
+
+    def close(self):
+        self.batcher.close()
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    HTTP requests of the detection server, the service is the server's.
+    """
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self.reply(200, {'status': "ok"})
+        else:
+            self.reply(404, {'error': "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/detect":
+            self.reply(404, {'error': "Not found"})
+            return
+
+        blur = parse_qs(url.query).get("blur", [None])[0]
+        if blur is not None and blur not in FORMATS:
+            self.reply(400, {'error': f"Unknown image format {blur}, expected one of {', '.join(FORMATS)}."})
+            return
+
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            self.reply(200, self.server.service.detect(data, blur))
+        except ValueError as error:
+            self.reply(400, {'error': str(error)})
+        except Exception as error:
+            # e.g. a CUDA or OpenCV error raised by the detection of the batch
+            self.log_error("Detection failed: %r", error)
+            self.reply(500, {'error': f"Detection failed: {error}"})
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """
+    HTTP server listening on a Unix socket.
+    """
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = "localhost", 0
+
+def serve(service, port=8080, host="127.0.0.1", unix_socket=None):
+    """
+    Function to serve detection requests until interrupted.
+
+    Parameters:
+        service: DetectionService answering the requests.
+        port, host: Address of the server.
+        unix_socket: Location of a Unix socket to listen on instead of a TCP port.
+    """
+    server = UnixHTTPServer(unix_socket, Handler) if unix_socket else ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = service
+
+    print(f"Serving detections on {unix_socket or f'{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server keeping the detectors loaded and detecting faces and license plates in images")
+    parser.add_argument("--port", type=int, default=8080, help="TCP port (default 8080)")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument("--socket", help="Unix socket to listen on instead of a TCP port")
+    parser.add_argument("--vehicle_threshold", type=float, help="Change vehicle detection threshold")
+    parser.add_argument("--lp_threshold", type=float, help="Change lp detection threshold")
+    parser.add_argument("--face_detector", choices=list(BACKENDS), default="retinaface", help="Face detector (default retinaface)")
+    parser.add_argument("--face_threshold", type=float, default=0.5, help="Confidence threshold of the face detector (default 0.5)")
+    parser.add_argument("--face_scales", type=float, nargs="+", default=(1.0,), help="Scales of the frame the face detector runs on (default 1)")
+    parser.add_argument("--nms_by_score", help="Keep the most confident of overlapping plates instead of the lowest one", action="store_true")
+    parser.add_argument("--blur", choices=METHODS, default="box", help="Blur method of the images sent back (default box)")
+    parser.add_argument("--blur_radius", type=parse_radius, default=20, help="Strength of the blur in pixels (default 20)")
+    parser.add_argument("--batch", type=int, default=VEHICLE_BATCH_SIZE, help=f"Maximum number of images detected together (default {VEHICLE_BATCH_SIZE})")
+    parser.add_argument("--window_ms", type=float, default=BATCH_WINDOW_MS, help=f"Longest time in milliseconds an image waits for others to be detected with (default {BATCH_WINDOW_MS})")
+
+    args = parser.parse_args()
+
+    if args.vehicle_threshold is not None:
+        detect.change_vehicle_threshold(args.vehicle_threshold)
+    if args.lp_threshold is not None:
+        detect.change_lp_threshold(args.lp_threshold)
+
+    service = DetectionService(args.face_detector, args.face_threshold, tuple(args.face_scales), args.blur,
+                               args.blur_radius, args.batch, args.window_ms / 1000, args.nms_by_score)
+    serve(service, args.port, args.host, args.socket)
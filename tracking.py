@@ -1,99 +1,224 @@
+"""
+This file contains the postprocessing of the license plate annotations. A tracked plate which is missed in a few
+frames is filled in those frames by interpolating its bounding box between the detections around the gap. The
+plates of a whole camera are grouped by track ID and the gaps of every track are filled at once. Gaps filled by an
+earlier run are rows of their track already, so only the plates missed since are filled, and the rewritten
+annotation files are recorded in the run manifest.
+
+    python tracking.py <dataset> [max gap] [linear|velocity]
+"""
+
 import json
 import os
+import sys
+import numpy as np
+from annotationstore import AnnotationStore
+from imageoutput import file_info
+from manifest import update_camera
+
+# longest gap, in frames, which is filled
+MAX_GAP = 5
+
+# interpolation methods, see fill_gaps
+METHODS = ("linear", "velocity")
+
+def load_annotations(currdir, cam):
+    """
+    Function to load the annotations of a camera, from its annotation store or from its 'json' files.
+
+    Parameters:
+        currdir: Directory of the sequence.
+        cam: Name of the camera.
+
+    Return:
+        Annotation store of the camera (NoneType object for 'json' files), list of frame names in order and
+        list of the license plate annotations of every frame.
+    """
+    annotations = os.path.join(currdir, "annotations")
 
-def dissecting_the_frames(x1, x2, y1, y2, m, n):
-    x = (float)((n * x1)+(m * x2))/(m + n) 
-    y = (float)((n * y1)+(m * y2))/(m + n) 
-
-    return [int(x), int(y)]
+    if os.path.isfile(os.path.join(annotations, f"{cam}.frames")):
+        store = AnnotationStore(os.path.join(annotations, cam))
+        names = sorted(store.index())
+        return store, names, [store.annotations(name)[1] for name in names]
+
+    license_path = os.path.join(annotations, "license-plates", cam)
+    names = sorted(file for file in os.listdir(license_path) if file.endswith(".json"))
+
+    plates = []
+    for name in names:
+        with open(os.path.join(license_path, name), 'r') as f:
+            plates.append(json.loads(f.read()))
+
+    return None, names, plates
+
+def frame_sources(currdir, cam):
+    """
+    Function to get the source of the frames of a camera, for recording their outputs in the run manifest.
+
+    Parameters:
+        currdir: Directory of the sequence.
+        cam: Name of the camera, a folder of frames or a video file.
+
+    Return:
+        Function giving the path of the source of a frame from its name or the name of its 'json' file, the
+        source of every frame of a video being the video.
+    """
+    currcam = os.path.join(currdir, "camera", cam)
+    if not os.path.isdir(currcam):
+        return lambda name: currcam
+
+    sources = {os.path.splitext(file)[0]: os.path.join(currcam, file) for file in os.listdir(currcam)}
+    return lambda name: sources.get(os.path.splitext(name)[0], os.path.join(currcam, name))
+
+def track_rows(plates):
+    """
+    Function to flatten the license plate annotations of a camera, keeping one box per track and frame.
+
+    Parameters:
+        plates: License plate annotations of every frame, {vehicle: {object ID: {'Confidence', 'Bounding box'}}}.
+
+    Return:
+        Arrays of frame index, track ID, vehicle and bounding box (N, 4) of every row, sorted by track and frame.
+    """
+    rows = {}
+    for i, frame_plates in enumerate(plates):
+        for vehicle, objects in frame_plates.items():
+            for objectId, detection in objects.items():
+                boxes = np.asarray(detection['Bounding box'], dtype=float).reshape(-1, 4)
+                if len(boxes):
+                    rows.setdefault((int(objectId), i), (int(vehicle), boxes[0]))
+
+    keys = sorted(rows)
+    tracks = np.array([key[0] for key in keys], dtype=int)
+    frames = np.array([key[1] for key in keys], dtype=int)
+    vehicles = np.array([rows[key][0] for key in keys], dtype=int)
+    boxes = np.array([rows[key][1] for key in keys], dtype=float).reshape(-1, 4)
+
+    return frames, tracks, vehicles, boxes
+
+def fill_gaps(frames, tracks, boxes, max_gap=MAX_GAP, method="linear"):
+    """
+    Function to interpolate the boxes of every track in the frames it is missing from, for gaps of at most max_gap
+    frames.
+
+    Parameters:
+        frames, tracks, boxes: Rows sorted by track and frame, see track_rows.
+        max_gap: Longest gap which is filled, in frames.
+        method: 'linear' for moving the box at a constant speed from one end of the gap to the other, 'velocity'
+                for a cubic curve which also keeps the speed the track had before and after the gap.
+
+    Return:
+        Index of the row before the gap and frame index and interpolated box (N, 4) of every filled row.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown interpolation method {method}, expected one of {', '.join(METHODS)}.")
+
+    # gaps between consecutive rows of the same track
+    lengths = np.diff(frames)
+    gaps = np.flatnonzero((tracks[1:] == tracks[:-1]) & (lengths > 1) & (lengths <= max_gap + 1))
+    if len(gaps) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 4))
+
+    # one filled row per missing frame, at a fraction s of the way through its gap
+    missing = lengths[gaps] - 1
+    before = np.repeat(gaps, missing)
+    steps = np.arange(missing.sum()) - np.repeat(np.cumsum(missing) - missing, missing) + 1
+    length = lengths[before][:, None]
+    s = steps[:, None] / length
+
+    start, end = boxes[before], boxes[before + 1]
+
+    if method == "linear":
+        filled = start + s * (end - start)
+    else:
+        # speed (per frame) at both ends of the gap, measured on the neighbouring rows of the track, or the
+        # average speed through the gap where the track has no row on that side
+        average = (end - start) / length
+        velocity_start, velocity_end = average.copy(), average.copy()
+
+        previous = before - 1
+        has_previous = (previous >= 0) & (tracks[np.maximum(previous, 0)] == tracks[before])
+        velocity_start[has_previous] = ((start - boxes[previous]) / np.maximum(frames[before] - frames[previous], 1)[:, None])[has_previous]
+
+        following = np.minimum(before + 2, len(frames) - 1)
+        has_following = (before + 2 < len(frames)) & (tracks[following] == tracks[before])
+        velocity_end[has_following] = ((boxes[following] - end) / np.maximum(frames[following] - frames[before + 1], 1)[:, None])[has_following]
+
+        # cubic Hermite curve
+        h00 = 2 * s ** 3 - 3 * s ** 2 + 1
+        h10 = s ** 3 - 2 * s ** 2 + s
+        h01 = -2 * s ** 3 + 3 * s ** 2
+        h11 = s ** 3 - s ** 2
+        filled = h00 * start + h10 * length * velocity_start + h01 * end + h11 * length * velocity_end
+
+    return before, frames[before] + steps, filled
+
+def finding_missing_detections(dataset, max_gap=MAX_GAP, method="linear"):
+    """
+    Function to fill the license plates missed by the detector in every camera of a dataset. Filled plates are
+    annotated with a confidence of -1, and saved in the annotation store (or 'json' files) of the camera.
+
+    Parameters:
+        dataset: Directory of the dataset.
+        max_gap: Longest gap which is filled, in frames.
+        method: Interpolation method, see fill_gaps.
+
+    Return:
+        Dictionary of the plates filled by this call, {(sequence directory, camera): {frame name: [bounding boxes]}},
+        frame names being those of the annotations (see load_annotations).
+    """
+    root = os.path.join(os.getcwd(), dataset)
+
+    filled = {}
+    for dir in sorted(os.listdir(root)):
+        currdir = os.path.join(root, dir)
+        camera = os.path.join(currdir, "camera")
+        if not os.path.isdir(camera):
+            continue
+
+        for cam in sorted(os.listdir(camera)):
+            if not (os.path.isfile(os.path.join(currdir, "annotations", f"{cam}.frames")) or
+                    os.path.isdir(os.path.join(currdir, "annotations", "license-plates", cam))):
+                continue
+
+            store, names, plates = load_annotations(currdir, cam)
+
+            frames, tracks, vehicles, boxes = track_rows(plates)
+            before, filled_frames, filled_boxes = fill_gaps(frames, tracks, boxes, max_gap, method)
+
+            # add the filled plates to the annotations of their frames
+            camera_filled = {}
+            for row, i, box in zip(before.tolist(), filled_frames.tolist(), filled_boxes.round().astype(int).tolist()):
+                vehicle = plates[i].setdefault(str(vehicles[row]), {})
+                vehicle[str(tracks[row])] = {
+                    'Confidence': -1,
+                    'Bounding box': [box],
+                }
+                camera_filled.setdefault(names[i], []).append(box)
+
+            source = frame_sources(currdir, cam)
+            outputs = {}
+            for i in [i for i, name in enumerate(names) if name in camera_filled]:
+                if store is not None:
+                    store.append(names[i], store.annotations(names[i])[0], plates[i], store.source(names[i]))
+                else:
+                    path = os.path.join(currdir, "annotations", "license-plates", cam, names[i])
+                    with open(path, "w") as f:
+                        f.write(json.dumps(plates[i]))
+                    outputs.setdefault(source(names[i]), []).append(file_info(path))
 
-#Path
-root = os.path.join(os.getcwd(), "")
+            if store is not None:
+                store.close()
 
-#Iterate through root directory
-for dir in os.listdir(root):
+            # rewritten annotation files are up to date, the store isn't an output of the frames
+            update_camera(currdir, cam, outputs)
 
-    #Current directory
-    currdir = os.path.join(root, dir)
+            if camera_filled:
+                filled[(currdir, cam)] = camera_filled
+            print(f"{len(filled_frames)} missing license plates of {cam} of {dir} have been filled")
 
-    #Annotations directory
-    annotations = os.path.join(currdir, "annotations")
+    return filled
 
-    #License plates directory
-    license_path = os.path.join(annotations, "license-plates")
-
-    #Iterate through 'cam' directories
-    for cam in os.listdir(license_path):
-        currcam = os.path.join(license_path, cam)
-
-        #Parameters
-        objID = 0
-        vehicle = 0
-        detectedFrames = {}
-        emptyFrames = []
-
-        #Iterate through 'json' files
-        for frame in os.listdir(currcam):
-
-            #Open the file
-            frame_path = os.path.join(currcam, frame)
-            with open(frame_path, 'r') as f:
-                detections = json.loads(f.read())
-                
-                #Detections
-                if len(detections) != 0:
-                    for vehicles in detections:
-                        for objectID in detections[vehicles]:
-                            vehicle = vehicles
-                            objID = objectID
-                            detectedFrames[frame] = [element for innerList in detections[vehicles][objectID]["Bounding box"] for element in innerList]
-                #No detections
-                else:
-                    if len(detectedFrames) == 1:
-                        emptyFrames.append(frame)
-
-                #Fill in the coordinates
-                if len(detectedFrames) == 2:
-
-                    #Detected frames
-                    frames = []
-                    for key in detectedFrames:
-                        frames.append(key)
-
-                    #Skipped frames
-                    totalSkippedFrames = len(emptyFrames)
-                    if totalSkippedFrames != 0 and totalSkippedFrames <= 5:
-
-                        #Dissecting the skipped frames
-                        lineSegments = totalSkippedFrames + 1
-                        x11, y11, x21, y21 = detectedFrames[frames[0]]
-                        x12, y12, x22, y22 = detectedFrames[frames[1]]
-
-                        m = 1
-                        print(emptyFrames)
-                        for file in emptyFrames:
-                            if m != lineSegments:
-                                n = lineSegments - m
-                                x1, y1 = dissecting_the_frames(x11, x12, y11, y12, m, n)
-                                x2, y2 = dissecting_the_frames(x21, x22, y21, y22, m, n)
-
-                                m += 1
-
-                            #Dump the annotations
-                            result = {
-                                vehicle: {
-                                    objID: {
-                                        'Confidence': -1,
-                                        'Bounding box': [[x1, y1, x2, y2]],
-                                    }
-                                }
-                            }
-                            store_path = os.path.join(currcam, file)
-                            with open(f"{store_path}", "w") as f:
-                                f.write(json.dumps(result))
-
-                    #Reset the parameters
-                    vehicle = 0
-                    objID = 0
-                    detectedFrames.pop(frames[0])
-                    emptyFrames.clear()
\ No newline at end of file
+if __name__ == "__main__":
+    finding_missing_detections(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else MAX_GAP,
+                               sys.argv[3] if len(sys.argv) > 3 else "linear")
@@ -0,0 +1,141 @@
+"""
+This file contains the video input and output of run.py. A camera can be a video file (camera/<cam>.mp4) instead of a
+folder of frames: its frames are decoded in a stream with cv2.VideoCapture and named after their index, so that the
+annotations are the same as for a folder of frames, and the blurred frames are encoded in a single video
+(privacy/<cam>.mp4) with cv2.VideoWriter.
+"""
+
+import hashlib
+import os
+import cv2
+from frame import Frame
+from pipeline import Writer
+from profiler import profiler
+
+# extensions of the files read as videos
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+
+# FourCC code of the blurred videos
+VIDEO_CODEC = "mp4v"
+
+def is_video(path):
+    """
+    Function to tell whether a camera is a video file.
+
+    Parameters:
+        path: Location of the camera, a folder of frames or a video file.
+    """
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+def frame_name(index):
+    """
+    Function to get the name of the frame of a video at a given index, used for naming its annotations.
+    """
+    return f"{index:06d}"
+
+def video_info(path):
+    """
+    Function to get the frame rate and number of frames of a video, as given by its container.
+
+    Parameters:
+        path: Location of the video.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"{path} couldn't be read as a video.")
+
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    length = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+
+    return fps, length
+
+def read_video(path):
+    """
+    Generator decoding the frames of a video in order.
+
+    Parameters:
+        path: Location of the video.
+
+    Return:
+        Yields Frame objects, whose path is the video's path followed by the frame's name.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"{path} couldn't be read as a video.")
+
+    try:
+        index = 0
+        while True:
+            with profiler.stage("decode"):
+                success, image = capture.read()
+            if not success:
+                break
+
+            yield Frame(os.path.join(path, frame_name(index)), image)
+            index += 1
+    finally:
+        capture.release()
+
+class VideoOutput:
+    """
+    Video the blurred frames of a camera are encoded in, in a background thread. Frames are written in the order
+    they are given. The video is written to a temporary file which replaces the video once it is closed, so an
+    interrupted run never leaves a truncated video behind.
+
+    Parameters:
+        path: Location of the video, its extension sets the container.
+        fps: Frame rate of the video.
+        codec: FourCC code of the video.
+        max_pending: Maximum number of frames waiting to be encoded.
+    """
+    def __init__(self, path, fps, codec=VIDEO_CODEC, max_pending=16):
+        self.path = path
+        self.fps = fps if fps > 0 else 30
+        self.codec = codec
+
+        root, extension = os.path.splitext(path)
+        self._partial = f"{root}.part{extension}"
+        self._video = None
+
+        # a single thread, so that frames are encoded in order
+        self._writer = Writer(workers=1, max_pending=max_pending)
+
+    def _write(self, image):
+        if self._video is None:
+            height, width = image.shape[:2]
+            self._video = cv2.VideoWriter(self._partial, cv2.VideoWriter_fourcc(*self.codec), self.fps, (width, height))
+            if not self._video.isOpened():
+                raise ValueError(f"{self._partial} couldn't be opened for writing with the {self.codec} codec.")
+
+        self._video.write(image)
+
+    def write(self, image):
+        """
+        Function to append a frame to the video.
+
+        Parameters:
+            image: Frame in OpenCV format, all the frames of a video have the same resolution.
+        """
+        self._writer.submit(profiler.timed("video write", self._write), image)
+
+    def close(self):
+        """
+        Function to finish encoding the video.
+
+        Return:
+            Path, size and checksum of the video file, NoneType object if no frame was written.
+        """
+        self._writer.close()
+        if self._video is None:
+            return None
+
+        self._video.release()
+        os.replace(self._partial, self.path)
+
+        checksum = hashlib.sha1()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                checksum.update(chunk)
+
+        return self.path, os.path.getsize(self.path), checksum.hexdigest()
@@ -1,6 +1,7 @@
 import os
 import cv2
 import json
+from annotationstore import AnnotationStore
 
 #Path
 root = os.path.join(os.getcwd(), "")
@@ -25,7 +26,7 @@ for dir in os.listdir(root):
     #License plates directory
     license_path = os.path.join(annotations, "license-plates")
 
-    for cam in os.listdir(license_path):
+    for cam in os.listdir(camera):
 
         #Create directory to store blurred images for each cam
         blur_folder_path = os.path.join(postprocessing, cam)
@@ -35,19 +36,29 @@ for dir in os.listdir(root):
         currcam = os.path.join(license_path, cam)
         cam_dir = os.path.join(camera, cam)
 
-        for file in os.listdir(currcam):
+        #Annotations of the camera are read from its annotation store, or from its 'json' files
+        store = None
+        if os.path.isfile(os.path.join(annotations, f"{cam}.frames")):
+            store = AnnotationStore(os.path.join(annotations, cam))
+            files = list(store.index())
+        elif os.path.isdir(currcam):
+            files = os.listdir(currcam)
+        else:
+            continue
 
-            #Current 'json' file
-            currfile = os.path.join(currcam, file)
+        for file in files:
 
             #Fetch the image from camera directory
             img_name = file[0:5] +".png"
             img_path = os.path.join(cam_dir, img_name)
             img = cv2.imread(img_path)
 
-            #Open the 'json' file
-            with open(currfile, 'r') as f:
-                detections = json.loads(f.read())
+            if store is not None:
+                detections = store.annotations(file)[1]
+            else:
+                #Open the 'json' file
+                with open(os.path.join(currcam, file), 'r') as f:
+                    detections = json.loads(f.read())
 
             #Use the annotations for bounding boxes
             if len(detections) != 0:
@@ -56,4 +67,4 @@ for dir in os.listdir(root):
                         x1, y1, x2, y2 = [element for innerList in detections[vehicles][objectID]["Bounding box"] for element in innerList]   
                         img = cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 0), 2)
 
-            cv2.imwrite(f"{blur_folder_path}\{img_name}", img)
\ No newline at end of file
+            cv2.imwrite(os.path.join(blur_folder_path, img_name), img)
\ No newline at end of file